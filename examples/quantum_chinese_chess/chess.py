@@ -484,18 +484,16 @@ class QuantumChineseChess:
         """After quantum moves, there might be pieces that:
         - is actually empty, but their classical properties is not cleared; or
         - is actually classically occupied, but their is_entangled state is not updated.
-        This method is called after each quantum move, and runs (100x) sampling of the board
-        to identify and fix those cases.
+        This method is called after each quantum move, and computes the exact probabilities
+        of the board to identify and fix those cases.
         """
-        probs = self.board.board.get_binary_probabilities()
+        probs = self.board.board.get_binary_probabilities(exact=True)
         num_rows = 10
         num_cols = 9
         for row in range(num_rows):
             for col in "abcdefghi":
                 piece = self.board.board[f"{col}{row}"]
                 prob = probs[row * num_cols + ord(col) - ord("a")]
-                # TODO(): This threshold does not actually work right now since we have 100 sampling.
-                # Change it to be more meaningful values maybe when we do error mitigation.
                 if prob < 1e-3:
                     piece.reset()
                     probs[row * num_cols + ord(col) - ord("a")] = 0
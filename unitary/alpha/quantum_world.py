@@ -13,15 +13,160 @@
 # limitations under the License.
 import copy
 import enum
-from typing import cast, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+import functools
+from typing import (
+    cast,
+    Dict,
+    FrozenSet,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 import cirq
 
 from unitary.alpha.quantum_object import QuantumObject
-from unitary.alpha.sparse_vector_simulator import PostSelectOperation, SparseSimulator
+from unitary.alpha.qudit_gates import BasisPermutationGate, QuditXGate
+from unitary.alpha.sparse_vector_simulator import (
+    InvalidPostSelectionError,
+    PostSelectOperation,
+    SparseSimulationState,
+    SparseSimulator,
+)
 from unitary.alpha.qudit_state_transform import qudit_to_qubit_unitary, num_bits
+from unitary.circuit_utils import backward_light_cone
 import numpy as np
 import itertools
 
+# Probabilities below this are treated as rounding errors by the exact
+# distribution functions.
+_PROBABILITY_TOLERANCE = 1e-12
+
+# Maximum number of repetitions a single peek may run before giving up.
+_MAX_REPETITIONS = 10**6
+
+# Extra fraction of repetitions requested on top of the expected shortfall
+# of post-selected samples, so that a second top-up is rarely needed.
+_REPETITION_MARGIN = 0.2
+
+# Number of distinct qudit gates whose compiled qubit gate is cached.
+_COMPILED_GATE_CACHE_SIZE = 1024
+
+
+class _AppendedOp(NamedTuple):
+    """Log record of an operation appended to the circuit."""
+
+    moment_index: int
+    op: cirq.Operation
+    # Whether a new moment was created for the operation.
+    new_moment: bool
+
+
+class _PostSelection(NamedTuple):
+    """Log record of a change to the post-selection dictionary."""
+
+    obj: QuantumObject
+    # The previous post-selected value, or None if there was none.
+    previous: Optional[int]
+
+
+class _Remap(NamedTuple):
+    """Log record of swapping qubits in the circuit."""
+
+    qubit_remapping_dict: Dict[cirq.Qid, cirq.Qid]
+
+
+class _Compaction(NamedTuple):
+    """Log record of `QuantumWorld.compact`, holding the replaced state."""
+
+    circuit: cirq.Circuit
+    physical_qubits: Dict[cirq.Qid, cirq.Qid]
+    logical_qubits: Dict[cirq.Qid, cirq.Qid]
+    object_name_dict: Dict[str, QuantumObject]
+    ancilla_names: Set[str]
+    compiled_qubits: Dict[cirq.Qid, List[cirq.Qid]]
+    post_selection: Dict[QuantumObject, int]
+
+
+_LogRecord = Union[_AppendedOp, _PostSelection, _Remap, _Compaction]
+
+
+def _copy_log_record(
+    record: _LogRecord, objects: Dict[QuantumObject, QuantumObject]
+) -> _LogRecord:
+    """Copies a log record, replacing the objects it refers to by `objects`."""
+    if isinstance(record, _PostSelection):
+        return record._replace(obj=objects[record.obj])
+    if isinstance(record, _Compaction):
+        return _Compaction(
+            circuit=record.circuit.copy(),
+            physical_qubits=record.physical_qubits.copy(),
+            logical_qubits=record.logical_qubits.copy(),
+            object_name_dict={
+                name: objects[obj] for name, obj in record.object_name_dict.items()
+            },
+            ancilla_names=record.ancilla_names.copy(),
+            compiled_qubits=record.compiled_qubits.copy(),
+            post_selection={
+                objects[obj]: value for obj, value in record.post_selection.items()
+            },
+        )
+    # The other records are immutable and do not refer to objects.
+    return record
+
+
+def _qubit_gate(
+    qudit_dimension: int, num_qudits: int, qudit_unitary: np.ndarray
+) -> cirq.Gate:
+    """Returns a gate on the compiled qubits equivalent to a qudit unitary.
+
+    Permutations compile to a `BasisPermutationGate` and diagonal unitaries
+    to a `cirq.DiagonalGate`. Their structure is read from the qudit
+    unitary, so the padded qubit unitary is never built for them. Other
+    unitaries compile to a `cirq.MatrixGate`.
+    """
+    qubits_per_qudit = num_bits(qudit_dimension)
+    qid_shape = (2,) * (qubits_per_qudit * num_qudits)
+    if (np.count_nonzero(qudit_unitary, axis=0) == 1).all():
+        qudit_permutation = np.argmax(qudit_unitary != 0, axis=0)
+        columns = np.arange(len(qudit_permutation))
+        qudit_phases = qudit_unitary[qudit_permutation, columns]
+        if (qudit_permutation == columns).all():
+            qudit_permutation = None
+        # The index of each qudit basis state among the padded qubit states.
+        padded_index = np.ravel_multi_index(
+            np.unravel_index(columns, (qudit_dimension,) * num_qudits),
+            (1 << qubits_per_qudit,) * num_qudits,
+        )
+        # The padding states are left alone.
+        phases = np.ones(1 << len(qid_shape), dtype=qudit_unitary.dtype)
+        phases[padded_index] = qudit_phases
+        if qudit_permutation is None:
+            return cirq.DiagonalGate(np.angle(phases))
+        permutation = np.arange(len(phases))
+        permutation[padded_index] = padded_index[qudit_permutation]
+        return BasisPermutationGate(qid_shape, permutation, phases)
+    compiled_unitary = qudit_to_qubit_unitary(
+        qudit_dimension=qudit_dimension,
+        num_qudits=num_qudits,
+        qudit_unitary=qudit_unitary,
+    )
+    return cirq.MatrixGate(matrix=compiled_unitary, qid_shape=qid_shape)
+
+
+@functools.lru_cache(maxsize=_COMPILED_GATE_CACHE_SIZE)
+def _compile_gate(gate: cirq.Gate) -> cirq.Gate:
+    """Returns the gate on the compiled qubits equivalent to a qudit gate.
+
+    Equal gates share the result, so `_compile_gate.cache_info()` reports
+    how often compiling was avoided.
+    """
+    qid_shape = cirq.qid_shape(gate)
+    return _qubit_gate(qid_shape[0], len(qid_shape), cirq.unitary(gate))
+
 
 class QuantumWorld:
     """A collection of `QuantumObject`s with effects.
@@ -39,27 +184,49 @@ class QuantumWorld:
     how to evaluate the quantum game state. If not specified, this
     defaults to a noiseless simulator optimized for sparse state vectors.
     You may also use e.g. cirq.Simulator, a noiseless simulator using
-    dense state vectors, which natively supports qudits unlike the sparse
-    simulator.
+    dense state vectors. Both simulators natively support qudits.
 
     Setting the `compile_to_qubits` option results in an internal state
     representation of ancilla qubits for every qudit in the world. That
     also results in the effects being applied to the corresponding qubits
-    instead of the original qudits.
+    instead of the original qudits. This is needed e.g. to run on
+    hardware that only supports qubits.
+
+    Setting the `live_state` option (only available with the
+    `SparseSimulator`) keeps the simulated state of the circuit between
+    calls to `peek`, so that only the operations appended since the last
+    peek need to be simulated. Undoing effects discards the kept state, and
+    the next peek then simulates the whole circuit again.
+
+    Internally, the circuit acts on "physical" qubits. When `unhook` or
+    `force_measurement` swap an object with a new ancilla, only the table
+    from the objects' qubits to the physical qubits is updated, instead of
+    rewriting the circuit. The `circuit` property shows the circuit in terms
+    of the current qubits of the objects.
+
+    The world tracks which qubits are connected by operations (their
+    entanglement components). Setting the `factor_components` option
+    simulates each component on its own, so that the cost grows with the size of the
+    largest component instead of with the number of objects, and components
+    that are not measured are not simulated at all.
     """
 
     def __init__(
         self,
         objects: Optional[List[QuantumObject]] = None,
         sampler: cirq.Sampler = SparseSimulator(),
-        compile_to_qubits: Optional[bool] = None,
+        compile_to_qubits: bool = False,
+        live_state: bool = False,
+        factor_components: bool = False,
     ):
         self.clear()
         self.sampler = sampler
         self.use_sparse = isinstance(sampler, SparseSimulator)
-        if compile_to_qubits is None:
-            compile_to_qubits = self.use_sparse
         self.compile_to_qubits = compile_to_qubits
+        if live_state and not self.use_sparse:
+            raise ValueError("The live_state option requires the SparseSimulator.")
+        self.live_state = live_state
+        self.factor_components = factor_components
 
         if isinstance(objects, QuantumObject):
             objects = [objects]
@@ -73,7 +240,12 @@ class QuantumWorld:
         This will reset the QuantumWorld to an empty state.
         """
         self.circuit = cirq.Circuit()
-        self.effect_history: List[Tuple[cirq.Circuit, Dict[QuantumObject, int]]] = []
+        # Every change to the circuit and post-selection dictionary is recorded
+        # in this append-only log, so that changes can be undone by reverting
+        # the most recent records.
+        self._log: List[_LogRecord] = []
+        # The length of the log at the start of each effect.
+        self.effect_history: List[int] = []
         # This variable is used to save the length of current effect history before each move is made,
         # so that if we later undo we know how many effects we need to pop out, since each move could
         # consist of several effects.
@@ -90,37 +262,271 @@ class QuantumWorld:
         # This variable is used to save the length of qubit_remapping_dict before each move is made,
         # so that if we later undo we know how to remap the qubits.
         self.qubit_remapping_dict_length: List[int] = []
+        # The length of the log at each snapshot.
+        self._snapshot_log_length: List[int] = []
+        # The fraction of repetitions that passed post-selection in the last
+        # peek, or None if nothing was peeked since the post-selection last
+        # changed.
+        self.post_selection_acceptance_rate: Optional[float] = None
+
+    @property
+    def circuit(self) -> cirq.Circuit:
+        """The circuit of all effects, acting on the qubits of the objects.
+
+        After qubits were swapped by `unhook` or `force_measurement`, this is
+        a new circuit built from the internal one, so changes to it are not
+        reflected in the world.
+        """
+        if not self._logical_qubits:
+            return self._circuit
+        if self._logical_circuit is None:
+            self._logical_circuit = self._circuit.transform_qubits(
+                lambda q: self._logical_qubits.get(q, q)
+            )
+        return self._logical_circuit
+
+    @circuit.setter
+    def circuit(self, circuit: cirq.Circuit) -> None:
+        self._circuit = circuit
+        # Maps the qubits of objects to the physical qubits that the circuit
+        # acts on, and back. Qubits that map to themselves are left out.
+        self._physical_qubits: Dict[cirq.Qid, cirq.Qid] = {}
+        self._logical_qubits: Dict[cirq.Qid, cirq.Qid] = {}
+        # Cache of the `circuit` property.
+        self._logical_circuit: Optional[cirq.Circuit] = None
+        self._invalidate_simulation_state()
+
+    def _physical_qubit(self, qubit: cirq.Qid) -> cirq.Qid:
+        """Returns the physical qubit that currently represents `qubit`."""
+        return self._physical_qubits.get(qubit, qubit)
+
+    def _physical_measurement_qubits(self, obj: QuantumObject) -> List[cirq.Qid]:
+        """Returns the physical qubits to measure for `obj` (big endian)."""
+        return [
+            self._physical_qubit(qubit)
+            for qubit in self.compiled_qubits.get(obj.qubit, [obj.qubit])
+        ]
+
+    def _swap_physical_qubits(
+        self, qubit_remapping_dict: Dict[cirq.Qid, cirq.Qid]
+    ) -> None:
+        """Swaps the physical qubits of the given pairs of qubits."""
+        updates = {
+            qubit: self._physical_qubit(other)
+            for qubit, other in qubit_remapping_dict.items()
+        }
+        for qubit, physical in updates.items():
+            if qubit == physical:
+                self._physical_qubits.pop(qubit, None)
+                self._logical_qubits.pop(physical, None)
+            else:
+                self._physical_qubits[qubit] = physical
+                self._logical_qubits[physical] = qubit
+        self._logical_circuit = None
+
+    def _component(self, qubit: cirq.Qid) -> cirq.Qid:
+        """Returns the representative qubit of the component of a physical qubit."""
+        if self._components_stale:
+            self._rebuild_components()
+        parent = self._component_parent
+        root = qubit
+        while root in parent:
+            root = parent[root]
+        # Compress the path, so that later lookups are fast.
+        while qubit != root:
+            parent[qubit], qubit = root, parent[qubit]
+        return root
+
+    def _simulated_component(self, qubit: cirq.Qid) -> Optional[cirq.Qid]:
+        """Returns the component that a physical qubit is simulated in.
+
+        Without `factor_components`, all qubits are simulated together in the
+        component None.
+        """
+        if not self.factor_components:
+            return None
+        return self._component(qubit)
+
+    def _object_component(self, obj: QuantumObject) -> Optional[cirq.Qid]:
+        """Returns the component that `obj` is simulated in."""
+        return self._simulated_component(self._physical_measurement_qubits(obj)[0])
+
+    def _merge_components(self, qubits: Sequence[cirq.Qid]) -> None:
+        """Merges the components of the given physical qubits."""
+        roots = list(dict.fromkeys(self._component(qubit) for qubit in qubits))
+        for root in roots[1:]:
+            self._component_parent[root] = roots[0]
+
+    def _rebuild_components(self) -> None:
+        """Recomputes the components from the circuit."""
+        # Maps qubits to their parent in a union-find forest. Qubits that are
+        # the representative of their component are left out.
+        self._component_parent: Dict[cirq.Qid, cirq.Qid] = {}
+        self._components_stale = False
+        for qubits in self.compiled_qubits.values():
+            self._merge_components([self._physical_qubit(qubit) for qubit in qubits])
+        for op in self._circuit.all_operations():
+            self._merge_components(op.qubits)
+
+    def _component_circuits(
+        self,
+        components: Optional[Sequence[Optional[cirq.Qid]]] = None,
+        circuit: Optional[cirq.Circuit] = None,
+    ) -> Dict[Optional[cirq.Qid], cirq.Circuit]:
+        """Splits the circuit into the circuits of the given components.
+
+        If `components` is None, the circuits of all components with
+        operations are returned. If `circuit` is given, it is split instead
+        of the whole circuit (see `_light_cone`).
+        """
+        if circuit is None:
+            circuit = self._circuit
+        if not self.factor_components:
+            return {None: circuit}
+        component_ops: Dict[Optional[cirq.Qid], List[cirq.Operation]] = {
+            component: [] for component in components or []
+        }
+        for op in circuit.all_operations():
+            if not op.qubits:
+                # Global phases do not affect the distribution of any component.
+                continue
+            component = self._component(op.qubits[0])
+            if components is None:
+                component_ops.setdefault(component, []).append(op)
+            elif component in component_ops:
+                component_ops[component].append(op)
+        return {
+            component: cirq.Circuit(ops) for component, ops in component_ops.items()
+        }
+
+    def _light_cone(self, objects: Sequence[QuantumObject]) -> cirq.Circuit:
+        """Returns the part of the circuit that affects the values of `objects`.
+
+        This leaves out the operations that only act on other objects after
+        their last interaction with `objects`. The result is cached until the
+        circuit changes.
+        """
+        qubits = frozenset(
+            qubit for obj in objects for qubit in self._physical_measurement_qubits(obj)
+        )
+        if qubits not in self._light_cones:
+            self._light_cones[qubits] = backward_light_cone(self._circuit, qubits)
+        return self._light_cones[qubits]
+
+    def _measured_objects(
+        self, objects: Sequence[QuantumObject]
+    ) -> List[QuantumObject]:
+        """Returns `objects` followed by the post-selected objects to measure.
+
+        With `factor_components`, post-selected objects in other components
+        than `objects` do not affect their distribution and are left out.
+        """
+        components = {self._object_component(obj) for obj in objects}
+        return list(objects) + [
+            obj
+            for obj in self.post_selection
+            if obj not in objects and self._object_component(obj) in components
+        ]
+
+    def _invalidate_simulation_state(self) -> None:
+        """Discards the simulation state kept in `live_state` mode.
+
+        This needs to be called whenever the circuit is changed in another
+        way than appending operations to it. The components are recomputed
+        from the circuit as well, since they may have been split.
+        """
+        self._simulation_states: Optional[
+            Dict[Optional[cirq.Qid], SparseSimulationState]
+        ] = None
+        # Operations appended to the circuit since `_simulation_states` was
+        # last brought up to date.
+        self._pending_ops: List[cirq.Operation] = []
+        self._components_stale = True
+        # The circuits returned by `_light_cone`, by the measured qubits.
+        self._light_cones: Dict[FrozenSet[cirq.Qid], cirq.Circuit] = {}
+
+    def _synced_simulation_states(
+        self,
+    ) -> Dict[Optional[cirq.Qid], SparseSimulationState]:
+        """Returns the simulation states of the components of the circuit.
+
+        Only the operations appended since the last call are simulated,
+        unless the kept states were invalidated in the meantime. Components
+        without operations have no state.
+        """
+        sampler = cast(SparseSimulator, self.sampler)
+        if self._simulation_states is None:
+            self._simulation_states = {
+                component: sampler.simulate_prefix(circuit)
+                for component, circuit in self._component_circuits().items()
+            }
+        elif self._pending_ops:
+            # Join the states of components that were merged since.
+            states: Dict[Optional[cirq.Qid], SparseSimulationState] = {}
+            for component, state in self._simulation_states.items():
+                component = self._simulated_component(component)
+                if component in states:
+                    state = states[component].kronecker_product(state)
+                states[component] = state
+            pending_ops: Dict[Optional[cirq.Qid], List[cirq.Operation]] = {}
+            for op in self._pending_ops:
+                if not op.qubits:
+                    continue
+                component = self._simulated_component(op.qubits[0])
+                pending_ops.setdefault(component, []).append(op)
+            for component, ops in pending_ops.items():
+                states[component] = sampler.simulate_prefix(
+                    cirq.Circuit(ops), initial_state=states.get(component)
+                )
+            self._simulation_states = states
+        self._pending_ops = []
+        return self._simulation_states
 
     def copy(self) -> "QuantumWorld":
         new_objects = []
         new_post_selection: Dict[QuantumObject, int] = {}
+        # Maps the objects of this world to their copies.
+        copies: Dict[QuantumObject, QuantumObject] = {}
         for obj in self.object_name_dict.values():
             new_obj = copy.copy(obj)
             new_objects.append(new_obj)
+            copies[obj] = new_obj
             if obj in self.post_selection:
                 new_post_selection[new_obj] = self.post_selection[obj]
         new_world = self.__class__(
             objects=new_objects,
             sampler=self.sampler,
             compile_to_qubits=self.compile_to_qubits,
+            live_state=self.live_state,
+            factor_components=self.factor_components,
         )
-        new_world.circuit = self.circuit.copy()
+        new_world._circuit = self._circuit.copy()
+        new_world._physical_qubits = self._physical_qubits.copy()
+        new_world._logical_qubits = self._logical_qubits.copy()
+        for record in self._log:
+            if isinstance(record, _Compaction):
+                # Objects dropped by `compact` are still needed to undo it.
+                for obj in record.object_name_dict.values():
+                    if obj not in copies:
+                        copies[obj] = copy.copy(obj)
+                        copies[obj].world = new_world
+        new_world._log = [_copy_log_record(record, copies) for record in self._log]
+        new_world._components_stale = True
+        if self._simulation_states is not None:
+            # The copies share their buffers until either of them changes.
+            new_world._simulation_states = {
+                component: state.copy()
+                for component, state in self._simulation_states.items()
+            }
+            new_world._pending_ops = self._pending_ops.copy()
         new_world.ancilla_names = self.ancilla_names.copy()
-        new_world.effect_history = [
-            (circuit.copy(), copy.copy(post_selection))
-            for circuit, post_selection in self.effect_history
-        ]
+        new_world.effect_history = self.effect_history.copy()
         new_world.effect_history_length = self.effect_history_length.copy()
         new_world.post_selection = new_post_selection
-        # copy qubit_remapping_dict
-        for remap in self.qubit_remapping_dict:
-            new_dict = {}
-            for key_obj, value_obj in remap.items():
-                new_dict[new_world.get_object_by_name(key_obj.name)] = (
-                    new_world.get_object_by_name(value_obj.name)
-                )
-            new_world.qubit_remapping_dict.append(new_dict)
+        # Qubits are immutable, so the remapping dictionaries can be shared.
+        new_world.qubit_remapping_dict = self.qubit_remapping_dict.copy()
         new_world.qubit_remapping_dict_length = self.qubit_remapping_dict_length.copy()
+        new_world._snapshot_log_length = self._snapshot_log_length.copy()
         return new_world
 
     def add_object(self, obj: QuantumObject):
@@ -143,6 +549,8 @@ class QuantumWorld:
                 for qubit_num in range(num_bits(qudit_dim)):
                     new_obj = self._add_ancilla(obj.qubit.name)
                     self.compiled_qubits[obj.qubit].append(new_obj.qubit)
+                # The qubits of an object are always measured together.
+                self._merge_components(self._physical_measurement_qubits(obj))
         obj.initial_effect()
 
     @property
@@ -185,9 +593,12 @@ class QuantumWorld:
         self.ancilla_names.update(other_world.ancilla_names)
         self.compiled_qubits.update(other_world.compiled_qubits)
         self.post_selection.update(other_world.post_selection)
+        self.post_selection_acceptance_rate = None
         self.circuit = self.circuit.zip(other_world.circuit)
+        self._invalidate_simulation_state()
         # Clear effect history, since undoing would undo the combined worlds
         self.effect_history.clear()
+        self._log.clear()
         # Clear the other world so that objects cannot be used from that world.
         other_world.clear()
 
@@ -205,10 +616,16 @@ class QuantumWorld:
         """
         count = 0
         ancilla_name = f"ancilla_{namespace}_{count}"
-        while ancilla_name in self.object_name_dict:
+        new_obj = QuantumObject(ancilla_name, value)
+        # The qubit of an ancilla dropped by `compact` may still be the
+        # physical qubit of another object.
+        while (
+            ancilla_name in self.object_name_dict
+            or new_obj.qubit in self._logical_qubits
+        ):
             count += 1
             ancilla_name = f"ancilla_{namespace}_{count}"
-        new_obj = QuantumObject(ancilla_name, value)
+            new_obj = QuantumObject(ancilla_name, value)
         self.add_object(new_obj)
         self.ancilla_names.add(ancilla_name)
         return new_obj
@@ -232,7 +649,25 @@ class QuantumWorld:
         if self.compile_to_qubits:
             op = self._compile_op(op)
 
-        self.circuit.append(op, strategy=strategy)
+        self._logical_circuit = None
+        self._light_cones.clear()
+        for flat_op in cirq.flatten_to_ops(op):
+            if self._physical_qubits:
+                flat_op = flat_op.transform_qubits(self._physical_qubit)
+            num_moments = len(self._circuit)
+            self._circuit.append(flat_op, strategy=strategy)
+            if len(self._circuit) > num_moments:
+                self._log.append(_AppendedOp(num_moments, flat_op, True))
+            else:
+                # The operation was added to the last moment that it operates on.
+                moment_index = self._circuit.prev_moment_operating_on(flat_op.qubits)
+                self._log.append(_AppendedOp(moment_index, flat_op, False))
+            self._merge_components(flat_op.qubits)
+            if self._simulation_states is not None:
+                # Appending in order is equivalent to the inserted positions,
+                # since `EARLIEST` never moves an operation before one on the
+                # same qubits.
+                self._pending_ops.append(flat_op)
 
     def _compile_op(self, op: cirq.Operation) -> Union[cirq.Operation, cirq.OP_TREE]:
         """Compiles the operation down to qubits, if needed."""
@@ -263,21 +698,66 @@ class QuantumWorld:
                 for qubit, value in zip(compiled_qubits, value_bits)
             ]
 
+        if op.gate is not None:
+            try:
+                return _compile_gate(op.gate).on(*compiled_qubits)
+            except TypeError:
+                # Unhashable gate.
+                pass
         # Compile the input unitary to a target qubit-based unitary.
-        compiled_unitary = qudit_to_qubit_unitary(
-            qudit_dimension=qudit_dim,
-            num_qudits=num_qudits,
-            qudit_unitary=cirq.unitary(op),
-        )
-        return cirq.MatrixGate(
-            matrix=compiled_unitary, qid_shape=(2,) * len(compiled_qubits)
-        ).on(*compiled_qubits)
+        return _qubit_gate(qudit_dim, num_qudits, cirq.unitary(op)).on(*compiled_qubits)
+
+    def _set_post_selection(self, obj: QuantumObject, value: int) -> None:
+        """Post-selects `obj` on `value`, recording the change in the log."""
+        self._log.append(_PostSelection(obj, self.post_selection.get(obj)))
+        self.post_selection[obj] = value
+        self.post_selection_acceptance_rate = None
+
+    def _remap_qubits(self, qubit_remapping_dict: Dict[cirq.Qid, cirq.Qid]) -> None:
+        """Swaps qubits in the circuit, recording the change in the log."""
+        self.qubit_remapping_dict.append(qubit_remapping_dict)
+        self._log.append(_Remap(qubit_remapping_dict))
+        self._swap_physical_qubits(qubit_remapping_dict)
+
+    def _undo_log(self, length: int) -> None:
+        """Reverts the log records beyond `length`, most recent first."""
+        if len(self._log) <= length:
+            return
+        self._logical_circuit = None
+        while len(self._log) > length:
+            record = self._log.pop()
+            if isinstance(record, _AppendedOp):
+                if record.new_moment:
+                    del self._circuit[record.moment_index]
+                else:
+                    moment = self._circuit[record.moment_index]
+                    self._circuit[record.moment_index] = (
+                        moment.without_operations_touching(record.op.qubits)
+                    )
+            elif isinstance(record, _PostSelection):
+                if record.previous is None:
+                    del self.post_selection[record.obj]
+                else:
+                    self.post_selection[record.obj] = record.previous
+                self.post_selection_acceptance_rate = None
+            elif isinstance(record, _Compaction):
+                self._circuit = record.circuit
+                self._physical_qubits = record.physical_qubits
+                self._logical_qubits = record.logical_qubits
+                self.object_name_dict = record.object_name_dict
+                self.ancilla_names = record.ancilla_names
+                self.compiled_qubits = record.compiled_qubits
+                self.post_selection = record.post_selection
+                self.post_selection_acceptance_rate = None
+            else:
+                # Remappings are swaps, so they are their own inverse.
+                self.qubit_remapping_dict.pop()
+                self._swap_physical_qubits(record.qubit_remapping_dict)
+        self._invalidate_simulation_state()
 
     def add_effect(self, op_list: List[cirq.Operation]):
         """Adds an operation to the current circuit."""
-        self.effect_history.append(
-            (self.circuit.copy(), copy.copy(self.post_selection))
-        )
+        self.effect_history.append(len(self._log))
         for op in op_list:
             self._append_op(op)
 
@@ -293,17 +773,21 @@ class QuantumWorld:
         """
         if not self.effect_history:
             raise IndexError("No effects to undo")
-        self.circuit, self.post_selection = self.effect_history.pop()
+        self._undo_log(self.effect_history.pop())
 
     def save_snapshot(self) -> None:
         """Saves the current length of the effect history and qubit_remapping_dict.
 
+        Together with them, the current length of the internal log of changes
+        is saved, so that restoring only needs to revert the later changes.
+
         Normally this could default to be called after every move made by player of your
         game, so that later if the player choose to undo his last move, we could use
         `restore_last_snapshot` to restore the quantum properties to the snapshot.
         """
         self.effect_history_length.append(len(self.effect_history))
         self.qubit_remapping_dict_length.append(len(self.qubit_remapping_dict))
+        self._snapshot_log_length.append(len(self._log))
 
     def restore_last_snapshot(self) -> None:
         """Restores the `QuantumWorld` to the last snapshot (which was saved after the last move
@@ -319,70 +803,193 @@ class QuantumWorld:
             # length == 1 corresponds to the initial state, and no more restore could be made.
             raise ValueError("Unable to restore any more.")
 
-        # Recover the mapping of qubits to the last snapshot, and remove any related post selection memory.
-        # Note that this need to be done before calling `undo_last_effect()`, otherwise the remapping does not
-        # work as expected.
+        # Revert all changes made since the last snapshot. This reverses the
+        # mapping of qubits and restores the post selection dictionary as well.
         self.qubit_remapping_dict_length.pop()
-        last_length = self.qubit_remapping_dict_length[-1]
-        while len(self.qubit_remapping_dict) > last_length:
-            qubit_remapping_dict = self.qubit_remapping_dict.pop()
-            if len(qubit_remapping_dict) == 0:
+        self.effect_history_length.pop()
+        self._snapshot_log_length.pop()
+        self._undo_log(self._snapshot_log_length[-1])
+        # Drop the effects that were started after the snapshot.
+        del self.effect_history[self.effect_history_length[-1] :]
+
+    def compact(self) -> None:
+        """Drops the history of objects that are in a known basis state.
+
+        Each entanglement component whose state, conditioned on its
+        post-selected values, is a single basis state has its operations
+        replaced by ones preparing that basis state. Its ancillas (except
+        the qubits of compiled qudits) and post-selections are dropped. As
+        `force_measurement` and `pop` add an ancilla each time, calling this
+        e.g. after every move keeps the number of qubits and operations of
+        long-running worlds bounded.
+
+        The compaction is recorded in the log of changes, so undoing the
+        current effect or restoring a snapshot also restores the state
+        before it.
+
+        Raises:
+            ValueError: if the sampler cannot provide the final state (see
+                `get_probabilities`).
+        """
+        compiled_bits = {
+            bit
+            for qudit, bits in self.compiled_qubits.items()
+            for bit in bits
+            if bit != qudit
+        }
+        component_objects: Dict[cirq.Qid, List[QuantumObject]] = {}
+        for obj in self.object_name_dict.values():
+            qubit = self._physical_measurement_qubits(obj)[0]
+            component_objects.setdefault(self._component(qubit), []).append(obj)
+        component_ops: Dict[cirq.Qid, List[cirq.Operation]] = {}
+        for op in self._circuit.all_operations():
+            if op.qubits:
+                component_ops.setdefault(self._component(op.qubits[0]), []).append(op)
+
+        compacted = set()
+        dropped: List[QuantumObject] = []
+        post_selected: List[QuantumObject] = []
+        preparations = []
+        for component, objects in component_objects.items():
+            ops = component_ops.get(component, [])
+            by_qubit = {obj.qubit: obj for obj in objects}
+            droppable = [
+                obj
+                for obj in objects
+                if obj.name in self.ancilla_names and obj.qubit not in compiled_bits
+            ]
+            # The compiled qubits of dropped qudits are dropped with them.
+            droppable.extend(
+                by_qubit[bit]
+                for obj in list(droppable)
+                for bit in self.compiled_qubits.get(obj.qubit, [])
+                if bit != obj.qubit
+            )
+            qubit_groups = [self._physical_measurement_qubits(obj) for obj in objects]
+            qubits = [qubit for group in qubit_groups for qubit in group]
+            kept_qubits = list(
+                dict.fromkeys(
+                    qubit
+                    for obj, group in zip(objects, qubit_groups)
+                    if obj not in droppable
+                    for qubit in group
+                )
+            )
+            if not (
+                droppable
+                or any(obj in self.post_selection for obj in objects)
+                or len(ops) > len(kept_qubits)
+            ):
+                # There is nothing to gain.
+                continue
+            if not set(qubits).issuperset(qubit for op in ops for qubit in op.qubits):
+                # Some qubits do not belong to objects, so their value is unknown.
+                continue
+            try:
+                values, _, probs = self._final_distribution(objects, cirq.Circuit(ops))
+            except InvalidPostSelectionError:
                 continue
-            # Reverse the mapping.
-            self.circuit = self.circuit.transform_qubits(
-                lambda q: qubit_remapping_dict.get(q, q)
+            (support,) = np.nonzero(probs > _PROBABILITY_TOLERANCE)
+            if len(support) != 1:
+                continue
+
+            compacted.add(component)
+            dropped.extend(droppable)
+            post_selected.extend(obj for obj in objects if obj in self.post_selection)
+            qubit_values = dict(zip(qubits, values[support[0]].tolist()))
+            for qubit in kept_qubits:
+                if qubit_values[qubit] == 0:
+                    continue
+                if qubit.dimension == 2:
+                    preparations.append(cirq.X(qubit))
+                else:
+                    preparations.append(
+                        QuditXGate(qubit.dimension, 0, qubit_values[qubit]).on(qubit)
+                    )
+        if not compacted:
+            return
+
+        self._log.append(
+            _Compaction(
+                circuit=self._circuit,
+                physical_qubits=self._physical_qubits.copy(),
+                logical_qubits=self._logical_qubits.copy(),
+                object_name_dict=self.object_name_dict.copy(),
+                ancilla_names=self.ancilla_names.copy(),
+                compiled_qubits=self.compiled_qubits.copy(),
+                post_selection=self.post_selection.copy(),
             )
-            # Clear relevant qubits from the post selection dictionary.
-            # TODO(): rethink if this is necessary, given that undo_last_effect()
-            # will also restore post selection dictionary.
-            for obj in qubit_remapping_dict.keys():
-                if obj in self.post_selection:
-                    self.post_selection.pop(obj)
-
-        # Recover the effects up to the last snapshot by popping effects out of the
-        # effect history of the board until its length equals the last snapshot's length.
-        self.effect_history_length.pop()
-        last_length = self.effect_history_length[-1]
-        while len(self.effect_history) > last_length:
-            self.undo_last_effect()
+        )
+        # Zero-qubit operations such as global phases are kept.
+        moments = [
+            cirq.Moment(
+                op
+                for op in moment
+                if not op.qubits or self._component(op.qubits[0]) not in compacted
+            )
+            for moment in self._circuit
+        ]
+        self._circuit = cirq.Circuit(moment for moment in moments if moment)
+        self._circuit.append(preparations)
+        for obj in dropped:
+            del self.object_name_dict[obj.name]
+            self.ancilla_names.discard(obj.name)
+            self.compiled_qubits.pop(obj.qubit, None)
+            physical = self._physical_qubits.pop(obj.qubit, obj.qubit)
+            if self._logical_qubits.get(physical) == obj.qubit:
+                del self._logical_qubits[physical]
+        for obj in post_selected:
+            del self.post_selection[obj]
+        if post_selected:
+            self.post_selection_acceptance_rate = None
+        self._logical_circuit = None
+        self._invalidate_simulation_state()
 
     def _suggest_num_reps(self, sample_size: int) -> int:
         """Guess the number of raw samples needed to get sample_size results.
-        Assume that each post-selection is about 50/50.
+        Use the acceptance rate observed in the last peek if there is one,
+        and otherwise assume that each post-selection is about 50/50.
         Noise and error mitigation will discard reps, so increase the total
         number of repetitions to compensate.
         """
         if self.use_sparse:
             return sample_size
         if len(self.post_selection) >= 1:
-            sample_size <<= len(self.post_selection) + 1
+            if self.post_selection_acceptance_rate:
+                sample_size = int(
+                    np.ceil(
+                        sample_size
+                        * (1 + _REPETITION_MARGIN)
+                        / self.post_selection_acceptance_rate
+                    )
+                )
+            else:
+                sample_size <<= len(self.post_selection) + 1
         if sample_size < 100:
             sample_size = 100
-        return sample_size
+        return min(sample_size, _MAX_REPETITIONS)
 
-    def _interpret_result(self, result: Union[int, Iterable[int]]) -> int:
-        """Canonicalize an entry from the measurement results array to int.
+    def _interpret_results(self, results: np.ndarray) -> np.ndarray:
+        """Canonicalize the measurement results array of one key to ints.
 
-        When `compile_to_qubit` is set, the results are expected to be a
-        sequence of bits that are the binary representation of the measurement
-        of the original key. Returns the `int` represented by the bits.
+        `results` has one row per repetition. When `compile_to_qubit` is set,
+        each row is expected to be the sequence of bits that are the binary
+        representation of the measurement of the original key. Otherwise
+        each row has to consist of a single value.
 
-        If the input is a single-element Iterable, returns the first element.
+        Returns:
+            An array with the `int` outcome of each repetition.
         """
         if self.compile_to_qubits:
             # For a compiled qudit, the results will be a bit array
-            # representing an integer outcome.
-            return cirq.big_endian_bits_to_int(result)
-        if isinstance(result, Iterable):
-            # If it is a single-element iterable, return the first element.
-            result_list = list(result)
-            if len(result_list) != 1:
-                raise ValueError(
-                    f"Cannot interpret a multivalued iterable {result} as a "
-                    "single result for a non-compiled world."
-                )
-            return result_list[0]
-        return result
+            # representing an integer outcome (big endian).
+            return results @ (1 << np.arange(results.shape[1] - 1, -1, -1))
+        if results.shape[1] != 1:
+            raise ValueError(
+                f"Cannot interpret multivalued results {results[0]} as a "
+                "single result for a non-compiled world."
+            )
+        return results[:, 0].astype(np.int64)
 
     def unhook(self, object: QuantumObject) -> None:
         """Replace all usages of the given `object` in the circuit with a new ancilla,
@@ -400,10 +1007,7 @@ class QuantumWorld:
             object.qubit: new_ancilla.qubit,
             new_ancilla.qubit: object.qubit,
         }
-        self.qubit_remapping_dict.append(qubit_remapping_dict)
-        self.circuit = self.circuit.transform_qubits(
-            lambda q: qubit_remapping_dict.get(q, q)
-        )
+        self._remap_qubits(qubit_remapping_dict)
         return
 
     def force_measurement(
@@ -426,12 +1030,9 @@ class QuantumWorld:
             qubit_remapping_dict.update(
                 {*zip(obj_qubits, new_obj_qubits), *zip(new_obj_qubits, obj_qubits)}
             )
-        self.qubit_remapping_dict.append(qubit_remapping_dict)
-        self.circuit = self.circuit.transform_qubits(
-            lambda q: qubit_remapping_dict.get(q, q)
-        )
+        self._remap_qubits(qubit_remapping_dict)
         post_selection = result.value if isinstance(result, enum.Enum) else result
-        self.post_selection[new_obj] = post_selection
+        self._set_post_selection(new_obj, post_selection)
         if self.use_sparse:
             self._append_op(PostSelectOperation(new_obj.qubit, post_selection))
 
@@ -440,30 +1041,30 @@ class QuantumWorld:
         objects: Optional[Sequence[Union[QuantumObject, str]]] = None,
         count: int = 1,
         convert_to_enum: bool = True,
-        _existing_list: Optional[List[List[Union[enum.Enum, int]]]] = None,
-        _num_reps: Optional[int] = None,
-    ) -> List[List[Union[enum.Enum, int]]]:
+        as_array: bool = False,
+    ) -> Union[List[List[Union[enum.Enum, int]]], np.ndarray]:
         """Measures the state of the system 'non-destructively'.
 
         This function will measure the state of each object.
         It will _not_ modify the circuit of the QuantumWorld.
 
+        If post-selection discards repetitions, more are run in batches
+        sized by the acceptance rate observed so far, until `count` results
+        are collected. The final acceptance rate is stored in
+        `post_selection_acceptance_rate`.
+
         Returns:
            A list of measurement results.  The length of the list will be
            equal to the count parameter.  Each element will be a list
            of measurement results for each object.
-        """
-        if _num_reps is None:
-            num_reps = self._suggest_num_reps(count)
-        else:
-            if _num_reps > 1e6:
-                raise RecursionError(
-                    f"Count {count} reached without sufficient results. "
-                    "Likely post-selection error"
-                )
-            num_reps = _num_reps
+           If `as_array` is set, the results are instead returned as an
+           integer array of shape `(count, len(objects))`, and
+           `convert_to_enum` is ignored.
 
-        measure_circuit = self.circuit.copy()
+        Raises:
+            RecursionError: if more than a million repetitions did not yield
+                `count` results. This is likely a post-selection error.
+        """
         if objects is None:
             quantum_objects = self.public_objects
         else:
@@ -471,46 +1072,88 @@ class QuantumWorld:
                 self[obj_or_str] if isinstance(obj_or_str, str) else obj_or_str
                 for obj_or_str in objects
             ]
-        measure_set = set(quantum_objects)
-        measure_set.update(self.post_selection.keys())
-        measure_circuit.append(
-            [
-                cirq.measure(
-                    self.compiled_qubits.get(p.qubit, p.qubit), key=p.qubit.name
+        measured = list(dict.fromkeys(self._measured_objects(quantum_objects)))
+        components: Dict[Optional[cirq.Qid], List[QuantumObject]] = {}
+        for obj in measured:
+            components.setdefault(self._object_component(obj), []).append(obj)
+        measure_circuits = {
+            component: cirq.Circuit(
+                cirq.measure(self._physical_measurement_qubits(p), key=p.qubit.name)
+                for p in component_objects
+            )
+            for component, component_objects in components.items()
+        }
+        if self.live_state:
+            states = self._synced_simulation_states()
+        else:
+            circuits = self._component_circuits(components, self._light_cone(measured))
+            for component, circuit in circuits.items():
+                measure_circuits[component] = circuit + measure_circuits[component]
+
+        num_reps = self._suggest_num_reps(count)
+        total_reps = 0
+        total_accepted = 0
+        batches = []
+        num_samples = 0
+        while True:
+            # Components are independent, so their samples can be combined.
+            measurements: Dict[str, np.ndarray] = {}
+            for component, circuit in measure_circuits.items():
+                if self.live_state:
+                    state = states.get(component)
+                    if state is None:
+                        # The component has no operations yet.
+                        state = SparseSimulationState(qubits=[])
+                    results = cast(SparseSimulator, self.sampler).run_from_state(
+                        state, circuit, repetitions=num_reps
+                    )
+                else:
+                    results = self.sampler.run(circuit, repetitions=num_reps)
+                measurements.update(results.measurements)
+
+            # Perform post-selection
+            selected = np.ones(num_reps, dtype=bool)
+            for obj, value in self.post_selection.items():
+                if obj.name in measurements:
+                    selected &= self._interpret_results(measurements[obj.name]) == value
+            (reps,) = np.nonzero(selected)
+            total_reps += num_reps
+            total_accepted += len(reps)
+            reps = reps[: count - num_samples]
+            batch = np.empty((len(reps), len(quantum_objects)), dtype=np.int64)
+            for idx, obj in enumerate(quantum_objects):
+                batch[:, idx] = self._interpret_results(measurements[obj.name][reps])
+            batches.append(batch)
+            num_samples += len(batch)
+            if num_samples >= count:
+                break
+
+            # We post-selected too much, get more reps. Only ask for the
+            # shortfall, scaled by the acceptance rate observed so far.
+            if total_reps >= _MAX_REPETITIONS:
+                self.post_selection_acceptance_rate = total_accepted / total_reps
+                raise RecursionError(
+                    f"Count {count} reached without sufficient results. "
+                    "Likely post-selection error"
                 )
-                for p in measure_set
-            ]
-        )
-        results = self.sampler.run(measure_circuit, repetitions=num_reps)
-
-        # Perform post-selection
-        rtn_list = _existing_list or []
-        for rep in range(num_reps):
-            post_selected = True
-            for obj in self.post_selection.keys():
-                result = self._interpret_result(results.measurements[obj.name][rep])
-                if result != self.post_selection[obj]:
-                    post_selected = False
-                    break
-            if post_selected:
-                rtn_list.append(
-                    [
-                        self._interpret_result(results.measurements[obj.name][rep])
-                        for obj in quantum_objects
-                    ]
+            if total_accepted:
+                num_reps = int(
+                    np.ceil(
+                        (count - num_samples)
+                        * (1 + _REPETITION_MARGIN)
+                        * total_reps
+                        / total_accepted
+                    )
                 )
-                if len(rtn_list) == count:
-                    break
-        if len(rtn_list) < count:
-            # We post-selected too much, get more reps
-            return self.peek(
-                quantum_objects,
-                count,
-                convert_to_enum,
-                rtn_list,
-                _num_reps=num_reps * 10,
-            )
-
+            else:
+                num_reps = total_reps * 10
+            num_reps = min(num_reps, _MAX_REPETITIONS - total_reps)
+        self.post_selection_acceptance_rate = total_accepted / total_reps
+
+        samples = np.concatenate(batches)
+        if as_array:
+            return samples
+        rtn_list = samples.tolist()
         if convert_to_enum:
             rtn_list = [
                 [quantum_objects[idx].enum_type(meas) for idx, meas in enumerate(res)]
@@ -524,9 +1167,7 @@ class QuantumWorld:
         objects: Optional[Sequence[Union[QuantumObject, str]]] = None,
         convert_to_enum: bool = True,
     ) -> List[Union[enum.Enum, int]]:
-        self.effect_history.append(
-            (self.circuit.copy(), copy.copy(self.post_selection))
-        )
+        self.effect_history.append(len(self._log))
         if objects is None:
             quantum_objects = self.public_objects
         else:
@@ -540,14 +1181,168 @@ class QuantumWorld:
 
         return results[0]
 
+    def _final_distribution(
+        self,
+        objects: Sequence[QuantumObject],
+        circuit: Optional[cirq.Circuit],
+        state: Optional[SparseSimulationState] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Computes the distribution of `objects` at the end of `circuit`.
+
+        The final state is read from the `SparseSimulator` (or taken from
+        `state`, if given) or from a state vector simulator such as
+        `cirq.Simulator`, and conditioned on the post-selected values of
+        `objects`.
+
+        Returns:
+            For each basis state with nonzero probability, the values of the
+            physical qubits of `objects` (one after the other), the values of
+            `objects` and the probability.
+
+        Raises:
+            ValueError: if the sampler cannot provide the final state.
+            InvalidPostSelectionError: if the post-selected values are
+                impossible.
+        """
+        qubit_groups = [self._physical_measurement_qubits(obj) for obj in objects]
+        qubits = [qubit for group in qubit_groups for qubit in group]
+        if self.use_sparse:
+            if state is None:
+                state = cast(SparseSimulator, self.sampler).simulate_prefix(circuit)
+            values, probs = state.add_qubits(qubits).probabilities(qubits)
+        elif isinstance(self.sampler, cirq.SimulatesIntermediateStateVector):
+            qubit_order = sorted(circuit.all_qubits().union(qubits))
+            result = self.sampler.simulate(circuit, qubit_order=qubit_order)
+            probs = abs(result.final_state_vector) ** 2
+            (support,) = np.nonzero(probs > _PROBABILITY_TOLERANCE)
+            digits = np.unravel_index(support, cirq.qid_shape(qubit_order))
+            values = np.stack(
+                [digits[qubit_order.index(qubit)] for qubit in qubits], axis=1
+            )
+            probs = probs[support]
+        else:
+            raise ValueError(
+                f"Exact probabilities are not supported for {type(self.sampler)}."
+            )
+
+        # Combine the values of the compiled qubits of each object (big endian).
+        object_values = np.empty((len(probs), len(objects)), dtype=np.intp)
+        column = 0
+        for idx, group in enumerate(qubit_groups):
+            weights = 2 ** np.arange(len(group) - 1, -1, -1)
+            object_values[:, idx] = values[:, column : column + len(group)] @ weights
+            column += len(group)
+
+        selected = np.ones(len(probs), dtype=bool)
+        for idx, obj in enumerate(objects):
+            if obj in self.post_selection:
+                selected &= object_values[:, idx] == self.post_selection[obj]
+        total = probs[selected].sum()
+        if total <= _PROBABILITY_TOLERANCE:
+            raise InvalidPostSelectionError("The post-selected values are impossible.")
+        return values[selected], object_values[selected], probs[selected] / total
+
+    def _exact_component_distributions(
+        self, objects: Sequence[QuantumObject]
+    ) -> List[Tuple[List[int], Dict[Tuple[int, ...], float]]]:
+        """Computes the distributions of `objects` from the amplitudes.
+
+        Instead of sampling, this reads the final state of the circuit (see
+        `_final_distribution`).
+
+        Returns:
+            A list with an element for each component of `objects` (a single
+            one without `factor_components`). Each element holds the indices
+            of the objects of the component within `objects`, and a
+            dictionary from tuples of their values to their joint
+            probability. Outcomes with zero probability are left out.
+
+        Raises:
+            ValueError: if the sampler cannot provide the final state.
+            InvalidPostSelectionError: if the post-selected values are
+                impossible.
+        """
+        measured = self._measured_objects(objects)
+        components: Dict[Optional[cirq.Qid], List[int]] = {}
+        for idx, obj in enumerate(measured):
+            components.setdefault(self._object_component(obj), []).append(idx)
+        if self.live_state:
+            states = self._synced_simulation_states()
+        else:
+            circuits = self._component_circuits(components, self._light_cone(measured))
+
+        distributions = []
+        for component, indices in components.items():
+            if self.live_state:
+                state = states.get(component, SparseSimulationState(qubits=[]))
+                circuit = None
+            else:
+                state = None
+                circuit = circuits[component]
+            _, object_values, probs = self._final_distribution(
+                [measured[idx] for idx in indices], circuit, state
+            )
+            # The post-selected objects come after `objects`.
+            num_requested = sum(idx < len(objects) for idx in indices)
+            outcomes, inverse = np.unique(
+                object_values[:, :num_requested], axis=0, return_inverse=True
+            )
+            outcome_probs = np.bincount(
+                inverse.reshape(-1), weights=probs, minlength=len(outcomes)
+            )
+            distributions.append(
+                (
+                    indices[:num_requested],
+                    {
+                        tuple(int(value) for value in outcome): float(prob)
+                        for outcome, prob in zip(outcomes, outcome_probs)
+                        if prob > _PROBABILITY_TOLERANCE
+                    },
+                )
+            )
+        return distributions
+
+    def _exact_distribution(
+        self, objects: Sequence[QuantumObject]
+    ) -> Dict[Tuple[int, ...], float]:
+        """Computes the joint distribution of `objects` from the amplitudes.
+
+        The distributions of the components are independent, so the joint
+        distribution is their product.
+
+        Returns:
+            A dictionary from tuples of the values of `objects` to their
+            probability. Outcomes with zero probability are left out.
+        """
+        order: List[int] = []
+        distribution: Dict[Tuple[int, ...], float] = {(): 1.0}
+        for indices, component in self._exact_component_distributions(objects):
+            order.extend(indices)
+            distribution = {
+                key + component_key: prob * component_prob
+                for key, prob in distribution.items()
+                for component_key, component_prob in component.items()
+            }
+        # Put the values back into the order of `objects`.
+        positions = np.argsort(order)
+        return {
+            tuple(key[position] for position in positions): prob
+            for key, prob in distribution.items()
+        }
+
     def get_histogram(
-        self, objects: Optional[Sequence[QuantumObject]] = None, count: int = 100
-    ) -> List[Dict[int, int]]:
+        self,
+        objects: Optional[Sequence[QuantumObject]] = None,
+        count: int = 100,
+        exact: bool = False,
+    ) -> List[Dict[int, Union[int, float]]]:
         """Creates histogram based on measurements (peeks) carried out.
 
         Parameters:
             objects:    List of QuantumObjects
             count:      Number of measurements
+            exact:      If True, return the expected (float) counts computed
+                        from the exact distribution instead of sampling.
 
         Returns:
             A list with one element for each object. Each element contains a dictionary with
@@ -555,18 +1350,24 @@ class QuantumWorld:
         """
         if not objects:
             objects = self.public_objects
-        peek_results = self.peek(objects=objects, convert_to_enum=False, count=count)
+        if exact:
+            return [
+                {state: prob * count for state, prob in obj_probs.items()}
+                for obj_probs in self.get_probabilities(objects=objects, exact=True)
+            ]
+        peek_results = self.peek(objects=objects, count=count, as_array=True)
         histogram = []
-        for obj in objects:
-            histogram.append({state: 0 for state in range(obj.num_states)})
-        for result in peek_results:
-            for idx in range(len(objects)):
-                histogram[idx][cast(int, result[idx])] += 1
+        for idx, obj in enumerate(objects):
+            counts = np.bincount(peek_results[:, idx], minlength=obj.num_states)
+            histogram.append(dict(enumerate(counts.tolist())))
         return histogram
 
     def get_correlated_histogram(
-        self, objects: Optional[Sequence[QuantumObject]] = None, count: int = 100
-    ) -> Dict[Tuple[int], int]:
+        self,
+        objects: Optional[Sequence[QuantumObject]] = None,
+        count: int = 100,
+        exact: bool = False,
+    ) -> Dict[Tuple[int], Union[int, float]]:
         """Creates histogram of the whole quantum world (or `objects` if specified)
         based on measurements (peeks) carried out. Comparing to get_histogram(),
         this statistics contains entanglement information accross quantum objects.
@@ -574,6 +1375,8 @@ class QuantumWorld:
         Parameters:
             objects:    List of QuantumObjects
             count:      Number of measurements
+            exact:      If True, return the expected (float) counts computed
+                        from the exact distribution instead of sampling.
 
         Returns:
             A dictionary, with the keys being tuples representing each possible state of
@@ -583,30 +1386,51 @@ class QuantumWorld:
         """
         if not objects:
             objects = self.public_objects
-        peek_results = self.peek(objects=objects, convert_to_enum=False, count=count)
-        histogram = {}
-        for result in peek_results:
-            # Convert the list to tuple so that it could be the key of a dictionary.
-            key = tuple(result)
-            if key not in histogram:
-                histogram[key] = 1
-            else:
-                histogram[key] += 1
-        return histogram
+        if exact:
+            return {
+                key: prob * count
+                for key, prob in self._exact_distribution(objects).items()
+            }
+        peek_results = self.peek(objects=objects, count=count, as_array=True)
+        states, counts = np.unique(peek_results, axis=0, return_counts=True)
+        # Convert the rows to tuples so that they could be keys of a dictionary.
+        return {
+            tuple(state.tolist()): state_count
+            for state, state_count in zip(states, counts.tolist())
+        }
 
     def get_probabilities(
-        self, objects: Optional[Sequence[QuantumObject]] = None, count: int = 100
+        self,
+        objects: Optional[Sequence[QuantumObject]] = None,
+        count: int = 100,
+        exact: bool = False,
     ) -> List[Dict[int, float]]:
         """Calculates the probabilities based on measurements (peeks) carried out.
 
         Parameters:
             objects:    List of QuantumObjects
             count:      Number of measurements
+            exact:      If True, compute the probabilities from the amplitudes
+                        instead of sampling (`count` is then ignored). This
+                        requires the `SparseSimulator` or a state vector
+                        simulator such as `cirq.Simulator`.
 
         Returns:
             A list with one element for each object. Each element contains a dictionary with
             the probability for each state of the given object.
         """
+        if exact:
+            if not objects:
+                objects = self.public_objects
+            probabilities = [
+                {state: 0.0 for state in range(obj.num_states)} for obj in objects
+            ]
+            # The marginals only need the distribution of each component.
+            for indices, distribution in self._exact_component_distributions(objects):
+                for key, prob in distribution.items():
+                    for idx, state in zip(indices, key):
+                        probabilities[idx][state] += prob
+            return probabilities
         histogram = self.get_histogram(objects=objects, count=count)
         probabilities = []
         for obj_hist in histogram:
@@ -616,7 +1440,10 @@ class QuantumWorld:
         return probabilities
 
     def get_binary_probabilities(
-        self, objects: Optional[Sequence[QuantumObject]] = None, count: int = 100
+        self,
+        objects: Optional[Sequence[QuantumObject]] = None,
+        count: int = 100,
+        exact: bool = False,
     ) -> List[float]:
         """Calculates the total probabilities for all non-zero states
         based on measurements (peeks) carried out.
@@ -624,13 +1451,15 @@ class QuantumWorld:
         Parameters:
             objects:    List of QuantumObjects
             count:      Number of measurements
+            exact:      If True, compute the probabilities from the amplitudes
+                        instead of sampling (see `get_probabilities`).
 
         Returns:
             A list with one element for each object which contains
             the probability for the event state!=0. Which is the same as
             1.0-Probability(state==0).
         """
-        full_probs = self.get_probabilities(objects=objects, count=count)
+        full_probs = self.get_probabilities(objects=objects, count=count, exact=exact)
         binary_probs = []
         for one_probs in full_probs:
             binary_probs.append(1 - one_probs[0])
@@ -22,6 +22,7 @@ import cirq
 
 import unitary.alpha as alpha
 import unitary.alpha.qudit_gates as qudit_gates
+import unitary.alpha.quantum_world as qw
 
 
 class Light(enum.Enum):
@@ -118,18 +119,11 @@ def test_two_qutrits(compile_to_qubits):
         y0 = cirq.NamedQubit("ancilla_yellow_0")
         y1 = cirq.NamedQubit("ancilla_yellow_1")
         # Flip the 0 and 2 states from identity for Green.
-        g_x02 = cirq.MatrixGate(
-            np.array(
-                [[0, 0, 1, 0], [0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 0, 1]], dtype=float
-            )
-        ).on(g0, g1)
+        g_x02 = qudit_gates.BasisPermutationGate((2, 2), [2, 1, 0, 3]).on(g0, g1)
         # Flip the 0 and 1 states from identity for Yellow.
-        y_x01 = cirq.MatrixGate(
-            np.array(
-                [[0, 1, 0, 0], [1, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]], dtype=float
-            )
-        ).on(y0, y1)
+        y_x01 = qudit_gates.BasisPermutationGate((2, 2), [1, 0, 2, 3]).on(y0, y1)
         circuit = cirq.Circuit(g_x02, y_x01)
+        assert board.circuit == circuit
         expected = str(circuit)
     else:
         expected = "green (d=3): ────X(0_2)───\n\nyellow (d=3): ───X(0_1)───"
@@ -137,12 +131,67 @@ def test_two_qutrits(compile_to_qubits):
     assert board.pop() == [StopLight.YELLOW, StopLight.GREEN]
 
 
+def test_compiled_gates_are_cached():
+    light = alpha.QuantumObject("l1", StopLight.RED)
+    light2 = alpha.QuantumObject("l2", StopLight.RED)
+    board = alpha.QuantumWorld([light, light2], compile_to_qubits=True)
+    cache_info = qw._compile_gate.cache_info()
+    alpha.Cycle()(light)
+    alpha.Cycle()(light2)
+    alpha.Cycle()(light)
+    assert qw._compile_gate.cache_info().hits >= cache_info.hits + 2
+    ops = list(board.circuit.all_operations())
+    assert ops[-1].gate is ops[-2].gate
+    assert board.peek(convert_to_enum=False) == [[2, 1]]
+
+
+@pytest.mark.parametrize(
+    ("gate", "compiled_type"),
+    [
+        (qudit_gates.QuditXGate(3, 0, 2), qudit_gates.BasisPermutationGate),
+        (qudit_gates.QuditControlledXGate(3), qudit_gates.BasisPermutationGate),
+        (cirq.MatrixGate(np.diag([1, 1j, -1]), qid_shape=(3,)), cirq.DiagonalGate),
+        (qudit_gates.QuditSwapPowGate(3, exponent=0.5), cirq.MatrixGate),
+    ],
+)
+def test_compiled_gate_structure(gate, compiled_type):
+    compiled = qw._compile_gate(gate)
+    assert isinstance(compiled, compiled_type)
+    qid_shape = cirq.qid_shape(gate)
+    assert np.allclose(
+        cirq.unitary(compiled),
+        alpha.qudit_to_qubit_unitary(qid_shape[0], len(qid_shape), cirq.unitary(gate)),
+    )
+
+
+@pytest.mark.parametrize(
+    "gate",
+    [
+        qudit_gates.QuditXGate(3, 0, 2),
+        qudit_gates.QuditControlledXGate(3),
+        qudit_gates.QuditXGate(5, 1, 4),
+        cirq.MatrixGate(np.diag(np.exp(1j * np.arange(9))), qid_shape=(3, 3)),
+    ],
+)
+def test_structured_gates_skip_dense_unitary(gate, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("built the padded unitary")
+
+    monkeypatch.setattr(qw, "qudit_to_qubit_unitary", fail)
+    qid_shape = cirq.qid_shape(gate)
+    compiled = qw._qubit_gate(qid_shape[0], len(qid_shape), cirq.unitary(gate))
+    assert np.allclose(
+        cirq.unitary(compiled),
+        alpha.qudit_to_qubit_unitary(qid_shape[0], len(qid_shape), cirq.unitary(gate)),
+    )
+
+
 @pytest.mark.parametrize(
     ("simulator", "compile_to_qubits"),
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -239,7 +288,7 @@ class QuditSplitEffect(alpha.QuantumEffect):
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -284,7 +333,7 @@ def test_pop_and_reuse(simulator, compile_to_qubits):
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -376,7 +425,7 @@ def test_copy(simulator, compile_to_qubits):
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -400,6 +449,45 @@ def test_undo_no_effects(compile_to_qubits):
         board.undo_last_effect()
 
 
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+@pytest.mark.parametrize("simulator", [cirq.Simulator, alpha.SparseSimulator])
+def test_undo_restores_circuits(simulator, compile_to_qubits):
+    lights = [alpha.QuantumObject(f"l{i}", Light.RED) for i in range(4)]
+    stop_light = alpha.QuantumObject("s", StopLight.GREEN)
+    board = alpha.QuantumWorld(
+        lights + [stop_light],
+        sampler=simulator(),
+        compile_to_qubits=compile_to_qubits,
+    )
+    effects = [
+        lambda: alpha.Superposition()(lights[0]),
+        lambda: alpha.Flip()(lights[2]),
+        lambda: alpha.Split()(lights[0], lights[1], lights[3]),
+        lambda: alpha.Cycle()(stop_light),
+        lambda: board.pop([lights[1]]),
+        lambda: alpha.Phase()(lights[3]),
+        lambda: alpha.Flip()(lights[1]),
+        lambda: board.pop([stop_light]),
+        lambda: alpha.Move()(lights[0], lights[2]),
+    ]
+    history = []
+    for effect in effects:
+        history.append(
+            (
+                len(board.effect_history),
+                board.circuit.copy(),
+                dict(board.post_selection),
+            )
+        )
+        effect()
+    for num_effects, circuit, post_selection in reversed(history):
+        # Measurements may add effects for the initial state of ancillas.
+        while len(board.effect_history) > num_effects:
+            board.undo_last_effect()
+        assert board.circuit == circuit
+        assert board.post_selection == post_selection
+
+
 @pytest.mark.parametrize("compile_to_qubits", [False, True])
 @pytest.mark.parametrize("simulator", [cirq.Simulator, alpha.SparseSimulator])
 def test_undo_post_select(simulator, compile_to_qubits):
@@ -440,7 +528,7 @@ def test_undo_post_select(simulator, compile_to_qubits):
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -515,7 +603,7 @@ def test_pop_not_enough_reps(simulator, compile_to_qubits):
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -577,7 +665,7 @@ def test_pop_qubits_twice(simulator, compile_to_qubits):
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -602,6 +690,9 @@ def test_pop_qudits_twice(simulator, compile_to_qubits):
     else:
         assert result2 == green_on_1
     assert all(peek_result == result2 for peek_result in peek_results)
+    peek_array = board.peek(count=200, as_array=True)
+    assert peek_array.shape == (200, 3)
+    assert (peek_array == [light.value for light in result2]).all()
 
 
 @pytest.mark.parametrize("compile_to_qubits", [False, True])
@@ -637,7 +728,7 @@ def test_combine_incompatibly_sparse_worlds(compile_to_qubits):
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -716,7 +807,7 @@ def test_get_histogram_and_get_probabilities_one_binary_qobject(
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -742,7 +833,7 @@ def test_get_histogram_and_get_probabilities_one_trinary_qobject(
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -775,7 +866,7 @@ def test_get_histogram_and_get_probabilities_two_qobjects(simulator, compile_to_
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -803,7 +894,7 @@ def test_get_correlated_histogram_with_entangled_qobjects(simulator, compile_to_
     [
         (cirq.Simulator, False),
         (cirq.Simulator, True),
-        # Cannot use SparseSimulator without `compile_to_qubits` due to issue #78.
+        (alpha.SparseSimulator, False),
         (alpha.SparseSimulator, True),
     ],
 )
@@ -892,3 +983,488 @@ def test_save_and_restore_snapshot(simulator, compile_to_qubits):
     # Further restore would return a value error.
     with pytest.raises(ValueError, match="Unable to restore any more."):
         world.restore_last_snapshot()
+
+
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+@pytest.mark.parametrize("simulator", [cirq.Simulator, alpha.SparseSimulator])
+def test_force_measurement_does_not_rewrite_circuit(simulator, compile_to_qubits):
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2], sampler=simulator(), compile_to_qubits=compile_to_qubits
+    )
+    alpha.Superposition()(light)
+    circuit_before_move = board.circuit.copy()
+    alpha.Move()(light, light2)
+    circuit = board.circuit.copy()
+    physical_circuit = board._circuit.copy()
+
+    board.force_measurement(light2, Light.RED)
+    ancilla = board["ancilla_l2_0"].qubit
+    swap = {light2.qubit: ancilla, ancilla: light2.qubit}
+    expected = circuit.transform_qubits(lambda q: swap.get(q, q))
+    if simulator is alpha.SparseSimulator:
+        # The post-selection is appended on the ancilla.
+        assert board._circuit[: len(physical_circuit)] == physical_circuit
+        expected.append(alpha.sparse_vector_simulator.PostSelectOperation(ancilla, 0))
+    else:
+        assert board._circuit == physical_circuit
+    assert board.circuit == expected
+
+    alpha.Flip()(light2)
+    assert board.peek([light, light2], count=20) == [[Light.RED, Light.GREEN]] * 20
+    board.undo_last_effect()
+    assert board.circuit == expected
+    # The measurement is undone together with the preceding effect.
+    board.undo_last_effect()
+    assert board.circuit == circuit_before_move
+    assert board._circuit == circuit_before_move
+
+
+def test_restore_snapshot_without_effects():
+    light1 = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    world = alpha.QuantumWorld([light1, light2])
+    alpha.Superposition()(light1)
+    world.save_snapshot()
+    circuit = world.circuit.copy()
+
+    # Measurements without any new effect are reverted as well.
+    world.force_measurement(light1, Light.GREEN)
+    world.unhook(light2)
+    world.save_snapshot()
+    assert world.qubit_remapping_dict_length == [0, 2]
+    world.restore_last_snapshot()
+    assert world.circuit == circuit
+    assert world.post_selection == {}
+    assert world.qubit_remapping_dict == []
+    results = world.peek([light1], count=100, convert_to_enum=False)
+    assert any(result[0] == 0 for result in results)
+    assert any(result[0] == 1 for result in results)
+
+
+def test_live_state_requires_sparse_simulator():
+    with pytest.raises(ValueError, match="SparseSimulator"):
+        alpha.QuantumWorld(sampler=cirq.Simulator(), live_state=True)
+
+
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+def test_live_state_only_simulates_new_ops(compile_to_qubits):
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2], compile_to_qubits=compile_to_qubits, live_state=True
+    )
+    assert board.peek() == [[Light.GREEN, Light.RED]]
+    assert not board._pending_ops
+    alpha.Flip()(light2)
+    assert len(board._pending_ops) == 1
+    assert board.peek(count=5) == [[Light.GREEN, Light.GREEN]] * 5
+    assert not board._pending_ops
+
+    alpha.Superposition()(light)
+    alpha.quantum_if(light).apply(alpha.Flip())(light2)
+    results = board.peek(count=100)
+    assert all(result[0] != result[1] for result in results)
+    assert any(result[0] == Light.RED for result in results)
+    assert any(result[0] == Light.GREEN for result in results)
+
+
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+def test_live_state_undo_and_pop(compile_to_qubits):
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2], compile_to_qubits=compile_to_qubits, live_state=True
+    )
+    alpha.Superposition()(light)
+    alpha.quantum_if(light).apply(alpha.Flip())(light2)
+    board.peek()
+    alpha.Flip()(light)
+    assert board._pending_ops
+    board.undo_last_effect()
+    assert board._simulation_states is None
+    assert not board._pending_ops
+
+    result = board.pop([light])
+    # Measurements only swap physical qubits, so the kept state stays valid.
+    assert board._simulation_states is not None
+    assert board.peek([light2], count=20) == [[result[0]]] * 20
+    alpha.Flip()(light2)
+    flipped = Light.GREEN if result[0] == Light.RED else Light.RED
+    assert board.peek([light, light2], count=20) == [[result[0], flipped]] * 20
+
+
+def test_live_state_copy_is_independent():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    board = alpha.QuantumWorld([light], live_state=True)
+    board.peek()
+    alpha.Flip()(light)
+    board2 = board.copy()
+    assert board2.live_state
+    alpha.Flip()(board2["l1"])
+    assert board.peek() == [[Light.RED]]
+    assert board2.peek() == [[Light.GREEN]]
+
+
+@pytest.mark.parametrize(
+    ("simulator", "compile_to_qubits"),
+    [
+        (cirq.Simulator, False),
+        (cirq.Simulator, True),
+        (alpha.SparseSimulator, False),
+        (alpha.SparseSimulator, True),
+    ],
+)
+def test_exact_probabilities(simulator, compile_to_qubits):
+    light = alpha.QuantumObject("l1", StopLight.YELLOW)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2, light3],
+        sampler=simulator(),
+        compile_to_qubits=compile_to_qubits,
+    )
+    alpha.Cycle()(light)
+    alpha.Superposition()(light2)
+    alpha.Superposition()(light3)
+    alpha.Phase()(light3)
+    alpha.Superposition()(light3)
+
+    probs = board.get_probabilities(exact=True)
+    assert len(probs) == 3
+    assert probs[0] == pytest.approx({0: 0.0, 1: 0.0, 2: 1.0})
+    assert probs[1] == pytest.approx({0: 0.5, 1: 0.5})
+    assert probs[2] == pytest.approx({0: 0.0, 1: 1.0})
+    assert board.get_binary_probabilities(exact=True) == pytest.approx([1.0, 0.5, 1.0])
+    histogram = board.get_histogram(count=300, exact=True)
+    assert histogram[1] == pytest.approx({0: 150.0, 1: 150.0})
+    correlated = board.get_correlated_histogram(count=300, exact=True)
+    assert correlated == pytest.approx({(2, 0, 1): 150.0, (2, 1, 1): 150.0})
+
+
+@pytest.mark.parametrize(
+    ("simulator", "compile_to_qubits"),
+    [
+        (cirq.Simulator, False),
+        (cirq.Simulator, True),
+        (alpha.SparseSimulator, False),
+        (alpha.SparseSimulator, True),
+    ],
+)
+def test_exact_probabilities_post_selection(simulator, compile_to_qubits):
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2, light3],
+        sampler=simulator(),
+        compile_to_qubits=compile_to_qubits,
+    )
+    alpha.Split()(light, light2, light3)
+    assert board.get_correlated_histogram(exact=True) == pytest.approx(
+        {(0, 1, 0): 50.0, (0, 0, 1): 50.0}
+    )
+    board.force_measurement(light2, Light.RED)
+    assert board.get_correlated_histogram(exact=True) == pytest.approx(
+        {(0, 0, 1): 100.0}
+    )
+    assert board.get_binary_probabilities(exact=True) == pytest.approx([0.0, 0.0, 1.0])
+
+
+def test_exact_probabilities_live_state():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    board = alpha.QuantumWorld([light], live_state=True)
+    assert board.get_binary_probabilities(exact=True) == [1.0]
+    alpha.Flip(effect_fraction=0.5)(light)
+    assert board.get_binary_probabilities(exact=True) == pytest.approx([0.5])
+    assert not board._pending_ops
+
+
+def test_exact_probabilities_unsupported_sampler():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    board = alpha.QuantumWorld([light], sampler=cirq.DensityMatrixSimulator())
+    with pytest.raises(ValueError, match="not supported"):
+        board.get_probabilities(exact=True)
+
+
+def test_peek_acceptance_rate():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld([light, light2], sampler=cirq.Simulator(seed=3))
+    assert board.post_selection_acceptance_rate is None
+    alpha.Superposition()(light)
+    alpha.Superposition()(light2)
+    board.peek()
+    assert board.post_selection_acceptance_rate == 1.0
+    board.force_measurement(light, Light.GREEN)
+    board.force_measurement(light2, Light.RED)
+    results = board.peek(count=1000, as_array=True)
+    assert results.shape == (1000, 2)
+    assert (results == [1, 0]).all()
+    assert board.post_selection_acceptance_rate == pytest.approx(0.25, abs=0.05)
+
+
+def test_acceptance_rate_reset_on_post_selection_change():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld([light, light2], sampler=cirq.Simulator(seed=3))
+    alpha.Superposition()(light)
+    alpha.Superposition()(light2)
+    board.peek()
+    assert board.post_selection_acceptance_rate == 1.0
+    board.force_measurement(light, Light.GREEN)
+    assert board.post_selection_acceptance_rate is None
+    assert board._suggest_num_reps(100) == 400
+
+    board.peek(count=100)
+    assert board.post_selection_acceptance_rate is not None
+    board.undo_last_effect()
+    assert board.post_selection_acceptance_rate is None
+
+    board.force_measurement(light, Light.GREEN)
+    board.peek(count=100)
+    board.compact()
+    assert board.post_selection_acceptance_rate is None
+
+
+def test_peek_impossible_post_selection():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    board = alpha.QuantumWorld([light], sampler=cirq.Simulator())
+    board.force_measurement(light, Light.RED)
+    with pytest.raises(RecursionError, match="post-selection"):
+        board.peek()
+    assert board.post_selection_acceptance_rate == 0.0
+
+
+@pytest.mark.parametrize(
+    ("simulator", "compile_to_qubits", "live_state"),
+    [
+        (cirq.Simulator, False, False),
+        (cirq.Simulator, True, False),
+        (alpha.SparseSimulator, False, False),
+        (alpha.SparseSimulator, True, False),
+        (alpha.SparseSimulator, False, True),
+        (alpha.SparseSimulator, True, True),
+    ],
+)
+def test_factor_components_matches_monolithic(simulator, compile_to_qubits, live_state):
+    distributions = []
+    for factor_components in [False, True]:
+        lights = [alpha.QuantumObject(f"l{idx}", Light.RED) for idx in range(4)]
+        stop_light = alpha.QuantumObject("s", StopLight.RED)
+        board = alpha.QuantumWorld(
+            lights + [stop_light],
+            sampler=simulator(),
+            compile_to_qubits=compile_to_qubits,
+            live_state=live_state,
+            factor_components=factor_components,
+        )
+        alpha.Superposition()(lights[0])
+        alpha.quantum_if(lights[0]).apply(alpha.Flip())(lights[1])
+        alpha.Flip(effect_fraction=0.5)(lights[2])
+        alpha.Cycle()(stop_light)
+        board.force_measurement(lights[1], Light.GREEN)
+        if factor_components:
+            components = {board._object_component(obj) for obj in board.objects}
+            assert len(components) > 2
+        assert (board.peek(count=20, as_array=True)[:, 0] == 1).all()
+        alpha.quantum_if(lights[2]).apply(alpha.Flip())(lights[3])
+        results = board.peek(count=50, as_array=True)
+        assert (results[:, 2] == results[:, 3]).all()
+        distributions.append(
+            (
+                board.get_correlated_histogram(exact=True),
+                board.get_probabilities(exact=True),
+            )
+        )
+    assert distributions[1][0] == pytest.approx(distributions[0][0])
+    assert distributions[1][1] == pytest.approx(distributions[0][1])
+    assert distributions[1][0] == pytest.approx(
+        {(1, 1, 0, 0, 1): 50.0, (1, 1, 1, 1, 1): 50.0}
+    )
+
+
+def test_factor_components_ignores_other_components():
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.GREEN)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2, light3], sampler=cirq.Simulator(), factor_components=True
+    )
+    alpha.quantum_if(light).apply(alpha.Flip())(light2)
+    assert board._object_component(light) == board._object_component(light2)
+    board.undo_last_effect()
+    assert board._object_component(light) != board._object_component(light2)
+
+    # An impossible post-selection only fails peeks of its own component.
+    board.force_measurement(light, Light.RED)
+    assert board.peek([light2, light3], count=5) == [[Light.GREEN, Light.RED]] * 5
+    assert board.post_selection_acceptance_rate == 1.0
+    with pytest.raises(RecursionError, match="post-selection"):
+        board.peek([board.objects[-1]])
+
+
+@pytest.mark.parametrize("live_state", [False, True])
+def test_factor_components_global_phase(live_state):
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2],
+        sampler=alpha.SparseSimulator(),
+        factor_components=True,
+        live_state=live_state,
+    )
+    alpha.Flip()(light2)
+    board.peek()
+    board.add_effect([cirq.global_phase_operation(1j)])
+    assert board.peek(count=5) == [[Light.GREEN, Light.GREEN]] * 5
+    assert board.get_probabilities(exact=True) == [
+        pytest.approx({0: 0.0, 1: 1.0}),
+        pytest.approx({0: 0.0, 1: 1.0}),
+    ]
+
+
+@pytest.mark.parametrize("compile_to_qubits", [False, True])
+@pytest.mark.parametrize("simulator", [cirq.Simulator, alpha.SparseSimulator])
+def test_light_cone(simulator, compile_to_qubits):
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2, light3],
+        sampler=simulator(),
+        compile_to_qubits=compile_to_qubits,
+    )
+    alpha.Superposition()(light3)
+    alpha.quantum_if(light).apply(alpha.Flip())(light2)
+    alpha.Superposition()(light3)
+
+    cone = board._light_cone([light2])
+    assert set(cone.all_qubits()) == set(
+        board._physical_measurement_qubits(light)
+        + board._physical_measurement_qubits(light2)
+    )
+    assert board._light_cone([light2]) is cone
+    assert board.peek([light2], count=5) == [[Light.GREEN]] * 5
+
+    # Later interactions pull other objects into the cone.
+    alpha.quantum_if(light3).apply(alpha.Flip())(light)
+    assert board._light_cone([light2]) is not cone
+    assert len(board._light_cone([light]).all_qubits()) == len(
+        board.circuit.all_qubits()
+    )
+
+    # Post-selections on entangled objects condition the result.
+    board.undo_last_effect()
+    alpha.Superposition()(light)
+    alpha.quantum_if(light).apply(alpha.Flip())(light2)
+    board.force_measurement(light2, Light.RED)
+    assert board.peek([light], count=10) == [[Light.GREEN]] * 10
+
+
+@pytest.mark.parametrize(
+    ("simulator", "compile_to_qubits"),
+    [
+        (cirq.Simulator, False),
+        (cirq.Simulator, True),
+        (alpha.SparseSimulator, False),
+        (alpha.SparseSimulator, True),
+    ],
+)
+def test_compact(simulator, compile_to_qubits):
+    light = alpha.QuantumObject("l1", Light.GREEN)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    light3 = alpha.QuantumObject("l3", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2, light3],
+        sampler=simulator(),
+        compile_to_qubits=compile_to_qubits,
+    )
+    num_objects = len(board.objects)
+    alpha.Flip()(light)
+    alpha.Superposition()(light2)
+    alpha.quantum_if(light2).apply(alpha.Flip())(light3)
+    board.save_snapshot()
+    alpha.Superposition()(light)
+    result = board.pop([light])
+    assert len(board.objects) > num_objects
+    assert board.post_selection
+
+    board.compact()
+    # The ancilla of the measurement is dropped, while the entangled lights
+    # are left alone.
+    assert len(board.objects) == num_objects
+    assert not board.post_selection
+    assert board.peek([light], count=10) == [[result[0]]] * 10
+    assert board.get_correlated_histogram(exact=True) == pytest.approx(
+        {(result[0].value, 0, 0): 50.0, (result[0].value, 1, 1): 50.0}
+    )
+
+    # Measuring again reuses the qubit of the dropped ancilla as needed.
+    alpha.Flip()(light)
+    board.pop([light])
+    board.compact()
+    assert len(board.objects) == num_objects
+
+    board.save_snapshot()
+    board.restore_last_snapshot()
+    assert board.post_selection == {}
+    assert board.get_probabilities([light], exact=True) == [
+        pytest.approx({0: 1.0, 1: 0.0})
+    ]
+
+
+def test_compact_undo_and_copy():
+    light = alpha.QuantumObject("l1", Light.RED)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld([light, light2], sampler=cirq.Simulator())
+    alpha.Superposition()(light)
+    alpha.Flip()(light2)
+    alpha.Flip()(light2)
+    alpha.Flip()(light2)
+    board.force_measurement(light, Light.GREEN)
+    circuit = board.circuit.copy()
+    board.add_effect([])
+    board.compact()
+    assert board.circuit == cirq.Circuit(cirq.X(light.qubit), cirq.X(light2.qubit))
+    assert [obj.name for obj in board.objects] == ["l1", "l2"]
+
+    board2 = board.copy()
+    board2.undo_last_effect()
+    assert board2.circuit == circuit
+    assert len(board2.objects) == 3
+    assert board2.post_selection == {board2.objects[2]: 1}
+    assert board.post_selection == {}
+    board.undo_last_effect()
+    assert board.circuit == circuit
+    assert board.peek(count=10) == [[Light.GREEN, Light.GREEN]] * 10
+
+
+def test_compact_global_phase():
+    light = alpha.QuantumObject("l1", Light.RED)
+    light2 = alpha.QuantumObject("l2", Light.RED)
+    board = alpha.QuantumWorld(
+        [light, light2], sampler=cirq.Simulator(), factor_components=True
+    )
+    alpha.Superposition()(light)
+    alpha.Flip()(light2)
+    alpha.Flip()(light2)
+    alpha.Flip()(light2)
+    board.add_effect([cirq.global_phase_operation(1j)])
+    board.compact()
+    assert board.circuit == cirq.Circuit(
+        cirq.H(light.qubit), cirq.global_phase_operation(1j), cirq.X(light2.qubit)
+    )
+    assert board.peek([light2], count=5) == [[Light.GREEN]] * 5
+
+
+def test_compact_keeps_superpositions():
+    light = alpha.QuantumObject("l1", Light.RED)
+    board = alpha.QuantumWorld([light])
+    alpha.Superposition()(light)
+    alpha.Superposition()(light)
+    alpha.Superposition()(light)
+    circuit = board.circuit.copy()
+    board.compact()
+    assert board.circuit == circuit
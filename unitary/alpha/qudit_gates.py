@@ -16,6 +16,34 @@ import numpy as np
 import cirq
 
 
+def _swap_slices(args: cirq.ApplyUnitaryArgs, index0: int, index1: int) -> np.ndarray:
+    """Swaps two basis states of the target qids in place."""
+    slice0 = args.subspace_index(big_endian_bits_int=index0)
+    slice1 = args.subspace_index(big_endian_bits_int=index1)
+    args.available_buffer[slice0] = args.target_tensor[slice0]
+    args.target_tensor[slice0] = args.target_tensor[slice1]
+    args.target_tensor[slice1] = args.available_buffer[slice0]
+    return args.target_tensor
+
+
+def _apply_swap_pow(
+    args: cirq.ApplyUnitaryArgs, dimension: int, coeff: complex, diag: complex
+) -> np.ndarray:
+    """Applies a (i)swap power gate given the coefficients of its unitary.
+
+    The unitary maps |xy〉to diag |xy〉+ coeff |yx〉for x != y and leaves the
+    |xx〉states alone.
+    """
+    swapped = np.swapaxes(args.target_tensor, *args.axes)
+    np.multiply(args.target_tensor, diag, out=args.available_buffer)
+    args.available_buffer += coeff * swapped
+    for x in range(dimension):
+        index = args.subspace_index(big_endian_bits_int=x * dimension + x)
+        args.available_buffer[index] = args.target_tensor[index]
+    return args.available_buffer
+
+
+@cirq.value_equality
 class QuditXGate(cirq.Gate):
     """Performs a X_ab gate.
 
@@ -42,6 +70,9 @@ class QuditXGate(cirq.Gate):
     def _qid_shape_(self):
         return (self.dimension,)
 
+    def _value_equality_values_(self):
+        return (self.dimension, self.source_state, self.destination_state)
+
     def _unitary_(self):
         arr = np.eye(self.dimension)
         if self.source_state != self.destination_state:
@@ -51,10 +82,22 @@ class QuditXGate(cirq.Gate):
             arr[self.destination_state, self.source_state] = 1
         return arr
 
+    def _has_unitary_(self):
+        return True
+
+    def _is_parameterized_(self):
+        return False
+
+    def _apply_unitary_(self, args: cirq.ApplyUnitaryArgs):
+        if self.source_state == self.destination_state:
+            return args.target_tensor
+        return _swap_slices(args, self.source_state, self.destination_state)
+
     def _circuit_diagram_info_(self, args):
         return f"X({self.source_state}_{self.destination_state})"
 
 
+@cirq.value_equality
 class QuditPlusGate(cirq.Gate):
     """Cycles all the states by `addend` using a permutation gate.
     This gate adds a number to each state. For instance,`QuditPlusGate(dimension=3, addend=1)`
@@ -68,16 +111,34 @@ class QuditPlusGate(cirq.Gate):
     def _qid_shape_(self):
         return (self.dimension,)
 
+    def _value_equality_values_(self):
+        return (self.dimension, self.addend)
+
     def _unitary_(self):
         arr = np.zeros((self.dimension, self.dimension))
         for i in range(self.dimension):
             arr[(i + self.addend) % self.dimension, i] = 1
         return arr
 
+    def _has_unitary_(self):
+        return True
+
+    def _is_parameterized_(self):
+        return False
+
+    def _apply_unitary_(self, args: cirq.ApplyUnitaryArgs):
+        for i in range(self.dimension):
+            target = (i + self.addend) % self.dimension
+            args.available_buffer[args.subspace_index(big_endian_bits_int=target)] = (
+                args.target_tensor[args.subspace_index(big_endian_bits_int=i)]
+            )
+        return args.available_buffer
+
     def _circuit_diagram_info_(self, args):
         return f"[+{self.addend}]"
 
 
+@cirq.value_equality
 class QuditControlledXGate(cirq.Gate):
     """A Qudit controlled-X gate.
 
@@ -101,6 +162,9 @@ class QuditControlledXGate(cirq.Gate):
     def _qid_shape_(self):
         return (self.dimension, self.dimension)
 
+    def _value_equality_values_(self):
+        return (self.dimension, self.control_state, self.state)
+
     def _unitary_(self):
         size = self.dimension * self.dimension
         arr = np.eye(size, dtype=np.complex64)
@@ -111,7 +175,22 @@ class QuditControlledXGate(cirq.Gate):
         arr[control_block_offset + self.state, control_block_offset] = 1
         return arr
 
+    def _has_unitary_(self):
+        return True
+
+    def _is_parameterized_(self):
+        return False
+
+    def _apply_unitary_(self, args: cirq.ApplyUnitaryArgs):
+        if self.state == 0:
+            return args.target_tensor
+        control_block_offset = self.control_state * self.dimension
+        return _swap_slices(
+            args, control_block_offset, control_block_offset + self.state
+        )
 
+
+@cirq.value_equality
 class QuditSwapPowGate(cirq.Gate):
     """Performs a swap gate between two qudits.
 
@@ -134,12 +213,33 @@ class QuditSwapPowGate(cirq.Gate):
     def _qid_shape_(self):
         return (self.dimension, self.dimension)
 
-    def _unitary_(self):
-        size = self.dimension * self.dimension
-        arr = np.zeros((size, size), dtype=np.complex64)
+    def _value_equality_values_(self):
+        return (self.dimension, self.exponent)
+
+    def _coefficients(self):
+        """Returns the amplitudes of swapping and of not swapping."""
         g = np.exp(1j * np.pi * self.exponent / 2)
         coeff = -1j * g * np.sin(np.pi * self.exponent / 2)
         diag = g * np.cos(np.pi * self.exponent / 2)
+        return coeff, diag
+
+    def _has_unitary_(self):
+        return not self._is_parameterized_()
+
+    def _is_parameterized_(self):
+        return cirq.is_parameterized(self.exponent)
+
+    def _apply_unitary_(self, args: cirq.ApplyUnitaryArgs):
+        if self._is_parameterized_():
+            return NotImplemented
+        return _apply_swap_pow(args, self.dimension, *self._coefficients())
+
+    def _unitary_(self):
+        if self._is_parameterized_():
+            return NotImplemented
+        size = self.dimension * self.dimension
+        arr = np.zeros((size, size), dtype=np.complex64)
+        coeff, diag = self._coefficients()
         for x in range(self.dimension):
             for y in range(self.dimension):
                 if x == y:
@@ -159,6 +259,7 @@ class QuditSwapPowGate(cirq.Gate):
         )
 
 
+@cirq.value_equality
 class QuditISwapPowGate(cirq.Gate):
     """Performs a swap gate between two qudits with a swap phase of i.
 
@@ -181,11 +282,32 @@ class QuditISwapPowGate(cirq.Gate):
     def _qid_shape_(self):
         return (self.dimension, self.dimension)
 
+    def _value_equality_values_(self):
+        return (self.dimension, self.exponent)
+
+    def _coefficients(self):
+        """Returns the amplitudes of swapping and of not swapping."""
+        coeff = 1j * np.sin(np.pi * self.exponent / 2)
+        diag = np.cos(np.pi * self.exponent / 2)
+        return coeff, diag
+
+    def _has_unitary_(self):
+        return not self._is_parameterized_()
+
+    def _is_parameterized_(self):
+        return cirq.is_parameterized(self.exponent)
+
+    def _apply_unitary_(self, args: cirq.ApplyUnitaryArgs):
+        if self._is_parameterized_():
+            return NotImplemented
+        return _apply_swap_pow(args, self.dimension, *self._coefficients())
+
     def _unitary_(self):
+        if self._is_parameterized_():
+            return NotImplemented
         size = self.dimension * self.dimension
         arr = np.zeros((size, size), dtype=np.complex64)
-        coeff = 1j * np.sin(np.pi * self.exponent / 2)
-        diag = np.cos(np.pi * self.exponent / 2)
+        coeff, diag = self._coefficients()
         for x in range(self.dimension):
             for y in range(self.dimension):
                 if x == y:
@@ -202,6 +324,7 @@ class QuditISwapPowGate(cirq.Gate):
         )
 
 
+@cirq.value_equality
 class QuditHadamardGate(cirq.Gate):
     """Performs a Hadamard operation on the given qudit.
     This is the equivalent of a H gate for qubits. When applied to a given pure state,
@@ -218,6 +341,9 @@ class QuditHadamardGate(cirq.Gate):
     def _qid_shape_(self):
         return (self.dimension,)
 
+    def _value_equality_values_(self):
+        return self.dimension
+
     def _unitary_(self):
         arr = (
             1.0
@@ -232,7 +358,80 @@ class QuditHadamardGate(cirq.Gate):
                 arr[i, j] *= w ** (i * j)
         return arr
 
+    def _has_unitary_(self):
+        return True
+
+    def _is_parameterized_(self):
+        return False
+
+    def _apply_unitary_(self, args: cirq.ApplyUnitaryArgs):
+        # The unitary is the inverse discrete Fourier transform, normalized.
+        args.available_buffer[...] = np.fft.ifft(
+            args.target_tensor, axis=args.axes[0], norm="ortho"
+        )
+        return args.available_buffer
+
     def _circuit_diagram_info_(self, args):
         return cirq.CircuitDiagramInfo(
             wire_symbols=("H", "H"), exponent=self._diagram_exponent(args)
         )
+
+
+@cirq.value_equality
+class BasisPermutationGate(cirq.Gate):
+    """Permutes the basis states of its qids, multiplying them by phases.
+
+    Basis state |i〉is mapped to phases[i] |permutation[i]〉, where states are
+    numbered in the big endian mixed radix order of `cirq.unitary`. Compiling
+    permutation gates such as `QuditXGate` down to qubits results in this
+    gate, which simulators apply by moving slices of the state instead of
+    multiplying it with a dense matrix.
+
+    Args:
+        qid_shape: the dimensions of the qids the gate acts on.
+        permutation: the index of the state that each basis state maps to.
+        phases: the phase of each mapped state. Defaults to all ones.
+    """
+
+    def __init__(self, qid_shape, permutation, phases=None):
+        self._qid_shape = tuple(qid_shape)
+        self.permutation = tuple(int(target) for target in permutation)
+        size = int(np.prod(self._qid_shape))
+        if sorted(self.permutation) != list(range(size)):
+            raise ValueError(f"Not a permutation of {size} states: {permutation}")
+        if phases is None:
+            phases = np.ones(size)
+        self.phases = tuple(complex(phase) for phase in phases)
+
+    def _qid_shape_(self):
+        return self._qid_shape
+
+    def _value_equality_values_(self):
+        return (self._qid_shape, self.permutation, self.phases)
+
+    def _has_unitary_(self):
+        return True
+
+    def _unitary_(self):
+        size = len(self.permutation)
+        arr = np.zeros((size, size), dtype=np.complex128)
+        arr[self.permutation, np.arange(size)] = self.phases
+        return arr
+
+    def _apply_unitary_(self, args: cirq.ApplyUnitaryArgs):
+        for source, (target, phase) in enumerate(zip(self.permutation, self.phases)):
+            source_slice = args.target_tensor[
+                args.subspace_index(big_endian_bits_int=source)
+            ]
+            target_index = args.subspace_index(big_endian_bits_int=target)
+            if phase == 1:
+                args.available_buffer[target_index] = source_slice
+            else:
+                args.available_buffer[target_index] = source_slice * phase
+        return args.available_buffer
+
+    def _circuit_diagram_info_(self, args):
+        return cirq.CircuitDiagramInfo(
+            wire_symbols=(f"Perm{list(self.permutation)}",)
+            + tuple(f"#{idx + 1}" for idx in range(1, len(self._qid_shape)))
+        )
@@ -15,6 +15,7 @@
 import pytest
 import numpy as np
 import cirq
+import sympy
 
 import unitary.alpha.qudit_gates as qudit_gates
 
@@ -337,3 +338,79 @@ def test_hadamard(d: int, q0: int):
     results = sim.run(c, repetitions=1000)
     for each_possible_outcome in range(d):
         assert np.any(results.measurements["m0"] == each_possible_outcome)
+
+
+def test_gate_equality():
+    eq = cirq.testing.EqualsTester()
+    eq.add_equality_group(qudit_gates.QuditXGate(3, 0, 1), qudit_gates.QuditXGate(3))
+    eq.add_equality_group(qudit_gates.QuditXGate(3, 0, 2))
+    eq.add_equality_group(qudit_gates.QuditXGate(4, 0, 2))
+    eq.add_equality_group(qudit_gates.QuditPlusGate(3), qudit_gates.QuditPlusGate(3, 1))
+    eq.add_equality_group(qudit_gates.QuditPlusGate(3, 2))
+    eq.add_equality_group(qudit_gates.QuditControlledXGate(3))
+    eq.add_equality_group(qudit_gates.QuditControlledXGate(3, 0, 2))
+    eq.add_equality_group(qudit_gates.QuditSwapPowGate(3))
+    eq.add_equality_group(qudit_gates.QuditSwapPowGate(3, exponent=0.5))
+    eq.add_equality_group(qudit_gates.QuditISwapPowGate(3))
+    eq.add_equality_group(qudit_gates.QuditHadamardGate(3))
+    eq.add_equality_group(qudit_gates.QuditHadamardGate(4))
+
+
+@pytest.mark.parametrize(
+    "gate",
+    [
+        qudit_gates.BasisPermutationGate((2,), [1, 0]),
+        qudit_gates.BasisPermutationGate((2, 2), [2, 1, 0, 3]),
+        qudit_gates.BasisPermutationGate((3,), [1, 2, 0], [1j, -1, 1]),
+        qudit_gates.BasisPermutationGate((2, 3), [5, 0, 1, 2, 3, 4], [-1] * 6),
+    ],
+)
+def test_basis_permutation(gate: cirq.Gate):
+    cirq.testing.assert_has_consistent_apply_unitary(gate)
+    m = cirq.unitary(gate)
+    assert np.allclose(np.eye(len(m)), m.dot(m.T.conj()))
+    for source, target in enumerate(gate.permutation):
+        assert m[target, source] == gate.phases[source]
+
+
+def test_basis_permutation_rejects_non_permutations():
+    with pytest.raises(ValueError, match="permutation"):
+        qudit_gates.BasisPermutationGate((2, 2), [0, 0, 1, 2])
+
+
+@pytest.mark.parametrize(
+    "gate",
+    [
+        qudit_gates.QuditXGate(3, 0, 0),
+        qudit_gates.QuditXGate(3, 0, 2),
+        qudit_gates.QuditXGate(4, 1, 3),
+        qudit_gates.QuditPlusGate(3, addend=1),
+        qudit_gates.QuditPlusGate(4, addend=3),
+        qudit_gates.QuditControlledXGate(3),
+        qudit_gates.QuditControlledXGate(3, 0, 2),
+        qudit_gates.QuditControlledXGate(4, 2, 0),
+        qudit_gates.QuditSwapPowGate(3),
+        qudit_gates.QuditSwapPowGate(3, exponent=0.5),
+        qudit_gates.QuditSwapPowGate(4, exponent=0.25),
+        qudit_gates.QuditISwapPowGate(3),
+        qudit_gates.QuditISwapPowGate(3, exponent=0.5),
+        qudit_gates.QuditISwapPowGate(4, exponent=-0.25),
+        qudit_gates.QuditHadamardGate(2),
+        qudit_gates.QuditHadamardGate(3),
+        qudit_gates.QuditHadamardGate(5),
+    ],
+)
+def test_apply_unitary(gate: cirq.Gate):
+    assert cirq.has_unitary(gate)
+    assert not cirq.is_parameterized(gate)
+    cirq.testing.assert_has_consistent_apply_unitary(gate, atol=1e-6)
+
+
+def test_parameterized_swaps():
+    exponent = sympy.Symbol("t")
+    for gate in [
+        qudit_gates.QuditSwapPowGate(3, exponent=exponent),
+        qudit_gates.QuditISwapPowGate(3, exponent=exponent),
+    ]:
+        assert cirq.is_parameterized(gate)
+        assert not cirq.has_unitary(gate)
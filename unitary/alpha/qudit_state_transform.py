@@ -12,8 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import itertools
-
 import numpy as np
 
 
@@ -154,11 +152,9 @@ def qudit_to_qubit_unitary(
         )
         # Initialize the result to the identity unitary in the qubit space.
         result = np.identity(dim_qubit_space, dtype=qudit_unitary.dtype)
-        # Iterate over each element in the qudit space dimension x qudit space dimension.
-        iter_range = range(qudit_dimension**num_qudits)
-        for i, j in itertools.product(iter_range, iter_range):
-            # Use the index map to populate the appropriate element in the qubit representation.
-            result[d_to_b_index_map[i]][d_to_b_index_map[j]] = qudit_unitary[i][j]
+        # Use the index map to populate the elements of the qudit space in the qubit
+        # representation, all at once.
+        result[np.ix_(d_to_b_index_map, d_to_b_index_map)] = qudit_unitary
         return result
 
     # Treat the unitary as a num_qudits^2 system's state vector and represent it using qubits (pad
@@ -16,108 +16,392 @@
 
 Just enough features to support Unitary are implemented.
 
-Supports standard unitary Cirq gates, plus a post-selection operator.
-
-Does not work with 3+-state qudits.
+Supports standard unitary Cirq gates on qubits and qudits of any
+dimension, plus a post-selection operator.
 """
+import copy
+import functools
+from typing import cast, Dict, Optional, Tuple
+
 import cirq
 import numpy as np
 
+from unitary.alpha.qudit_state_transform import num_bits
+
 
 # TODO: Is this a good number?
 _EPSILON = 1e-14
 
+# Basis states are packed into words of this many bits.
+_WORD_SIZE = 64
+_ONE = np.uint64(1)
+
+# Number of distinct gates whose classification is cached.
+_KERNEL_CACHE_SIZE = 1024
+
+
+def _unique_rows(states: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the unique rows of a packed state array and the inverse indices.
+
+    Rows are sorted in the numeric order of the basis states they represent.
+    """
+    if states.shape[1] == 1:
+        # Sorting a flat array is much faster than sorting rows.
+        unique, inverse = np.unique(states[:, 0], return_inverse=True)
+        return unique[:, np.newaxis], inverse
+    unique, inverse = np.unique(states, axis=0, return_inverse=True)
+    return unique, inverse.reshape(-1)
+
+
+class _GateKernel:
+    """Describes how a unitary acts on the basis states of its qubits.
+
+    Gates are classified once so that the simulator can use the cheapest
+    way of applying them:
+
+    * Diagonal gates (Z, S, T, CZ, ...) only multiply amplitudes.
+    * Gates with a single nonzero entry per column (X, CNOT, SWAP, ISWAP,
+      Toffoli, ...) permute basis states and multiply amplitudes.
+    * Other gates are applied as a dense matrix, but only to the basis
+      states on which the unitary is not the identity. This covers the
+      controls of controlled gates and the |00> and |11> states of the
+      SWAP and ISWAP families.
+
+    Attributes:
+        diagonal: The diagonal of the unitary if it is diagonal, else None.
+        permutation: If the unitary is a permutation with phases (and not
+            diagonal), the row of the nonzero entry of each column, else None.
+        phases: The nonzero entry of each column of a permutation.
+        active: Indices of the rows and columns that differ from the identity.
+        active_index: Maps an index to its position in `active`, or -1.
+        unitary: The unitary restricted to the `active` rows and columns.
+    """
+
+    def __init__(self, unitary: np.ndarray):
+        unitary = np.asarray(unitary, dtype=np.complex128)
+        size = len(unitary)
+        self.diagonal = None
+        self.permutation = None
+        self.phases = None
+        nonzero = abs(unitary) > _EPSILON
+        if (nonzero.sum(axis=0) == 1).all():
+            permutation = nonzero.argmax(axis=0)
+            phases = unitary[permutation, np.arange(size)]
+            if (permutation == np.arange(size)).all():
+                self.diagonal = phases
+            else:
+                self.permutation = permutation
+                self.phases = phases
+        differs = abs(unitary - np.eye(size)) > _EPSILON
+        self.active = np.nonzero(differs.any(axis=0) | differs.any(axis=1))[0]
+        self.active_index = np.full(size, -1, dtype=np.intp)
+        self.active_index[self.active] = np.arange(len(self.active))
+        self.unitary = unitary[np.ix_(self.active, self.active)]
+
+
+@functools.lru_cache(maxsize=_KERNEL_CACHE_SIZE)
+def _kernel_for_gate(gate: cirq.Gate) -> _GateKernel:
+    return _GateKernel(cirq.unitary(gate))
+
+
+def _kernel_for(action: cirq.Operation) -> _GateKernel:
+    """Returns the kernel of an operation, reusing the one of equal gates."""
+    if action.gate is not None:
+        try:
+            return _kernel_for_gate(action.gate)
+        except TypeError:
+            # Unhashable gate.
+            pass
+    return _GateKernel(cirq.unitary(action))
+
 
 class SparseSimulationState(cirq.SimulationState):
     """Implements sparse state vector evolution and sampling.
 
-    Uses object arrays to represent states so that circuits with more than 64
-    qubits work.
+    Basis states are stored packed into rows of a `uint64` array of shape
+    `(num_states, num_words)`. Each qid owns a field of just enough bits to
+    hold its value, so qubits take one bit and qutrits take two. Fields
+    never straddle a word boundary. Registers that fit into 64 bits use a
+    single word. Wider registers use several words, with the most
+    significant word first so that sorting rows keeps the numeric order of
+    the states.
+
+    Gates index the values of the qids they act on in mixed radix, as
+    `cirq.unitary` does, so qudits of any dimension are supported without
+    padding them to qubits.
     """
 
     def __init__(self, qubits):
         super().__init__(qubits=qubits, state=None)
-        self._states = np.array([0], dtype=object)
+        # Maps each qid to the index of its word counting from the least
+        # significant one, its shift within that word and its field mask.
+        self._fields: Dict[cirq.Qid, Tuple[int, np.uint64, np.uint64]] = {}
+        self._num_bits = 0
+        self._num_words = 1
+        self._allocate_fields(qubits)
+        self._states = np.zeros((1, self._num_words), dtype=np.uint64)
         self._amplitudes = np.array([1], dtype=np.complex128)
-
-    def copy(self):
-        raise NotImplementedError
+        self._shares_buffers = False
+
+    def copy(self, deep_copy_buffers: bool = True) -> "SparseSimulationState":
+        """Returns a copy of this state.
+
+        The copy shares its buffers with this state until either of them is
+        modified (copy-on-write), so copying is cheap regardless of
+        `deep_copy_buffers`.
+        """
+        new_state = copy.copy(self)
+        new_state._classical_data = self._classical_data.copy()
+        self._shares_buffers = True
+        new_state._shares_buffers = True
+        return new_state
+
+    def _own_buffers(self) -> None:
+        """Copies the buffers before modifying them in place, if shared."""
+        if self._shares_buffers:
+            self._states = self._states.copy()
+            self._amplitudes = self._amplitudes.copy()
+            self._shares_buffers = False
+
+    def add_qubits(self, qubits) -> "SparseSimulationState":
+        """Returns a copy of this state extended by `qubits` in the |0> state."""
+        new_qubits = [qubit for qubit in qubits if qubit not in self.qubit_map]
+        if not new_qubits:
+            return self
+        new_state = self.copy()
+        new_state._set_qubits(self.qubits + tuple(new_qubits))
+        new_state._fields = dict(self._fields)
+        new_state._allocate_fields(new_qubits)
+        extra_words = new_state._num_words - self._num_words
+        if extra_words:
+            # New words are more significant, so they go first.
+            new_state._states = np.concatenate(
+                (
+                    np.zeros((len(self._states), extra_words), dtype=np.uint64),
+                    self._states,
+                ),
+                axis=1,
+            )
+        return new_state
+
+    def kronecker_product(
+        self, other: "SparseSimulationState", *, inplace: bool = False
+    ) -> "SparseSimulationState":
+        """Joins this state with a state of disjoint qids.
+
+        The support of the joined state is the product of the two supports,
+        so it stays as sparse as its factors.
+        """
+        joined = self.add_qubits(other.qubits)
+        packed = np.zeros((len(other._states), joined._num_words), dtype=np.uint64)
+        for qubit in other.qubits:
+            word, shift, _ = joined._field(qubit)
+            packed[:, word] |= other._values(qubit) << shift
+        states = (joined._states[:, np.newaxis, :] | packed[np.newaxis, :, :]).reshape(
+            -1, joined._num_words
+        )
+        amplitudes = np.outer(joined._amplitudes, other._amplitudes).reshape(-1)
+        if inplace:
+            self._set_qubits(joined.qubits)
+            self._fields = joined._fields
+            self._num_bits = joined._num_bits
+            self._num_words = joined._num_words
+            joined = self
+        elif joined is self:
+            joined = self.copy()
+        joined._states = states
+        joined._amplitudes = amplitudes
+        joined._shares_buffers = False
+        return joined
+
+    def _allocate_fields(self, qubits) -> None:
+        """Assigns a bit field after the existing ones to each of `qubits`."""
+        for qubit in qubits:
+            width = num_bits(qubit.dimension)
+            if self._num_bits % _WORD_SIZE + width > _WORD_SIZE:
+                self._num_bits += _WORD_SIZE - self._num_bits % _WORD_SIZE
+            self._fields[qubit] = (
+                self._num_bits // _WORD_SIZE,
+                np.uint64(self._num_bits % _WORD_SIZE),
+                np.uint64((1 << width) - 1),
+            )
+            self._num_bits += width
+        self._num_words = max(1, -(-self._num_bits // _WORD_SIZE))
+
+    def _field(self, qubit: cirq.Qid) -> Tuple[int, np.uint64, np.uint64]:
+        """Returns the column, shift and mask of the field storing `qubit`."""
+        word, shift, field = self._fields[qubit]
+        return self._num_words - 1 - word, shift, field
+
+    def _values(self, qubit: cirq.Qid) -> np.ndarray:
+        """Returns the value of `qubit` in each basis state of the support."""
+        word, shift, field = self._field(qubit)
+        return (self._states[:, word] >> shift) & field
+
+    def _rows(self, qubits) -> np.ndarray:
+        """Returns the index of the basis state of `qubits` in each state.
+
+        The index uses the big endian mixed radix convention of
+        `cirq.unitary`.
+        """
+        rows = np.zeros(len(self._states), dtype=np.intp)
+        for qubit in qubits:
+            rows *= qubit.dimension
+            rows += self._values(qubit).astype(np.intp)
+        return rows
+
+    def _layout(self, qubits) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns how the basis states of `qubits` are packed.
+
+        Returns:
+            A `(size, num_words)` array whose row i is basis state i of
+            `qubits` packed with all other qids set to zero, and a mask of
+            the bits that do not belong to `qubits`.
+        """
+        dims = [qubit.dimension for qubit in qubits]
+        digits = np.unravel_index(np.arange(np.prod(dims, dtype=int)), dims)
+        packed = np.zeros((len(digits[0]), self._num_words), dtype=np.uint64)
+        mask = np.full(self._num_words, ~np.uint64(0), dtype=np.uint64)
+        for qubit, digit in zip(qubits, digits):
+            word, shift, field = self._field(qubit)
+            packed[:, word] |= digit.astype(np.uint64) << shift
+            mask[word] &= ~(field << shift)
+        return packed, mask
 
     def _act_on_fallback_(self, action, qubits, allow_decompose):
         if action.gate is cirq.X:
-            self._states ^= 1 << self.qubit_map[qubits[0]]
-        else:
-            # Create a matrix (partitioned_state) where each nonzero entry corresponds
-            # to an element of the sparse state vector. The row indicates the value of
-            # the qubits acted on by the unitary, the column indicates the value of the
-            # remaining qubits, and the value there is the amplitude. Multiplying by
-            # the gate unitary then gives the resulting state in the same format.
-            # After filtering small entries it is then converted back to the lists
-            # of states and amplitudes.
-            #
-            # The basic algorithm here is short and simple, but we go through a lot of
-            # contortions to optimize it by using numpy operations instead of pure
-            # Python ones (even at the cost of performing a much greater number of
-            # mathematical operations).
-
-            # The nth element of dst_rows tells which row of partitioned_state the
-            # nth element of the state vector will go to.
-            dst_rows = np.zeros(len(self._states), dtype=int)
-            # reverse_affected maps row index of partitioned_state -> state with all
-            # qubits not acted on by the unitary masked out.
-            reverse_affected = np.zeros(1, dtype=object)
-            mask = ~0
-            for dst_bit, qubit in enumerate(qubits[::-1]):
-                src_bit = self.qubit_map[qubit]
-                bit = np.array((self._states >> src_bit) & 1, dtype=int)
-                dst_rows |= bit << dst_bit
-                reverse_affected = np.concatenate(
-                    (reverse_affected, reverse_affected | 1 << src_bit)
-                )
-                mask ^= 1 << src_bit
+            self._own_buffers()
+            word, shift, _ = self._field(qubits[0])
+            self._states[:, word] ^= _ONE << shift
+            return True
+        kernel = _kernel_for(action)
+        rows = self._rows(qubits)
+        if kernel.diagonal is not None or kernel.permutation is not None:
+            self._own_buffers()
+        if kernel.diagonal is not None:
+            # Diagonal gates only change the phases of the amplitudes.
+            self._amplitudes *= kernel.diagonal[rows]
+        elif kernel.permutation is not None:
+            # Permutation gates map each basis state to exactly one other, so
+            # the support keeps its size and only the affected fields change.
+            packed, mask = self._layout(qubits)
             self._states &= mask
-            # unique_affected is the set of states after masking out the qubits acted
-            # on by the unitary.
-            # The nth element of dst_colls which column of partitioned_state the nth
-            # element of the state vector will go to.
-            unique_unaffected, dst_cols = np.unique(self._states, return_inverse=True)
-            partitioned_state = np.zeros(
-                (1 << len(qubits), len(unique_unaffected)), dtype=np.complex128
-            )
-            partitioned_state[dst_rows, dst_cols] = self._amplitudes
-            np.matmul(cirq.unitary(action), partitioned_state, out=partitioned_state)
-            nz_rows, nz_cols = np.nonzero(abs(partitioned_state) > _EPSILON)
-            self._states = reverse_affected[nz_rows] | unique_unaffected[nz_cols]
-            self._amplitudes = partitioned_state[nz_rows, nz_cols]
+            self._states |= packed[kernel.permutation[rows]]
+            self._amplitudes *= kernel.phases[rows]
+        else:
+            self._apply_dense(kernel, qubits, rows)
         return True
 
+    def _apply_dense(self, kernel: "_GateKernel", qubits, rows: np.ndarray):
+        """Applies a general unitary to the states it does not leave alone.
+
+        States whose affected qubits are outside of `kernel.active` (e.g.
+        states where the controls of a controlled gate are not satisfied)
+        are left untouched. The remaining states are evolved as follows.
+
+        Create a matrix (partitioned_state) where each nonzero entry corresponds
+        to an element of the sparse state vector. The row indicates the value of
+        the qubits acted on by the unitary, the column indicates the value of the
+        remaining qubits, and the value there is the amplitude. Multiplying by
+        the gate unitary then gives the resulting state in the same format.
+        After filtering small entries it is then converted back to the lists
+        of states and amplitudes.
+
+        The basic algorithm here is short and simple, but we go through a lot of
+        contortions to optimize it by using numpy operations instead of pure
+        Python ones (even at the cost of performing a much greater number of
+        mathematical operations).
+        """
+        # The nth element of dst_rows tells which row of partitioned_state the
+        # nth selected element of the state vector will go to.
+        dst_rows = kernel.active_index[rows]
+        selected = dst_rows >= 0
+        all_selected = selected.all()
+        if all_selected:
+            states, amplitudes = self._states, self._amplitudes
+        else:
+            states, amplitudes = self._states[selected], self._amplitudes[selected]
+            dst_rows = dst_rows[selected]
+        if len(states) == 0:
+            return
+        # reverse_affected maps row index of the full unitary -> state with all
+        # qubits not acted on by the unitary masked out.
+        reverse_affected, mask = self._layout(qubits)
+        # unique_unaffected is the set of states after masking out the qubits acted
+        # on by the unitary.
+        # The nth element of dst_cols which column of partitioned_state the nth
+        # selected element of the state vector will go to.
+        unique_unaffected, dst_cols = _unique_rows(states & mask)
+        partitioned_state = np.zeros(
+            (len(kernel.active), len(unique_unaffected)), dtype=np.complex128
+        )
+        partitioned_state[dst_rows, dst_cols] = amplitudes
+        np.matmul(kernel.unitary, partitioned_state, out=partitioned_state)
+        nz_rows, nz_cols = np.nonzero(abs(partitioned_state) > _EPSILON)
+        new_states = (
+            reverse_affected[kernel.active[nz_rows]] | unique_unaffected[nz_cols]
+        )
+        new_amplitudes = partitioned_state[nz_rows, nz_cols]
+        if all_selected:
+            self._states, self._amplitudes = new_states, new_amplitudes
+        else:
+            self._states = np.concatenate((self._states[~selected], new_states))
+            self._amplitudes = np.concatenate(
+                (self._amplitudes[~selected], new_amplitudes)
+            )
+        self._shares_buffers = False
+
     def _perform_measurement(self, qubits):
         raise NotImplementedError
 
-    # abstract method of OperationTarget
-    def sample(self, qubits, repetitions, prng):
+    def _probabilities(self) -> np.ndarray:
+        """Returns the probabilities of the basis states in the support."""
         probs = abs(self._amplitudes) ** 2
-        samples = prng.choice(self._states, size=repetitions, p=probs)
+        # Gates with single precision unitaries (e.g. the qudit gates) let the
+        # norm drift slightly.
+        probs /= probs.sum()
+        return probs
+
+    def probabilities(self, qubits) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the exact outcome distribution of measuring `qubits`.
+
+        Returns:
+            A `(n, len(qubits))` array with the values of `qubits` in each of
+            the n basis states of the support, and an array with the
+            probabilities of these basis states. Rows are not merged, so the
+            same values may occur in several rows.
+        """
+        values = np.empty((len(self._states), len(qubits)), dtype=np.intp)
+        for j, q in enumerate(qubits):
+            values[:, j] = self._values(q)
+        return values, self._probabilities()
+
+    # abstract method of OperationTarget
+    def sample(self, qubits, repetitions=1, prng=None):
+        prng = cirq.value.parse_random_state(prng)
+        probs = self._probabilities()
+        # Choosing indices draws the same random numbers as choosing the states
+        # themselves would, so results only depend on the seed.
+        samples = prng.choice(len(self._states), size=repetitions, p=probs)
         out = np.empty((repetitions, len(qubits)), dtype=np.uint8)
         for j, q in enumerate(qubits):
-            out[:, j] = (samples >> self.qubit_map[q]) & 1
+            out[:, j] = self._values(q)[samples]
         return out
 
     def post_select(self, qubit, value):
-        assert value in (0, 1)
-        mask = 1 << self.qubit_map[qubit]
-        value *= mask
-        (nonzero_indices,) = np.nonzero(self._states & mask == value)
+        assert 0 <= value < qubit.dimension
+        (nonzero_indices,) = np.nonzero(self._values(qubit) == value)
         if len(nonzero_indices) == 0:
             raise InvalidPostSelectionError(f"No states where {qubit} equals {value}")
         self._states = self._states[nonzero_indices]
         self._amplitudes = self._amplitudes[nonzero_indices]
         self._amplitudes /= np.linalg.norm(self._amplitudes)
+        self._shares_buffers = False
 
 
 class SparseSimulator(cirq.SimulatesIntermediateStateVector):
-    def __init__(self):
-        super().__init__(split_untangled_states=False)
+    def __init__(self, seed: cirq.RANDOM_STATE_OR_SEED_LIKE = None):
+        super().__init__(seed=seed, split_untangled_states=False)
 
     # override
     def _can_be_in_run_prefix(self, val):
@@ -136,10 +420,73 @@ class SparseSimulator(cirq.SimulatesIntermediateStateVector):
     def _create_step_result(self, sim_state):
         return SparseSimulatorStep(sim_state=sim_state)
 
-
+    def simulate_prefix(
+        self,
+        program: cirq.AbstractCircuit,
+        initial_state: Optional[SparseSimulationState] = None,
+    ) -> SparseSimulationState:
+        """Simulates `program` and returns the resulting state.
+
+        The returned state can be passed back as `initial_state`, or to
+        `run_from_state`, in order to continue the simulation from there,
+        e.g. to try several different continuations of the same prefix
+        without simulating the prefix again. `initial_state` itself is not
+        modified. Qids that are not yet part of it start in the |0> state.
+
+        Measurements in `program` are ignored.
+        """
+        qubits = cirq.QubitOrder.DEFAULT.order_for(program.all_qubits())
+        if initial_state is None:
+            state = SparseSimulationState(qubits=qubits)
+        else:
+            state = initial_state.add_qubits(qubits)
+            if state is initial_state:
+                state = initial_state.copy()
+        for op in program.all_operations():
+            if not cirq.is_measurement(op):
+                cirq.act_on(op, state)
+        return state
+
+    def run_from_state(
+        self,
+        state: SparseSimulationState,
+        program: cirq.AbstractCircuit,
+        repetitions: int = 1,
+    ) -> cirq.Result:
+        """Samples `program` as if it was appended to the simulated `state`.
+
+        `state` is not modified, so it can be reused for other programs.
+
+        Raises:
+            ValueError: if `program` has non-terminal measurements.
+        """
+        if not program.are_all_measurements_terminal():
+            raise ValueError("All measurements must be terminal.")
+        final_state = self.simulate_prefix(program, initial_state=state)
+        measurement_ops = [
+            op for op in program.all_operations() if cirq.is_measurement(op)
+        ]
+        measured_qubits = [qubit for op in measurement_ops for qubit in op.qubits]
+        samples = final_state.sample(measured_qubits, repetitions, self._prng)
+        measurements = {}
+        column = 0
+        for op in measurement_ops:
+            num_qubits = len(op.qubits)
+            values = samples[:, column : column + num_qubits]
+            gate = cast(cirq.MeasurementGate, op.gate)
+            # As in Cirq, only the values 0 and 1 are inverted.
+            invert_mask = np.array(gate.full_invert_mask(), dtype=bool)
+            measurements[gate.key] = values ^ (invert_mask & (values < 2))
+            column += num_qubits
+        return cirq.ResultDict(params=cirq.ParamResolver(), measurements=measurements)
+
+
+@cirq.value_equality
 class PostSelectOperation(cirq.Operation):
     """Prunes states where self.qubit is not equal to self.value from the state vector.
 
+    The qubit may also be a qudit, in which case value can be any of its states.
+
     Must be used with SparseSimulator as the sampler.
     """
 
@@ -159,6 +506,9 @@ class PostSelectOperation(cirq.Operation):
     def with_qubits(self, new_qubit):
         return PostSelectOperation(new_qubit, self.value)
 
+    def _value_equality_values_(self):
+        return self.qubit, self.value
+
 
 class InvalidPostSelectionError(Exception):
     """When a qubit state with zero amplitude is post-selected for."""
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import numpy as np
 import pytest
 
 import cirq
@@ -22,6 +23,7 @@ from unitary.alpha.sparse_vector_simulator import (
     SparseSimulator,
     PostSelectOperation,
     InvalidPostSelectionError,
+    _GateKernel,
 )
 
 
@@ -56,15 +58,52 @@ def test_simulation_fidelity():
         assert abs(test_ones_fraction - validation_ones_fraction) < 0.1
 
 
-def test_simulation_fidelity_qudits_fails():
-    """Check that SparseSimulator does not support Qudit operations yet.
+def test_simulation_fidelity_qudits():
+    """Check that qudit simulation results are roughly the same as a Cirq simulator."""
+    qutrits = [cirq.NamedQid(f"t{i}", 3) for i in range(4)]
+    ququart = cirq.NamedQid("q", 4)
+    qubit = cirq.NamedQubit("b")
+    circuit = cirq.Circuit(
+        qudit_gates.QuditHadamardGate(3).on(qutrits[0]),
+        qudit_gates.QuditXGate(3, 0, 2).on(qutrits[1]),
+        qudit_gates.QuditSwapPowGate(3, 0.5).on(qutrits[0], qutrits[1]),
+        qudit_gates.QuditISwapPowGate(3, 0.5).on(qutrits[1], qutrits[2]),
+        qudit_gates.QuditControlledXGate(3, 2, 1).on(qutrits[2], qutrits[3]),
+        qudit_gates.QuditPlusGate(4, 3).on(ququart),
+        qudit_gates.QuditHadamardGate(4).on(ququart),
+        cirq.H(qubit),
+        qudit_gates.QuditPlusGate(3).on(qutrits[3]).controlled_by(qubit),
+        cirq.MatrixGate(
+            cirq.testing.random_unitary(12, random_state=1), qid_shape=(3, 4)
+        ).on(qutrits[0], ququart),
+    )
+    circuit.append(cirq.measure(q, key=q.name) for q in circuit.all_qubits())
+    test_sim = SparseSimulator()
+    validation_sim = cirq.Simulator()
+    repetitions = 10000
+    test_data = test_sim.run(circuit, repetitions=repetitions).measurements
+    validation_data = validation_sim.run(circuit, repetitions=repetitions).measurements
+    for q in circuit.all_qubits():
+        for value in range(q.dimension):
+            test_fraction = (test_data[q.name] == value).sum() / repetitions
+            validation_fraction = (validation_data[q.name] == value).sum() / repetitions
+            assert abs(test_fraction - validation_fraction) < 0.05
 
-    TODO(#78): Fix this.
-    """
-    qudit = cirq.NamedQid("a", 3)
-    circuit = cirq.Circuit(qudit_gates.QuditXGate(3).on(qudit), cirq.measure(qudit))
-    with pytest.raises(ValueError, match="size 2 is different from 3"):
-        _ = SparseSimulator().run(circuit).measurements
+
+def test_qudit_fields_across_words():
+    """Qudits must not straddle the boundary between two words."""
+    qutrits = [cirq.NamedQid(f"t{i:02}", 3) for i in range(40)]
+    circuit = cirq.Circuit(
+        qudit_gates.QuditPlusGate(3, 2).on(qutrits[31]),
+        qudit_gates.QuditPlusGate(3, 1).on(qutrits[32]),
+        qudit_gates.QuditSwapPowGate(3).on(qutrits[32], qutrits[39]),
+        cirq.measure(*qutrits, key="m"),
+    )
+    results = SparseSimulator().run(circuit, repetitions=10).measurements["m"]
+    expected = [0] * 40
+    expected[31] = 2
+    expected[39] = 1
+    assert all(list(row) == expected for row in results)
 
 
 def test_post_selection():
@@ -92,6 +131,23 @@ def test_post_selection():
     assert 0.23 < sum((data.c1 == 0) & (data.c2 == 0)) / repetitions < 0.43
 
 
+def test_qudit_post_selection():
+    """Test PostSelectOperation on a qutrit."""
+    sim = SparseSimulator()
+    control = cirq.NamedQid("c", 3)
+    target = cirq.NamedQid("t", 3)
+    circuit = cirq.Circuit(
+        qudit_gates.QuditHadamardGate(3).on(control),
+        qudit_gates.QuditControlledXGate(3, 2, 2).on(control, target),
+        PostSelectOperation(target, 2),
+        cirq.measure(control, key="c"),
+        cirq.measure(target, key="t"),
+    )
+    data = sim.run(circuit, repetitions=100).data
+    assert all(data.c == 2)
+    assert all(data.t == 2)
+
+
 def test_impossible_post_selection():
     """Test post-selecting for a state with zero amplitude."""
     sim = SparseSimulator()
@@ -99,3 +155,212 @@ def test_impossible_post_selection():
     circuit = cirq.Circuit(PostSelectOperation(qubit, 1), cirq.measure(qubit))
     with pytest.raises(InvalidPostSelectionError):
         sim.run(circuit, repetitions=100)
+
+
+def test_more_than_64_qubits():
+    """Check that registers wider than a single word are simulated correctly."""
+    qubits = cirq.LineQubit.range(130)
+    circuit = cirq.Circuit(
+        cirq.X(qubits[1]),
+        cirq.H(qubits[70]),
+        cirq.CNOT(qubits[70], qubits[129]),
+        cirq.SWAP(qubits[1], qubits[100]),
+        cirq.measure(*qubits, key="m"),
+    )
+    results = SparseSimulator().run(circuit, repetitions=100).measurements["m"]
+    assert all(row[100] == 1 and row[1] == 0 for row in results)
+    assert all(row[70] == row[129] for row in results)
+    assert 0 < results[:, 70].sum() < 100
+    assert results.sum() == 100 + 2 * results[:, 70].sum()
+
+
+def test_multi_word_sampling_matches_single_word():
+    """Idle qubits that widen the register must not change sampled results."""
+    circuit = random_circuit(
+        qubits=8,
+        n_moments=10,
+        op_density=0.5,
+        gate_domain={cirq.H: 1, cirq.T: 1, cirq.CNOT: 2, cirq.ISWAP**0.5: 2},
+        random_state=1234,
+    )
+    circuit.append(cirq.measure(q) for q in circuit.all_qubits())
+    wide_circuit = circuit + cirq.Circuit(
+        cirq.I(cirq.NamedQubit(f"z{i}")) for i in range(100)
+    )
+    narrow = SparseSimulator(seed=5).run(circuit, repetitions=100).measurements
+    wide = SparseSimulator(seed=5).run(wide_circuit, repetitions=100).measurements
+    for key, value in narrow.items():
+        assert (value == wide[key]).all()
+
+
+@pytest.mark.parametrize(
+    ("gate", "kind"),
+    [
+        (cirq.Z, "diagonal"),
+        (cirq.T, "diagonal"),
+        (cirq.CZ, "diagonal"),
+        (cirq.CNOT, "permutation"),
+        (cirq.SWAP, "permutation"),
+        (cirq.ISWAP, "permutation"),
+        (cirq.TOFFOLI, "permutation"),
+        (cirq.X.controlled(2, control_values=[0, 1]), "permutation"),
+        (qudit_gates.QuditXGate(3, 0, 2), "permutation"),
+        (cirq.H, "dense"),
+        (cirq.ISWAP**0.5, "dense"),
+        ((cirq.SWAP**0.5).controlled(), "dense"),
+    ],
+)
+def test_gate_kernel_classification(gate, kind):
+    kernel = _GateKernel(cirq.unitary(gate))
+    assert (kernel.diagonal is not None) == (kind == "diagonal")
+    assert (kernel.permutation is not None) == (kind == "permutation")
+
+
+def test_gate_kernel_active_subspace():
+    # Controlled sqrt-iSWAP only mixes |101> and |110>.
+    kernel = _GateKernel(cirq.unitary((cirq.ISWAP**0.5).controlled()))
+    assert list(kernel.active) == [5, 6]
+    assert kernel.unitary.shape == (2, 2)
+
+
+def test_fast_paths_fidelity():
+    """Check that gates with fast paths give the same results as a Cirq simulator."""
+    circuit = random_circuit(
+        qubits=8,
+        n_moments=20,
+        op_density=0.5,
+        gate_domain={
+            cirq.H: 1,
+            cirq.S: 1,
+            cirq.T: 1,
+            cirq.CZ: 2,
+            cirq.CNOT: 2,
+            cirq.SWAP: 2,
+            cirq.ISWAP: 2,
+            cirq.ISWAP**0.5: 2,
+            cirq.TOFFOLI: 3,
+            cirq.X.controlled(2, control_values=[0, 1]): 3,
+            (cirq.ISWAP**0.5).controlled(): 3,
+        },
+        random_state=4321,
+    )
+    qubits = sorted(circuit.all_qubits())
+    circuit.append(cirq.H.on_each(*qubits))
+    circuit.append(cirq.measure(q) for q in qubits)
+    repetitions = 10000
+    test_data = SparseSimulator().run(circuit, repetitions=repetitions).measurements
+    validation_data = (
+        cirq.Simulator().run(circuit, repetitions=repetitions).measurements
+    )
+    for q in qubits:
+        test_ones_fraction = test_data[q.name].sum() / repetitions
+        validation_ones_fraction = validation_data[q.name].sum() / repetitions
+        assert abs(test_ones_fraction - validation_ones_fraction) < 0.05
+
+
+def test_copy_is_independent():
+    a, b = cirq.LineQubit.range(2)
+    sim = SparseSimulator()
+    state = sim.simulate_prefix(cirq.Circuit(cirq.H(a), cirq.CNOT(a, b)))
+    copied = state.copy()
+    cirq.act_on(cirq.X(a), copied)
+    cirq.act_on(cirq.Z(b), copied)
+    cirq.act_on(PostSelectOperation(b, 1), state)
+    assert (state.sample([a, b], 10, np.random) == 1).all()
+    samples = copied.sample([a, b], 100, np.random)
+    assert (samples[:, 0] != samples[:, 1]).all()
+    assert 0 < samples[:, 0].sum() < 100
+
+
+def test_simulate_prefix_and_branch():
+    a, b, c = cirq.LineQubit.range(3)
+    sim = SparseSimulator()
+    prefix = sim.simulate_prefix(cirq.Circuit(cirq.X(a)))
+    moved = sim.run_from_state(
+        prefix,
+        cirq.Circuit(cirq.SWAP(a, b), cirq.measure(a, b, key="m")),
+        repetitions=10,
+    )
+    assert (moved.measurements["m"] == [0, 1]).all()
+    # Qubits that the prefix did not touch are added in the |0> state, and
+    # the prefix itself is unchanged.
+    split = sim.run_from_state(
+        prefix,
+        cirq.Circuit(
+            cirq.SWAP(a, c) ** 0.5,
+            cirq.measure(a, c, key="m"),
+            cirq.measure(b, key="b", invert_mask=(True,)),
+        ),
+        repetitions=100,
+    )
+    assert (split.measurements["m"].sum(axis=1) == 1).all()
+    assert 0 < split.measurements["m"][:, 0].sum() < 100
+    assert (split.measurements["b"] == 1).all()
+    unchanged = sim.run_from_state(
+        prefix, cirq.Circuit(cirq.measure(a, key="a")), repetitions=10
+    )
+    assert (unchanged.measurements["a"] == 1).all()
+
+
+def test_simulate_prefix_widens_register():
+    qubits = cirq.LineQubit.range(100)
+    sim = SparseSimulator()
+    state = sim.simulate_prefix(cirq.Circuit(cirq.H(qubits[0])))
+    state = sim.simulate_prefix(
+        cirq.Circuit(cirq.CNOT(qubits[0], qubits[99])), initial_state=state
+    )
+    result = sim.run_from_state(
+        state, cirq.Circuit(cirq.measure(qubits[0], qubits[99], key="m"))
+    )
+    assert result.measurements["m"][0, 0] == result.measurements["m"][0, 1]
+
+
+def test_run_from_state_rejects_intermediate_measurements():
+    q = cirq.LineQubit(0)
+    sim = SparseSimulator()
+    state = sim.simulate_prefix(cirq.Circuit())
+    with pytest.raises(ValueError, match="terminal"):
+        sim.run_from_state(state, cirq.Circuit(cirq.measure(q), cirq.X(q)))
+
+
+def test_simulate_moment_steps():
+    q = cirq.LineQubit(0)
+    circuit = cirq.Circuit(cirq.X(q), cirq.H(q))
+    samples = [
+        step.sample([q], repetitions=100)
+        for step in SparseSimulator().simulate_moment_steps(circuit)
+    ]
+    assert len(samples) == 2
+    assert (samples[0] == 1).all()
+    assert 0 < samples[1].sum() < 100
+
+
+def test_post_select_equality():
+    q0, q1 = cirq.LineQubit.range(2)
+    assert PostSelectOperation(q0, 1) == PostSelectOperation(q0, 1)
+    assert PostSelectOperation(q0, 1) != PostSelectOperation(q0, 0)
+    assert PostSelectOperation(q0, 1).with_qubits(q1) == PostSelectOperation(q1, 1)
+
+
+@pytest.mark.parametrize("inplace", [False, True])
+def test_kronecker_product(inplace):
+    qubits = cirq.LineQubit.range(70)
+    qutrit = cirq.NamedQid("t", dimension=3)
+    sim = SparseSimulator()
+    left = sim.simulate_prefix(
+        cirq.Circuit(cirq.H(qubits[0]), cirq.CNOT(qubits[0], qubits[69]))
+    )
+    right = sim.simulate_prefix(
+        cirq.Circuit(qudit_gates.QuditPlusGate(3).on(qutrit), cirq.H(qubits[1]))
+    )
+    joined = left.kronecker_product(right, inplace=inplace)
+    assert (joined is left) == inplace
+    values, probs = joined.probabilities([qubits[0], qubits[69], qutrit, qubits[1]])
+    assert sorted(zip(map(tuple, values.tolist()), probs)) == [
+        ((0, 0, 1, 0), pytest.approx(0.25)),
+        ((0, 0, 1, 1), pytest.approx(0.25)),
+        ((1, 1, 1, 0), pytest.approx(0.25)),
+        ((1, 1, 1, 1), pytest.approx(0.25)),
+    ]
+    # The factors are not modified.
+    assert right.probabilities([qubits[1]])[0].tolist() == [[0], [1]]
@@ -0,0 +1,47 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Iterable
+
+import cirq
+
+
+def backward_light_cone(
+    circuit: cirq.Circuit, qubits: Iterable[cirq.Qid]
+) -> cirq.Circuit:
+    """Returns the operations of `circuit` that can affect `qubits` at its end.
+
+    Going back from the end, a unitary operation is kept if it acts on one
+    of `qubits` or on a qubit of a kept later operation.  Other operations,
+    such as measurements, post-selections, resets, noise channels and
+    classically controlled operations, are always kept together with the
+    history of their qubits, since they may condition the whole state.
+    """
+    cone = set(qubits)
+    moments = []
+    for moment in reversed(circuit):
+        ops = [
+            op
+            for op in moment
+            if not cone.isdisjoint(op.qubits)
+            or cirq.is_measurement(op)
+            or cirq.control_keys(op)
+            or not cirq.has_unitary(op)
+        ]
+        # Operations in a moment act on different qubits.
+        for op in ops:
+            cone.update(op.qubits)
+        if ops:
+            moments.append(cirq.Moment(ops))
+    return cirq.Circuit(reversed(moments))
@@ -0,0 +1,41 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cirq
+
+from unitary.alpha.sparse_vector_simulator import PostSelectOperation
+from unitary.circuit_utils import backward_light_cone
+
+
+def test_backward_light_cone():
+    a, b, c = cirq.LineQubit.range(3)
+    circuit = cirq.Circuit(cirq.X(a), cirq.X(c), cirq.CNOT(a, b), cirq.X(a))
+    assert backward_light_cone(circuit, [b]) == cirq.Circuit(cirq.X(a), cirq.CNOT(a, b))
+    assert backward_light_cone(circuit, [c]) == cirq.Circuit(cirq.X(c))
+    assert backward_light_cone(circuit, []) == cirq.Circuit()
+
+
+def test_backward_light_cone_keeps_non_unitary_operations():
+    a, b, c, d = cirq.LineQubit.range(4)
+    circuit = cirq.Circuit(
+        cirq.H(a),
+        cirq.H(b),
+        cirq.H(c),
+        cirq.H(d),
+        PostSelectOperation(a, 1),
+        cirq.measure(b, key="m"),
+        cirq.X(c).with_classical_controls("m"),
+        cirq.depolarize(0.1).on(d),
+    )
+    assert backward_light_cone(circuit, []) == circuit
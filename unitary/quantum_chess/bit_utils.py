@@ -17,6 +17,7 @@ Utilities for converting to and from bit boards.
 from typing import List
 
 import cirq
+import numpy as np
 
 import unitary.quantum_chess.move as move
 
@@ -46,6 +47,12 @@ def num_ones(n: int) -> int:
     return count
 
 
+def num_ones_array(bit_boards: np.ndarray) -> np.ndarray:
+    """Number of ones in each entry of an array of 64-bit bitstrings."""
+    as_bytes = np.ascontiguousarray(bit_boards, dtype=np.uint64).view(np.uint8)
+    return np.unpackbits(as_bytes.reshape(-1, 8), axis=1).sum(axis=1)
+
+
 def bit_ones(n: int) -> List[int]:
     """Indices of ones in the binary representation of n."""
     indices = []
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import cirq
+import numpy as np
 
 import unitary.quantum_chess.bit_utils as u
 
@@ -45,6 +46,12 @@ def test_num_ones():
     assert u.num_ones(int("0111111", 2)) == 6
 
 
+def test_num_ones_array():
+    bit_boards = np.array([int("1000101", 2), 0, 2**64 - 1, 1 << 63], dtype=np.uint64)
+    assert u.num_ones_array(bit_boards).tolist() == [3, 0, 64, 1]
+    assert u.num_ones_array(np.array([], dtype=np.uint64)).tolist() == []
+
+
 def test_bit_ones():
     assert u.bit_ones(int("1000101", 2)) == [0, 2, 6]
     assert u.bit_ones(int("0000000", 2)) == []
@@ -12,20 +12,226 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import abc
+import collections.abc
+import enum
+import json
+import os
+import sqlite3
 from dataclasses import dataclass
-from typing import Tuple
+from typing import Dict, Iterator, Optional, Tuple
 import unitary.quantum_chess.enums as enums
 import unitary.quantum_chess.move as move
 
 
+class Occupancy(enum.Enum):
+    """Whether a square is known to be empty or full, or is in superposition."""
+
+    EMPTY = 0
+    FULL = 1
+    QUANTUM = 2
+
+
 @dataclass(frozen=True, eq=True)
 class CacheKey:
+    """Identifies the effect of a move on the probabilities of its squares.
+
+    Args:
+        move_type: type of the move
+        repetitions: number of samples used to compute the probabilities
+        move_variant: variant of the move
+        squares: occupancy of the source(s) and target(s) of the move, in the
+            order source, source2, target, target2 (leaving out absent ones)
+        paths: occupancy of the squares along each path of a sliding move
+        sampler: description of the sampler (and its settings) used to
+            compute the probabilities
+    """
+
     move_type: enums.MoveType
     repetitions: int
+    move_variant: Optional[enums.MoveVariant] = None
+    squares: Tuple[Occupancy, ...] = ()
+    paths: Tuple[Tuple[Occupancy, ...], ...] = ()
+    sampler: str = ""
+
+    def to_json(self) -> str:
+        """Returns a string representation of the key, see `from_json`."""
+        return json.dumps(
+            [
+                self.move_type.name,
+                self.repetitions,
+                self.move_variant.name if self.move_variant else None,
+                [o.name for o in self.squares],
+                [[o.name for o in path] for path in self.paths],
+                self.sampler,
+            ]
+        )
+
+    @classmethod
+    def from_json(cls, text: str) -> "CacheKey":
+        """Parses a key from the output of `to_json`."""
+        move_type, repetitions, move_variant, squares, paths, sampler = json.loads(text)
+        return cls(
+            enums.MoveType[move_type],
+            repetitions,
+            enums.MoveVariant[move_variant] if move_variant else None,
+            tuple(Occupancy[o] for o in squares),
+            tuple(tuple(Occupancy[o] for o in path) for path in paths),
+            sampler,
+        )
+
+
+def cache_key_from_move(
+    m: move.Move,
+    repetitions: int,
+    squares: Tuple[Occupancy, ...] = (),
+    paths: Tuple[Tuple[Occupancy, ...], ...] = (),
+    sampler: str = "",
+) -> CacheKey:
+    return CacheKey(
+        m.move_type or enums.MoveType.NULL_TYPE,
+        repetitions,
+        m.move_variant,
+        squares,
+        paths,
+        sampler,
+    )
+
+
+class ProbabilityCache(collections.abc.MutableMapping, abc.ABC):
+    """Stores the effects of moves on the probabilities of their squares.
+
+    Maps a CacheKey to a dictionary from the attributes of the move naming
+    its squares (such as "target") to their probability after the move.
+    Subclasses implement the storage in `_get`, `__setitem__`,
+    `__delitem__`, `__iter__` and `__len__`.
+
+    Looking up keys counts the hits and misses of the cache.
+    """
+
+    # Maximum number of entries, or None if unbounded. Zero disables caching.
+    maxsize: Optional[int] = None
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of lookups that found their key, 0 before any lookup."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @abc.abstractmethod
+    def _get(self, key: CacheKey) -> Dict[str, float]:
+        """Returns the value of a key, or raises KeyError if it is absent."""
+
+    def __getitem__(self, key: CacheKey) -> Dict[str, float]:
+        try:
+            value = self._get(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+
+class LRUCache(ProbabilityCache):
+    """An in-memory cache that only keeps its `maxsize` most recently used entries."""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._entries: Dict[CacheKey, Dict[str, float]] = collections.OrderedDict()
+
+    def _get(self, key: CacheKey) -> Dict[str, float]:
+        value = self._entries[key]
+        self._entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: CacheKey, value: Dict[str, float]) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __delitem__(self, key: CacheKey) -> None:
+        del self._entries[key]
+
+    def __iter__(self) -> Iterator[CacheKey]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteCache(ProbabilityCache):
+    """A cache stored in an sqlite database file.
+
+    Many boards, also in different processes, can share the same file.
+    Besides the key, each entry records the sampler and the number of
+    repetitions it was computed with.
+
+    Args:
+        path: the database file, created if it does not exist
+        timeout: seconds to wait for other processes writing to the file
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        super().__init__()
+        self.path = path
+        self.timeout = timeout
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, sampler TEXT, repetitions INTEGER, value TEXT)"
+        )
+
+    def _execute(self, sql: str, parameters: Tuple = ()) -> sqlite3.Cursor:
+        # Connections must not be shared with forked processes.
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._connection.execute(sql, parameters)
+
+    def _get(self, key: CacheKey) -> Dict[str, float]:
+        row = self._execute(
+            "SELECT value FROM cache WHERE key = ?", (key.to_json(),)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key: CacheKey, value: Dict[str, float]) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            (key.to_json(), key.sampler, key.repetitions, json.dumps(value)),
+        )
+
+    def __delitem__(self, key: CacheKey) -> None:
+        if not self._execute(
+            "DELETE FROM cache WHERE key = ?", (key.to_json(),)
+        ).rowcount:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[CacheKey]:
+        rows = self._execute("SELECT key FROM cache").fetchall()
+        return (CacheKey.from_json(row[0]) for row in rows)
 
+    def __len__(self) -> int:
+        return self._execute("SELECT COUNT(*) FROM cache").fetchone()[0]
 
-def cache_key_from_move(m: move.Move, repetitions: int) -> CacheKey:
-    return CacheKey(m.move_type or enums.MoveType.NULL_TYPE, repetitions)
+    def close(self) -> None:
+        """Closes the connection to the database file."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
 
 
 @dataclass(frozen=True)
@@ -37,9 +243,12 @@ class ProbabilityHistory:
         probabilities: maps square -> probability of being occupied
         full_squares: (derived from self.probabilities) full squares bitboard
         empty_squares: (derived from self.probabilities) empty squares bitboard
+        exact: whether probabilities were computed from the state instead
+            of being sampled
     """
 
     repetitions: int
     probabilities: Tuple[float, ...]  # for each square
     full_squares: int  # bitboard derived from square_probabilities
     empty_squares: int  # bitboard derived from square_probabilities
+    exact: bool = False
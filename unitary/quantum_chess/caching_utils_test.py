@@ -0,0 +1,95 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+
+import unitary.quantum_chess.caching_utils as caching_utils
+import unitary.quantum_chess.enums as enums
+import unitary.quantum_chess.move as move
+
+
+def test_cache_key_from_move():
+    m = move.Move.from_string("b1^a3c3:SPLIT_JUMP:BASIC")
+    squares = (
+        caching_utils.Occupancy.FULL,
+        caching_utils.Occupancy.EMPTY,
+        caching_utils.Occupancy.EMPTY,
+    )
+    assert caching_utils.cache_key_from_move(m, 100, squares) == caching_utils.CacheKey(
+        enums.MoveType.SPLIT_JUMP, 100, enums.MoveVariant.BASIC, squares
+    )
+    assert caching_utils.cache_key_from_move(
+        move.Move("a1", "a2"), 100
+    ) == caching_utils.CacheKey(enums.MoveType.NULL_TYPE, 100)
+
+
+def test_lru_cache():
+    cache = caching_utils.LRUCache(2)
+    cache["a"] = {"target": 0.5}
+    cache["b"] = {"target": 0.25}
+    assert cache["a"] == {"target": 0.5}
+    cache["c"] = {"target": 1.0}
+    # "b" is the least recently used entry.
+    assert list(cache) == ["a", "c"]
+    assert "b" not in cache
+    del cache["a"]
+    assert len(cache) == 1
+    assert cache.evictions == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.hit_rate == 0.5
+
+    cache = caching_utils.LRUCache(0)
+    cache["a"] = {"target": 0.5}
+    assert len(cache) == 0
+
+
+def test_cache_key_json():
+    key = caching_utils.CacheKey(
+        enums.MoveType.SPLIT_SLIDE,
+        1000,
+        enums.MoveVariant.BASIC,
+        (caching_utils.Occupancy.QUANTUM, caching_utils.Occupancy.EMPTY),
+        ((caching_utils.Occupancy.EMPTY,), ()),
+        "cirq.Simulator",
+    )
+    assert caching_utils.CacheKey.from_json(key.to_json()) == key
+    key = caching_utils.CacheKey(enums.MoveType.JUMP, 10)
+    assert caching_utils.CacheKey.from_json(key.to_json()) == key
+
+
+def test_sqlite_cache(tmp_path):
+    path = str(tmp_path / "cache.db")
+    key = caching_utils.CacheKey(enums.MoveType.JUMP, 10, sampler="sim")
+    key2 = caching_utils.CacheKey(enums.MoveType.JUMP, 100, sampler="sim")
+    cache = caching_utils.SqliteCache(path)
+    assert cache.hit_rate == 0.0
+    assert cache.get(key) is None
+    cache[key] = {"source": 0.0, "target": 1.0}
+    cache[key2] = {"source": 0.5}
+
+    other = caching_utils.SqliteCache(path)
+    assert other[key] == {"source": 0.0, "target": 1.0}
+    assert set(other) == {key, key2}
+    assert other.hit_rate == 1.0
+    del other[key2]
+    with pytest.raises(KeyError):
+        del other[key2]
+    other.close()
+
+    assert len(cache) == 1
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_probability_cache_is_abstract():
+    with pytest.raises(TypeError):
+        caching_utils.ProbabilityCache()
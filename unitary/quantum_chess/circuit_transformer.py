@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import copy
-from typing import Dict, Iterable, List, Optional, Sequence, Set
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
 import cirq
 import cirq_google as cg
 
 import unitary.quantum_chess.controlled_iswap as controlled_iswap
+from unitary.quantum_chess.device_graph import DeviceGraph
 import unitary.quantum_chess.initial_mapping_utils as imu
 import unitary.quantum_chess.swap_updater as su
 
@@ -40,14 +42,36 @@ class ConnectivityHeuristicCircuitTransformer:
     search to find a suitable mapping into the specified grid.
 
     It will then transform all operations to use the new qubits.
+
+    The search for a mapping is bounded, so that its latency is predictable.
+    When the budget runs out, the largest partial mapping found is kept and
+    the remaining qubits are placed like disconnected ones.
+
+    Args:
+      device: the device to map the circuits onto.
+      max_explored_nodes: the maximum number of search nodes explored to
+        map a circuit, or None for no limit.
+      time_budget: the maximum time in seconds spent searching for the
+        mapping of a circuit, or None for no limit.
     """
 
-    def __init__(self, device: cirq.Device):
+    def __init__(
+        self,
+        device: cirq.Device,
+        max_explored_nodes: Optional[int] = 100000,
+        time_budget: Optional[float] = None,
+    ):
         super().__init__()
         self.device = device
         self.mapping: Dict[cirq.Qid, cirq.GridQubit] = {}
         self.qubit_list = list(device.metadata.qubit_set or {})
         self.starting_qubit = self.find_start_qubit(self.qubit_list)
+        self.max_explored_nodes = max_explored_nodes
+        self.time_budget = time_budget
+        # Statistics of the last call to `qubit_mapping`.
+        self.explored_nodes = 0
+        self.budget_exhausted = False
+        self._deadline: Optional[float] = None
 
     def qubits_within(
         self,
@@ -62,19 +86,15 @@ class ConnectivityHeuristicCircuitTransformer:
           depth: how many connections to traverse
           qubit: starting qubit
           qubit_list: iterable of valid qubits
-          visited: grid qubits that have already been counted
+          visited: grid qubits that have already been counted.  They are
+            not counted again, and the counted qubits are added to it.
         """
-        if qubit not in qubit_list:
+        graph = DeviceGraph.for_qubits(set(qubit_list).difference(visited))
+        if qubit not in graph:
             return 0
-        if qubit in visited:
-            return 0
-        visited.add(qubit)
-        if depth <= 0:
-            return 1
-        c = 1
-        for diff in ADJACENCY:
-            c += self.qubits_within(depth - 1, qubit + diff, qubit_list, visited)
-        return c
+        within = graph.nodes_within(depth, qubit)
+        visited.update(within)
+        return len(within)
 
     def find_start_qubit(
         self, qubit_list: Iterable[cirq.Qid], depth=3
@@ -86,15 +106,10 @@ class ConnectivityHeuristicCircuitTransformer:
         Raises:
             DeviceMappingError: if there are no qubits left to map.
         """
-        best_count = -1
-        for q in qubit_list:
-            c = self.qubits_within(depth, q, qubit_list, set())
-            if c > best_count:
-                best_count = c
-                best = q
-        if best_count == -1:
+        graph = DeviceGraph.for_qubits(qubit_list)
+        if not len(graph):
             raise DeviceMappingError("Qubits exhausted")
-        return best
+        return graph.most_connected(depth)
 
     def edges_within(
         self,
@@ -110,22 +125,27 @@ class ConnectivityHeuristicCircuitTransformer:
           node: starting qubit
           graph: edge graph of connections between qubits,
             representing by a dictionary from qubit to adjacent qubits.
-          visited: saves the qubits that have already been counted.
+          visited: saves the qubits that have already been counted.  They
+            are not counted again, and the counted qubits are added to it.
         """
-        if node in visited:
+        logical_graph = DeviceGraph.from_adjacency(
+            {
+                n: [adj_node for adj_node in v if adj_node not in visited]
+                for n, v in graph.items()
+                if n not in visited
+            }
+        )
+        if node not in logical_graph:
             return 0
-        visited.add(node)
-        if depth <= 0:
-            return 1
-        c = 1
-        for adj_node in graph[node]:
-            c += self.edges_within(depth - 1, adj_node, graph, visited)
-        return c
+        within = logical_graph.nodes_within(depth, node)
+        visited.update(within)
+        return len(within)
 
     def find_start_node(
         self,
         graph: Dict[cirq.Qid, Sequence[cirq.Qid]],
         mapping: Dict[cirq.Qid, cirq.GridQubit],
+        logical_graph: Optional[DeviceGraph] = None,
     ) -> cirq.Qid:
         """Finds a reasonable starting qubit from an adjacency graph.
 
@@ -133,19 +153,31 @@ class ConnectivityHeuristicCircuitTransformer:
             graph: edge graph of connections between qubits,
             representing by a dictionary from qubit to adjacent qubits.
             mapping: stores current mapping from named qubits to grid qubits.
+            logical_graph: `graph` as a DeviceGraph, to reuse its counts of
+              nodes within a distance across calls.
         """
+        if logical_graph is None:
+            logical_graph = DeviceGraph.from_adjacency(graph)
         best = None
         best_count = -1
         for node in graph:
             if node in mapping:
                 continue
-            visited: Set[cirq.Qid] = set()
-            c = self.edges_within(3, node, graph, visited)
+            c = logical_graph.qubits_within(3, node)
             if c > best_count:
                 best_count = c
                 best = node
         return best
 
+    def _out_of_budget(self) -> bool:
+        """Returns whether the search for a mapping must stop."""
+        if (
+            self.max_explored_nodes is not None
+            and self.explored_nodes >= self.max_explored_nodes
+        ):
+            return True
+        return self._deadline is not None and time.perf_counter() > self._deadline
+
     def map_helper(
         self,
         cur_node: cirq.Qid,
@@ -157,11 +189,14 @@ class ConnectivityHeuristicCircuitTransformer:
     ) -> bool:
         """Helper function to construct mapping.
 
-        Traverses a graph and performs recursive depth-first
-        search to construct a mapping one node at a time.
-        On failure, raises an error and back-tracks until a
-        suitable mapping can be found.  Assumes all qubits in
-        the graph are connected.
+        Traverses a graph and performs a depth-first search
+        to construct a mapping one node at a time.
+        On failure, back-tracks until a suitable mapping
+        can be found.  Assumes all qubits in the graph are connected.
+
+        The search uses an explicit stack and stops when the budget of the
+        transformer runs out.  If no mapping was found, the largest partial
+        mapping found is left in `mapping`.
 
         Args:
           cur_node: node to examine.
@@ -169,92 +204,117 @@ class ConnectivityHeuristicCircuitTransformer:
           available_qubits: current set of unassigned qubits.
           graph: adjacency graph of connections between qubits,
             representing by a dictionary from qubit to adjacent qubits.
-          nodes_trying: this list is used as a stack containing nodes currently under trying.
+          nodes_trying: this list is used as a stack containing the nodes
+            mapped by the search, in order.
 
         Returns:
-          True if mapping was successful, False if no mapping was possible.
+          True if mapping was successful, False if no mapping was possible
+          or the budget ran out.
         """
-        # cur_node is the named qubit
-        # cur_qubit is the currently assigned GridQubit
-        cur_qubit = mapping[cur_node]
-        if print_debug:
-            print(f"{cur_node} -> {cur_qubit}")
-
-        # Determine the list of adjacent nodes that still need to be mapped
-        nodes_to_map = []
-        for node in graph[cur_node]:
-            if node not in mapping:
-                # Unmapped node.
-                nodes_to_map.append(node)
-            else:
-                # Mapped adjacent node.
-                # Verify that the previous mapping is adjacent in the Grid.
-                if not mapping[node].is_adjacent(cur_qubit):
-                    if print_debug:
-                        print(f"Not adjacent {node} and {cur_node}")
-                    return False
-        if not nodes_to_map:
-            # All done with this node.
-            return True
 
-        # Find qubits that are adjacent in the grid
-        valid_adjacent_qubits = []
-        for a in ADJACENCY:
-            q = cur_qubit + a
-            if q in available_qubits:
-                valid_adjacent_qubits.append(q)
+        def undo(length: int) -> None:
+            while len(nodes_trying) > length:
+                named_qubit = nodes_trying.pop()
+                available_qubits.add(mapping.pop(named_qubit))
+
+        start = len(nodes_trying)
+        best: List[Tuple[cirq.Qid, cirq.GridQubit]] = []
+        # Nodes whose adjacent nodes still need to be checked and mapped.
+        # The last node is examined first.
+        goals = [cur_node]
+        # Back-tracking points: the node being mapped, the grid qubits that
+        # were not tried yet, the length of `nodes_trying` before the node
+        # was mapped, and the nodes to examine after it.
+        choices: List[Tuple[cirq.Qid, List[cirq.GridQubit], int, List[cirq.Qid]]] = []
+        while goals:
+            if self._out_of_budget():
+                if print_debug:
+                    print("Warning: mapping budget exhausted!")
+                self.budget_exhausted = True
+                break
+            self.explored_nodes += 1
 
-        # Not enough adjacent qubits to map all qubits
-        if len(valid_adjacent_qubits) < len(nodes_to_map):
+            # cur_node is the named qubit
+            # cur_qubit is the currently assigned GridQubit
+            cur_node = goals.pop()
+            cur_qubit = mapping[cur_node]
             if print_debug:
-                print(f"Cannot fit adjacent nodes into {cur_node}")
-            return False
+                print(f"{cur_node} -> {cur_qubit}")
+
+            # Determine the list of adjacent nodes that still need to be mapped
+            nodes_to_map = []
+            success = True
+            for node in graph[cur_node]:
+                if node not in mapping:
+                    # Unmapped node.
+                    nodes_to_map.append(node)
+                elif not mapping[node].is_adjacent(cur_qubit):
+                    # Mapped adjacent node.
+                    # The previous mapping must be adjacent in the Grid.
+                    if print_debug:
+                        print(f"Not adjacent {node} and {cur_node}")
+                    success = False
+                    break
+            if success and not nodes_to_map:
+                # All done with this node.
+                continue
+
+            if success:
+                # Find qubits that are adjacent in the grid
+                valid_adjacent_qubits = [
+                    cur_qubit + a
+                    for a in ADJACENCY
+                    if cur_qubit + a in available_qubits
+                ]
+                if len(valid_adjacent_qubits) < len(nodes_to_map):
+                    # Not enough adjacent qubits to map all qubits
+                    if print_debug:
+                        print(f"Cannot fit adjacent nodes into {cur_node}")
+                    success = False
+                else:
+                    # Only map one qubit at a time
+                    # This makes back-tracking easier.
+                    # Move on to the qubit we map, then come back to this
+                    # node and map the rest of the adjacent nodes.
+                    choices.append(
+                        (
+                            nodes_to_map[0],
+                            valid_adjacent_qubits,
+                            len(nodes_trying),
+                            goals + [cur_node],
+                        )
+                    )
 
-        # Only map one qubit at a time
-        # This makes back-tracking easier.
-        node_to_map = nodes_to_map[0]
+            if not success:
+                # Undo mappings back to the last node with qubits left to try.
+                while choices and not choices[-1][1]:
+                    choices.pop()
+                if not choices:
+                    if print_debug:
+                        print("Warning: could not map all qubits!")
+                    break
+                undo(choices[-1][2])
 
-        for node_to_try in valid_adjacent_qubits:
+            node_to_map, qubits_to_try, _, next_goals = choices[-1]
             # Add proposed qubit to the mapping
             # and remove it from available qubits
+            node_to_try = qubits_to_try.pop(0)
             mapping[node_to_map] = node_to_try
             available_qubits.remove(node_to_try)
             nodes_trying.append(node_to_map)
-            # Recurse
-            # Move on to the qubit we just mapped.
-            # Then, come back to this node and
-            # map the rest of the adjacent nodes.
-            # Note:
-            # When the 1st run of map_helper below returns success but the 2nd
-            # run of map_helper returns failure, all nodes involved in 1st and
-            # 2nd run (i.e. nodes saved in the stack nodes_trying, down to
-            # node_to_map) are supposed to be reversed in mapping and
-            # available_qubits.
-
-            success = self.map_helper(
-                node_to_map, mapping, available_qubits, graph, nodes_trying
-            )
-            if success:
-                success = self.map_helper(
-                    cur_node, mapping, available_qubits, graph, nodes_trying
-                )
-
-            if not success:
-                # We have failed.  Undo this mapping and try another one.
-                while True:
-                    named_qubit = nodes_trying.pop()
-                    available_qubits.add(mapping[named_qubit])
-                    del mapping[named_qubit]
-                    if named_qubit == node_to_map:
-                        break
-            else:
-                # We have successfully mapped all qubits!
-                return True
+            goals = next_goals + [node_to_map]
+            if len(nodes_trying) - start > len(best):
+                best = [(n, mapping[n]) for n in nodes_trying[start:]]
+        else:
+            # We have successfully mapped all qubits!
+            return True
 
-        # All available qubits were not valid.
-        # Fail upwards and back-track if possible.
-        if print_debug:
-            print("Warning: could not map all qubits!")
+        # Keep the largest partial mapping.
+        undo(start)
+        for node, qubit in best:
+            mapping[node] = qubit
+            available_qubits.remove(qubit)
+            nodes_trying.append(node)
         return False
 
     def qubit_mapping(self, circuit: cirq.Circuit) -> Dict[cirq.Qid, cirq.GridQubit]:
@@ -290,6 +350,14 @@ class ConnectivityHeuristicCircuitTransformer:
                     f"Qubit {q} needs more than 4 adjacent qubits!"
                 )
 
+        # Initialize the budget of the search
+        self.explored_nodes = 0
+        self.budget_exhausted = False
+        self._deadline = (
+            None if self.time_budget is None else time.perf_counter() + self.time_budget
+        )
+        logical_graph = DeviceGraph.from_adjacency(g)
+
         # Initialize mappings and available qubits
         start_qubit = self.starting_qubit
         mapping: Dict[cirq.Qid, cirq.GridQubit] = {}
@@ -297,7 +365,7 @@ class ConnectivityHeuristicCircuitTransformer:
         start_list.remove(start_qubit)
 
         last_node = None
-        cur_node = self.find_start_node(g, mapping)
+        cur_node = self.find_start_node(g, mapping, logical_graph)
         if not cur_node and sq:
             for q in sq:
                 start_qubit = self.find_start_qubit(start_list)
@@ -312,7 +380,7 @@ class ConnectivityHeuristicCircuitTransformer:
             # Depth first seach for a valid mapping
             self.map_helper(cur_node, mapping, start_list, g, [])
             last_node = cur_node
-            cur_node = self.find_start_node(g, mapping)
+            cur_node = self.find_start_node(g, mapping, logical_graph)
             if not cur_node:
                 for q in sq:
                     start_qubit = self.find_start_qubit(start_list)
@@ -331,6 +399,64 @@ class ConnectivityHeuristicCircuitTransformer:
         self.mapping = mapping
         return mapping
 
+    def extend_mapping(
+        self,
+        circuit: cirq.AbstractCircuit,
+        mapping: Dict[cirq.Qid, cirq.GridQubit],
+    ) -> Optional[Dict[cirq.Qid, cirq.GridQubit]]:
+        """Extends a mapping to the qubits of a circuit without moving any qubit.
+
+        Used to map operations appended to a circuit that was already mapped.
+        A new qubit is placed next to the first mapped qubit it interacts
+        with.  Qubits that only have single qubit operations are placed like
+        in `qubit_mapping`.
+
+        Args:
+          circuit: circuit whose qubits should be mapped.
+          mapping: mapping of the qubits that are already placed.  It is
+            not modified.
+
+        Returns:
+          The extended mapping, or None if the circuit does not fit, for
+          instance because it acts on two qubits that were already mapped to
+          qubits which are not adjacent.
+        """
+        mapping = dict(mapping)
+        available_qubits = set(self.qubit_list).difference(mapping.values())
+        single_qubits = []
+        for op in circuit.all_operations():
+            if len(op.qubits) == 1:
+                single_qubits.append(op.qubits[0])
+                continue
+            if len(op.qubits) != 2:
+                return None
+            q1, q2 = op.qubits
+            if q1 not in mapping:
+                q1, q2 = q2, q1
+            if q1 not in mapping:
+                # Unconnected to the mapped qubits.
+                return None
+            if q2 in mapping:
+                if not mapping[q1].is_adjacent(mapping[q2]):
+                    return None
+                continue
+            for a in ADJACENCY:
+                q = mapping[q1] + a
+                if q in available_qubits:
+                    mapping[q2] = q
+                    available_qubits.remove(q)
+                    break
+            else:
+                return None
+        for q in single_qubits:
+            if q not in mapping:
+                try:
+                    mapping[q] = self.find_start_qubit(available_qubits)
+                except DeviceMappingError:
+                    return None
+                available_qubits.remove(mapping[q])
+        return mapping
+
     def __call__(
         self,
         circuit: cirq.AbstractCircuit,
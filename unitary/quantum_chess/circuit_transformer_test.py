@@ -199,6 +199,65 @@ def test_split_then_merge_trapezoid(device):
     device.validate_circuit(t(c))
 
 
+def test_extend_mapping():
+    t = ct.ConnectivityHeuristicCircuitTransformer(cg.Sycamore23)
+    mapping = t.qubit_mapping(cirq.Circuit(cirq.ISWAP(a1, a2)))
+    extended = t.extend_mapping(cirq.Circuit(cirq.ISWAP(a2, a3), cirq.X(b1)), mapping)
+    assert len(mapping) == 2
+    assert {q: extended[q] for q in mapping} == mapping
+    assert extended[a3].is_adjacent(extended[a2])
+    assert len(set(extended.values())) == 4
+
+    # Mapped qubits are never moved. a1 and a3 are both adjacent to a2, so
+    # they cannot be adjacent to each other on the grid.
+    assert extended[a1].is_adjacent(extended[a2])
+    assert not extended[a1].is_adjacent(extended[a3])
+    assert t.extend_mapping(cirq.Circuit(cirq.ISWAP(a1, a3)), extended) is None
+    # Qubits that do not interact with mapped qubits need a new mapping.
+    assert t.extend_mapping(cirq.Circuit(cirq.ISWAP(c1, c2)), extended) is None
+
+
+def test_mapping_search_statistics():
+    t = ct.ConnectivityHeuristicCircuitTransformer(cg.Sycamore23)
+    c = cirq.Circuit(qm.split_move(a1, a2, b1), qm.split_move(a2, a3, b3))
+    cg.Sycamore23.validate_circuit(t(c))
+    assert t.explored_nodes > 0
+    assert not t.budget_exhausted
+
+
+@pytest.mark.parametrize("kwargs", [{"max_explored_nodes": 3}, {"time_budget": 0.0}])
+def test_mapping_search_budget(kwargs):
+    """A triangle cannot be mapped onto a grid, so the search fails and
+    keeps back-tracking until the budget runs out."""
+    t = ct.ConnectivityHeuristicCircuitTransformer(cg.Sycamore, **kwargs)
+    c = cirq.Circuit(
+        cirq.ISWAP(a1, a2),
+        cirq.ISWAP(a2, a3),
+        cirq.ISWAP(a3, a1),
+        cirq.ISWAP(a1, b1),
+        cirq.ISWAP(b1, b2),
+        cirq.ISWAP(b2, b3),
+    )
+    mapping = t.qubit_mapping(c)
+    assert t.budget_exhausted
+    assert t.explored_nodes <= kwargs.get("max_explored_nodes", 0)
+    assert set(mapping) == set(c.all_qubits())
+    assert len(set(mapping.values())) == len(mapping)
+
+
+def test_map_helper_keeps_partial_mapping():
+    t = ct.ConnectivityHeuristicCircuitTransformer(cg.Sycamore)
+    graph = {a1: [a2, a3], a2: [a1, a3], a3: [a1, a2]}
+    start = t.starting_qubit
+    mapping = {a1: start}
+    available = set(t.qubit_list) - {start}
+    nodes_trying = []
+    assert not t.map_helper(a1, mapping, available, graph, nodes_trying)
+    assert len(mapping) == 3
+    assert nodes_trying == [q for q in mapping if q != a1]
+    assert available.isdisjoint(mapping.values())
+
+
 def test_too_many_qubits():
     c = cirq.Circuit()
     for i in range(24):
@@ -0,0 +1,202 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Integer-indexed qubit graphs shared by the circuit transformers.
+
+Building the shortest distances between all qubits of a device is the
+largest part of the setup cost of the transformers, so the graphs of
+devices and of sets of grid qubits are built once and memoized.
+"""
+
+import functools
+import math
+import weakref
+from typing import Dict, FrozenSet, Hashable, Iterable, List, Optional, Tuple, Union
+
+import cirq
+import numpy as np
+
+
+class DeviceGraph:
+    """A graph whose nodes are numbered 0, ..., n - 1.
+
+    Nodes are usually qubits.  The graph stores the length of the shortest
+    path between every pair of nodes, the neighbors of each node in
+    compressed sparse row form (the neighbors of node `i` are
+    `indices[indptr[i]:indptr[i + 1]]`), and the number of nodes within
+    each distance of each node.
+
+    Use `for_device` and `for_qubits` to get the memoized graphs of devices.
+
+    Args:
+      nodes: the nodes of the graph.  Node `nodes[i]` has id `i`.
+      edges: pairs of adjacent nodes.
+      directed: whether an edge `(a, b)` only makes `b` a neighbor of `a`.
+    """
+
+    def __init__(
+        self,
+        nodes: Iterable[Hashable],
+        edges: Iterable[Tuple[Hashable, Hashable]],
+        directed: bool = False,
+    ):
+        self.nodes = list(nodes)
+        self.index: Dict[Hashable, int] = {q: i for i, q in enumerate(self.nodes)}
+        n = len(self.nodes)
+        adjacency = np.zeros((n, n), dtype=bool)
+        for q1, q2 in edges:
+            i, j = self.index[q1], self.index[q2]
+            if i != j:
+                adjacency[i, j] = True
+                if not directed:
+                    adjacency[j, i] = True
+
+        rows, self.indices = np.nonzero(adjacency)
+        self.indptr = np.searchsorted(rows, np.arange(n + 1))
+
+        # Breadth-first search from all nodes at once.
+        self.distances = np.full((n, n), np.inf)
+        np.fill_diagonal(self.distances, 0)
+        reached = np.eye(n, dtype=bool)
+        frontier = reached
+        step = adjacency.astype(np.int32)
+        distance = 0
+        while frontier.any():
+            distance += 1
+            frontier = (frontier.astype(np.int32) @ step > 0) & ~reached
+            self.distances[frontier] = distance
+            reached |= frontier
+
+        # khop_counts[k, i] is the number of nodes within distance k of node i.
+        self.khop_counts = np.array(
+            [(self.distances <= k).sum(axis=1) for k in range(max(distance, 1))],
+            dtype=np.int64,
+        )
+
+    @classmethod
+    def from_adjacency(
+        cls,
+        g: Union[
+            Dict[cirq.GridQubit, List[cirq.GridQubit]],
+            Dict[cirq.Qid, List[Tuple[cirq.Qid, int]]],
+        ],
+    ) -> "DeviceGraph":
+        """Builds a graph from a physical or logical qubits graph.
+
+        See `initial_mapping_utils` for the formats of these graphs.  The
+        edges are directed like the adjacency lists.
+        """
+        nodes = dict.fromkeys(g)
+        edges = []
+        for k, v in g.items():
+            for neighbor in v:
+                if isinstance(neighbor, tuple):
+                    neighbor = neighbor[0]
+                nodes[neighbor] = None
+                edges.append((k, neighbor))
+        return cls(nodes, edges, directed=True)
+
+    @classmethod
+    def for_device(cls, device: cirq.Device) -> "DeviceGraph":
+        """Returns the memoized graph of the qubits of a device.
+
+        Each edge represents a valid two-qubit gate.
+        """
+        if device not in _DEVICE_GRAPHS:
+            graph = device.metadata.nx_graph
+            _DEVICE_GRAPHS[device] = cls(graph, graph.edges)
+        return _DEVICE_GRAPHS[device]
+
+    @classmethod
+    def for_qubits(cls, qubits: Iterable[cirq.GridQubit]) -> "DeviceGraph":
+        """Returns the memoized graph of adjacent grid qubits among `qubits`."""
+        return _grid_graph(frozenset(qubits))
+
+    def __contains__(self, node: Hashable) -> bool:
+        return node in self.index
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def neighbors(self, node: Hashable) -> List[Hashable]:
+        """Returns the neighbors of a node, or an empty list if not in the graph."""
+        i = self.index.get(node)
+        if i is None:
+            return []
+        return [
+            self.nodes[j] for j in self.indices[self.indptr[i] : self.indptr[i + 1]]
+        ]
+
+    def distance(self, q1: Hashable, q2: Hashable) -> Union[int, float]:
+        """Returns the length of the shortest path between two nodes.
+
+        This is `math.inf` if the nodes are not connected.
+
+        Raises:
+          KeyError: if a node is not in the graph.
+        """
+        d = self.distances[self.index[q1], self.index[q2]]
+        return int(d) if d != np.inf else math.inf
+
+    def shortest_path(self, q1: Hashable, q2: Hashable) -> List[Hashable]:
+        """Returns the nodes of a shortest path from `q1` to `q2`, both included.
+
+        Raises:
+          KeyError: if a node is not in the graph.
+          ValueError: if the nodes are not connected.
+        """
+        i, j = self.index[q1], self.index[q2]
+        if np.isinf(self.distances[i, j]):
+            raise ValueError(f"{q1} and {q2} are not connected")
+        path = [q1]
+        while i != j:
+            neighbors = self.indices[self.indptr[i] : self.indptr[i + 1]]
+            i = int(neighbors[np.argmin(self.distances[neighbors, j])])
+            path.append(self.nodes[i])
+        return path
+
+    def qubits_within(self, depth: int, node: Hashable) -> int:
+        """Returns the number of nodes within `depth` of `node`, including itself."""
+        depth = min(max(depth, 0), len(self.khop_counts) - 1)
+        return int(self.khop_counts[depth, self.index[node]])
+
+    def most_connected(self, depth: int) -> Hashable:
+        """Returns the first node with the most nodes within `depth` of it."""
+        depth = min(max(depth, 0), len(self.khop_counts) - 1)
+        return self.nodes[int(self.khop_counts[depth].argmax())]
+
+    def nodes_within(self, depth: int, node: Hashable) -> List[Hashable]:
+        """Returns the nodes within `depth` of `node`, including itself."""
+        ids = np.flatnonzero(self.distances[self.index[node]] <= depth)
+        return [self.nodes[i] for i in ids]
+
+    def center(self) -> Optional[Hashable]:
+        """Returns the first node whose distance to the farthest node is smallest.
+
+        Returns None if the graph is empty.
+        """
+        if not self.nodes:
+            return None
+        return self.nodes[int(np.argmin(self.distances.max(axis=1)))]
+
+
+_DEVICE_GRAPHS: "weakref.WeakKeyDictionary[cirq.Device, DeviceGraph]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+@functools.lru_cache(maxsize=128)
+def _grid_graph(qubits: FrozenSet[cirq.GridQubit]) -> DeviceGraph:
+    nodes = sorted(qubits)
+    edges = [(q, n) for q in nodes for n in q.neighbors(qubits)]
+    return DeviceGraph(nodes, edges)
@@ -0,0 +1,90 @@
+# Copyright 2023 The Unitary Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+
+import cirq
+import cirq_google as cg
+import numpy as np
+import pytest
+
+from unitary.quantum_chess.device_graph import DeviceGraph
+
+
+def test_grid_graph():
+    """Coupling graph of grid qubits looks like:
+
+    Q0 = Q1 = Q2
+    ||   ||   ||
+    Q3 = Q4 = Q5
+    """
+    Q = cirq.GridQubit.rect(2, 3)
+    graph = DeviceGraph.for_qubits(Q)
+    assert graph.nodes == Q
+    assert set(graph.neighbors(Q[4])) == {Q[1], Q[3], Q[5]}
+    assert graph.neighbors(cirq.GridQubit(5, 5)) == []
+    assert graph.distance(Q[0], Q[5]) == 3
+    assert [graph.qubits_within(d, Q[0]) for d in range(5)] == [1, 3, 5, 6, 6]
+    assert set(graph.nodes_within(1, Q[1])) == {Q[0], Q[1], Q[2], Q[4]}
+    assert graph.most_connected(1) == Q[1]
+    assert graph.center() == Q[1]
+    np.testing.assert_array_equal(graph.distances, graph.distances.T)
+
+
+def test_disconnected_graph():
+    Q = cirq.GridQubit.rect(1, 3)
+    graph = DeviceGraph.for_qubits([Q[0], Q[2]])
+    assert graph.distance(Q[0], Q[2]) == math.inf
+    assert graph.qubits_within(10, Q[0]) == 1
+    with pytest.raises(KeyError):
+        graph.distance(Q[0], Q[1])
+
+
+def test_memoized():
+    assert DeviceGraph.for_device(cg.Sycamore23) is DeviceGraph.for_device(
+        cg.Sycamore23
+    )
+    qubits = cg.Sycamore.metadata.qubit_set
+    assert DeviceGraph.for_qubits(qubits) is DeviceGraph.for_qubits(list(qubits))
+
+
+@pytest.mark.parametrize("device", (cg.Sycamore23, cg.Sycamore))
+def test_device_graph(device):
+    graph = DeviceGraph.for_device(device)
+    nx_graph = device.metadata.nx_graph
+    assert set(graph.nodes) == set(nx_graph)
+    for q in graph.nodes:
+        assert set(graph.neighbors(q)) == set(nx_graph.neighbors(q))
+    assert np.isfinite(graph.distances).all()
+
+
+def test_shortest_path():
+    Q = cirq.GridQubit.rect(2, 3)
+    graph = DeviceGraph.for_qubits(Q)
+    path = graph.shortest_path(Q[0], Q[5])
+    assert len(path) == 4
+    assert path[0] == Q[0] and path[-1] == Q[5]
+    assert all(a.is_adjacent(b) for a, b in zip(path, path[1:]))
+    assert graph.shortest_path(Q[4], Q[4]) == [Q[4]]
+    with pytest.raises(ValueError, match="not connected"):
+        DeviceGraph.for_qubits([Q[0], Q[2]]).shortest_path(Q[0], Q[2])
+
+
+def test_empty_graph():
+    assert DeviceGraph.from_adjacency({}).center() is None
+
+
+def test_directed_graph():
+    graph = DeviceGraph.from_adjacency({0: [1], 1: [2], 2: []})
+    assert graph.distance(0, 2) == 2
+    assert graph.distance(2, 0) == math.inf
@@ -38,9 +38,12 @@ evaluation of https://ieeexplore.ieee.org/abstract/document/8976109.
 For example, to run the benchmark on all the circuits in that directory:
   python unitary/quantum_chess/experiments/circuit_transform_benchmark.py \
       unitary/quantum_chess/experiments/circuits/*
-NOTE however that the current dynamic look-ahead transformer implementation
-contains a bug and will never terminate on some of the circuits in that
-directory (https://github.com/quantumlib/ReCirq/issues/163).
+The dynamic look-ahead transformer used to loop forever on some of the
+circuits in that directory (https://github.com/quantumlib/ReCirq/issues/163).
+Its SwapUpdater now falls back to shortest-path routing when its greedy SWAPs
+stop making progress, and raises a RuntimeError if it still has not finished
+after `max_iterations` iterations, so it no longer runs forever.  The largest
+circuits in that directory may still take a long time to transform.
 """
 
 import cirq
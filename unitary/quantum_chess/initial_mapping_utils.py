@@ -16,6 +16,9 @@ from collections import defaultdict, deque
 from typing import Deque, Dict, List, Optional, Tuple, Union, ValuesView
 
 import cirq
+import numpy as np
+
+from unitary.quantum_chess.device_graph import DeviceGraph
 
 
 def build_physical_qubits_graph(
@@ -124,33 +127,16 @@ def find_all_pairs_shortest_paths(
 ) -> Dict[Tuple[cirq.Qid, cirq.Qid], float]:
     """Returns a dict of the shortest distance between each pair of nodes.
 
-    Implements repeated BFS, which is faster than the Floyd–Warshall algorithm
-    when the input graph is sparse.
+    Pairs of nodes that are not connected are missing from the dict, which
+    returns infinity for them.
 
     Args:
       g: A physical qubits graph or a logical qubits graph.
     """
-    all_qubits = set()
-    adjacent = defaultdict(list)
-    for k, v in g.items():
-        all_qubits.add(k)
-        for neighbor in v:
-            if isinstance(neighbor, tuple):
-                neighbor = neighbor[0]
-            all_qubits.add(neighbor)
-            adjacent[k].append(neighbor)
-
+    graph = DeviceGraph.from_adjacency(g)
     shortest: Dict[Tuple[cirq.Qid, cirq.Qid], float] = defaultdict(lambda: math.inf)
-    for starting_qubit in all_qubits:
-        to_be_visited: Deque[Tuple[cirq.Qid, int]] = deque()
-        shortest[(starting_qubit, starting_qubit)] = 0
-        to_be_visited.append((starting_qubit, 0))
-        while to_be_visited:
-            qubit, cur_dist = to_be_visited.popleft()
-            for neighbor in adjacent[qubit]:
-                if (starting_qubit, neighbor) not in shortest:
-                    shortest[(starting_qubit, neighbor)] = cur_dist + 1
-                    to_be_visited.append((neighbor, cur_dist + 1))
+    for i, j in zip(*np.nonzero(np.isfinite(graph.distances))):
+        shortest[(graph.nodes[i], graph.nodes[j])] = int(graph.distances[i, j])
     return shortest
 
 
@@ -162,33 +148,14 @@ def find_graph_center(
 ) -> cirq.Qid:
     """Returns a qubit that is a graph center.
 
-    Uses the Floyd-Warshall algorithm to calculate the length of the
-    shortest path between each pair of nodes. Then, finds the graph center
-    such that the length of the shortest path to the farthest node is the
-    smallest. Returns the first graph center if there are multiple.
+    Finds the graph center such that the length of the shortest path to the
+    farthest node is the smallest. Returns the first graph center if there
+    are multiple.
 
     Args:
       g: A physical qubits graph or a logical qubits graph.
     """
-    shortest = find_all_pairs_shortest_paths(g)
-
-    # For each node, find the length of the shortest path to the farthest
-    # node.
-    farthest = defaultdict(int)
-    for i in g:
-        for j in g:
-            if i != j and shortest[(i, j)] > farthest[i]:
-                farthest[i] = shortest[(i, j)]
-
-    # Find the graph center such that the length of the shortest path to the
-    # farthest node is the smallest. Use the first graph center if there are
-    # multiple graph centers.
-    center = None
-    for q in g:
-        if not center or farthest[q] < farthest[center]:
-            center = q
-
-    return center
+    return DeviceGraph.from_adjacency(g).center()
 
 
 def traverse(
@@ -333,8 +300,9 @@ def calculate_initial_mapping(
     mapping = defaultdict()
 
     pg = build_physical_qubits_graph(device)
+    device_graph = DeviceGraph.for_device(device)
     lg = build_logical_qubits_graph(circuit)
-    pg_center = find_graph_center(pg)
+    pg_center = device_graph.center()
     lg_center = find_graph_center(lg)
     mapping[lg_center] = pg_center
 
@@ -356,7 +324,7 @@ def calculate_initial_mapping(
             for ref_q in reference_qubits[1:]:
                 distances = defaultdict(list)
                 for cand_q in candidate_qubits:
-                    d = find_shortest_path(pg, ref_q, cand_q)
+                    d = device_graph.distance(ref_q, cand_q)
                     distances[d].append(cand_q)
                 min_dist = min(distances.keys())
                 candidate_qubits = distances[min_dist]
@@ -11,25 +11,42 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import copy
+import hashlib
 import time
 from collections import defaultdict
-from typing import Dict, List, Optional, Sequence, Set, Tuple
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 import cirq
-import pandas
+import numpy as np
 
 from unitary.quantum_chess.bit_utils import (
     bit_to_qubit,
     nth_bit_of,
     num_ones,
+    num_ones_array,
     qubit_to_bit,
     set_nth_bit,
     square_to_bit,
     xy_to_bit,
     bit_ones,
+    bit_to_square,
 )
 from unitary.quantum_chess.caching_utils import (
     CacheKey,
+    LRUCache,
+    Occupancy,
+    ProbabilityCache,
     ProbabilityHistory,
     cache_key_from_move,
 )
@@ -37,6 +54,7 @@ import unitary.quantum_chess.circuit_transformer as ct
 import unitary.quantum_chess.enums as enums
 import unitary.quantum_chess.move as move
 import unitary.quantum_chess.quantum_moves as qm
+from unitary.circuit_utils import backward_light_cone
 
 # This is a constant used to check if a board is in a classical state. It indicates that every
 # space is represented by a 1. The XOR of the empty squares and full squares bitboards will yield
@@ -54,6 +72,123 @@ _NO_CACHE_AVAILABLE = -1
 # Repetitions count for position which should always use the cache
 _CACHE_ALWAYS_AVAILABLE = 10**9
 
+# Moves whose effect on the probabilities can be cached, see
+# `CirqBoard._transform_cache_key`.
+_TRANSFORM_CACHE_MOVE_TYPES = (
+    enums.MoveType.JUMP,
+    enums.MoveType.SLIDE,
+    enums.MoveType.SPLIT_JUMP,
+    enums.MoveType.SPLIT_SLIDE,
+    enums.MoveType.MERGE_JUMP,
+    enums.MoveType.MERGE_SLIDE,
+    enums.MoveType.PAWN_STEP,
+    enums.MoveType.PAWN_TWO_STEP,
+    enums.MoveType.PAWN_CAPTURE,
+)
+
+# Moves that measure their source or merge it with another square, so that
+# their effect on a source in superposition depends on other squares.
+_NONLOCAL_SOURCE_MOVE_TYPES = (
+    enums.MoveType.MERGE_JUMP,
+    enums.MoveType.MERGE_SLIDE,
+    enums.MoveType.PAWN_CAPTURE,
+)
+
+# Attributes of a move naming the squares whose probabilities it changes.
+_TRANSFORM_ROLES = ("source", "source2", "target", "target2")
+
+# Probabilities within this distance of 0 or 1 are treated as rounding errors
+# when computing exact probabilities.
+_EXACT_TOLERANCE = 1e-9
+
+# Largest number of qubits of an entangled component whose state vector is
+# computed for exact probabilities (2**24 amplitudes take 128 MB).
+_MAX_EXACT_QUBITS = 24
+
+
+def _qubit_components(
+    circuit: cirq.AbstractCircuit, qubits: Iterable[cirq.Qid]
+) -> List[List[cirq.Qid]]:
+    """Splits `qubits` and those of `circuit` into groups that never interact."""
+    # Maps qubits to their parent in a union-find forest.
+    parent: Dict[cirq.Qid, cirq.Qid] = {q: q for q in qubits}
+
+    def root(qubit: cirq.Qid) -> cirq.Qid:
+        parent.setdefault(qubit, qubit)
+        while parent[qubit] != qubit:
+            parent[qubit] = parent[parent[qubit]]
+            qubit = parent[qubit]
+        return qubit
+
+    for op in circuit.all_operations():
+        roots = [root(qubit) for qubit in op.qubits]
+        for r in roots[1:]:
+            parent[r] = roots[0]
+    components: Dict[cirq.Qid, List[cirq.Qid]] = {}
+    for qubit in list(parent):
+        components.setdefault(root(qubit), []).append(qubit)
+    return list(components.values())
+
+
+class _AppendedOp(NamedTuple):
+    """An operation appended to the circuit of a CirqBoard, see `CirqBoard._append`."""
+
+    moment_index: int
+    op: cirq.Operation
+    # Whether a new moment was created for the operation.
+    new_moment: bool
+
+
+class _CompiledCircuit(NamedTuple):
+    """The compilation of a CirqBoard circuit for its device.
+
+    `num_ops` is the number of appended operations that were compiled, or
+    -1 if nothing was compiled yet.  With a
+    `ConnectivityHeuristicCircuitTransformer`, `circuit` is `decomposed`
+    mapped with `mapping`.  Other transformers may add swaps, so `circuit`
+    is then the whole transformed circuit, including `measure_moment`.
+
+    `measured` is the circuit to run for `measure_moment`, see
+    `CirqBoard._device_circuit`.
+    """
+
+    num_ops: int
+    decomposed: cirq.Circuit
+    circuit: cirq.Circuit
+    mapping: Dict[cirq.Qid, cirq.GridQubit]
+    measure_moment: Optional[cirq.Moment] = None
+    measured: Optional[cirq.Circuit] = None
+
+
+_NOT_COMPILED = _CompiledCircuit(-1, cirq.Circuit(), cirq.Circuit(), {})
+
+
+def _append_earliest(circuit: cirq.Circuit, ops: cirq.Circuit) -> cirq.Circuit:
+    """Returns `circuit` followed by the operations of `ops`, packed earliest."""
+    circuit = circuit.copy()
+    circuit.append(ops.all_operations())
+    return circuit
+
+
+class _MoveSnapshot(NamedTuple):
+    """The state of a CirqBoard before a move, used to undo the move.
+
+    The circuit is restored by removing the operations appended after the
+    first `num_appended` ones of `appended_ops` (see `CirqBoard._append`).
+    """
+
+    state: int
+    circuit: cirq.Circuit
+    appended_ops: List[_AppendedOp]
+    num_appended: int
+    physical_qubits: Dict[cirq.Qid, cirq.Qid]
+    logical_qubits: Dict[cirq.Qid, cirq.Qid]
+    entangled_squares: Set[cirq.Qid]
+    post_selection: Dict[cirq.Qid, bool]
+    ancilla_count: int
+    allowed_pieces: Set[int]
+    compiled: _CompiledCircuit
+
 
 class CirqBoard:
     """Implementation of Quantum Board API using cirq sampler.
@@ -71,6 +206,11 @@ class CirqBoard:
     are then post-selected to retrieve samples that match board
     positions with the same measurements.
 
+    Internally, the circuit acts on "physical" qubits. Moving a qubit to
+    an ancilla (see `unhook`) only updates the table from qubits to
+    physical qubits instead of rewriting the whole circuit. The `circuit`
+    property shows the circuit in terms of the current qubits.
+
     Args:
         init_basis_state: 64-bit bitboard defining the initial
             classical state of the board.
@@ -87,6 +227,15 @@ class CirqBoard:
             to be considered not noise.
         transformer: The CircuitTransformer to use to convert the board's
             NamedQubit circuit into a GridQubit circuit.
+        exact: If True, square and board probabilities are computed from
+            the final state vector instead of by sampling. This needs a
+            `cirq.Simulator` as sampler and no device.
+        cache_size: Number of effects of moves on the probabilities of their
+            squares to keep, so that the probabilities after a move can be
+            computed without sampling the board. Zero disables the cache.
+        cache: The cache to store these effects in, such as a SqliteCache
+            shared with other boards. Defaults to an LRUCache of cache_size
+            entries.
     """
 
     def __init__(
@@ -100,9 +249,17 @@ class CirqBoard:
         noise_mitigation: float = 0.0,
         transformer: Optional[cirq.TRANSFORMER] = None,
         reset_starting_states=False,
+        exact: bool = False,
+        cache_size: int = 1024,
+        cache: Optional[ProbabilityCache] = None,
     ):
+        if exact and (device is not None or not isinstance(sampler, cirq.Simulator)):
+            raise ValueError(
+                "Exact probabilities need a cirq.Simulator sampler and no device"
+            )
         self.device = device
         self.sampler = sampler
+        self.exact = exact
         if device is not None:
             self.transformer = (
                 transformer or ct.ConnectivityHeuristicCircuitTransformer(device)
@@ -114,7 +271,7 @@ class CirqBoard:
         # Stores the repetition number if there is a cache.
         self.board_accumulations_repetitions = _NO_CACHE_AVAILABLE
 
-        self.cache: Dict[CacheKey, Dict[str, float]] = {}
+        self.cache = cache if cache is not None else LRUCache(cache_size)
 
         # Will only be turned on if user specifies
         self.reset_starting_states = reset_starting_states
@@ -141,13 +298,15 @@ class CirqBoard:
 
         if reset_move_history:
             self.move_history: List[move.Move] = []
+            # The state of the board before each move in the move history.
+            self._move_snapshots: List[_MoveSnapshot] = []
 
             # Store the initial basis state so that we can use it for replaying
             # the move-history when undoing moves
             self.init_basis_state = basis_state
             self.move_history_probabilities_cache = [
                 self._make_probability_history(
-                    _CACHE_ALWAYS_AVAILABLE, initial_square_probs
+                    _CACHE_ALWAYS_AVAILABLE, initial_square_probs, exact=True
                 )
             ]
 
@@ -155,6 +314,185 @@ class CirqBoard:
         self.timing_stats: Dict[str, List[float]] = defaultdict(list)
         return self
 
+    @property
+    def circuit(self) -> cirq.Circuit:
+        """The circuit of the board, acting on the current qubits.
+
+        After qubits were moved to ancillas, this is a new circuit built
+        from the internal one, so changes to it are not reflected in the
+        board.
+        """
+        if not self._logical_qubits:
+            return self._circuit
+        if self._logical_circuit is None:
+            self._logical_circuit = self._circuit.transform_qubits(
+                lambda q: self._logical_qubits.get(q, q)
+            )
+        return self._logical_circuit
+
+    @circuit.setter
+    def circuit(self, circuit: cirq.Circuit) -> None:
+        self._circuit = circuit
+        # Maps the current qubits to the physical qubits that the circuit
+        # acts on, and back. Qubits that map to themselves are left out.
+        self._physical_qubits: Dict[cirq.Qid, cirq.Qid] = {}
+        self._logical_qubits: Dict[cirq.Qid, cirq.Qid] = {}
+        # Cache of the `circuit` property.
+        self._logical_circuit: Optional[cirq.Circuit] = None
+        # The operations appended to the circuit, in order.
+        self._appended_ops: List[_AppendedOp] = []
+        # The circuits returned by `_light_cone`, by the measured qubits.
+        self._light_cones: Dict[FrozenSet[cirq.Qid], cirq.Circuit] = {}
+        # Compilation of the circuit for the device, see `_device_circuit`.
+        self._compiled = _NOT_COMPILED
+
+    def _physical_qubit(self, qubit: cirq.Qid) -> cirq.Qid:
+        """Returns the physical qubit that currently represents `qubit`."""
+        return self._physical_qubits.get(qubit, qubit)
+
+    def _append(self, op_tree: cirq.OP_TREE) -> None:
+        """Appends operations on the current qubits to the circuit.
+
+        Each operation is inserted in the earliest moment that it fits in,
+        and where it was inserted is recorded, so that it can be removed
+        again when undoing a move (see `_restore`).
+        """
+        for op in cirq.flatten_to_ops(op_tree):
+            if self._physical_qubits:
+                op = op.transform_qubits(self._physical_qubit)
+            num_moments = len(self._circuit)
+            self._circuit.append(op)
+            if len(self._circuit) > num_moments:
+                self._appended_ops.append(_AppendedOp(num_moments, op, True))
+            else:
+                moment_index = self._circuit.prev_moment_operating_on(op.qubits)
+                self._appended_ops.append(_AppendedOp(moment_index, op, False))
+        self._logical_circuit = None
+        self._light_cones.clear()
+
+    def _light_cone(self, physical_qubits: Iterable[cirq.Qid]) -> cirq.Circuit:
+        """Returns the part of the circuit that affects the given physical qubits.
+
+        The result is cached until the circuit changes.
+        """
+        physical_qubits = frozenset(physical_qubits)
+        if physical_qubits not in self._light_cones:
+            self._light_cones[physical_qubits] = backward_light_cone(
+                self._circuit, physical_qubits
+            )
+        return self._light_cones[physical_qubits]
+
+    def _validate(self, circuit: cirq.Circuit) -> None:
+        """Checks that a compiled circuit can run on the device."""
+        # For debug, ensure that the circuit correctly validates
+        try:
+            self.device.validate_circuit(circuit)
+        except ValueError as e:
+            raise ct.DeviceMappingError(str(e))
+
+    def _device_circuit(self, measure_moment: cirq.Moment) -> cirq.Circuit:
+        """Returns the circuit followed by a measurement, compiled for the device.
+
+        The compilation is kept and only the operations appended since the
+        last call are decomposed into sqrt-iSWAP gates, mapped onto the
+        device with the existing mapping and validated.  The whole circuit is
+        only mapped again when the new qubits do not fit.  The result is
+        kept until the circuit or the measurement change.
+        """
+        compiled = self._compiled
+        num_ops = len(self._appended_ops)
+        if compiled.num_ops == num_ops and compiled.measure_moment == measure_moment:
+            return compiled.measured
+        decomposed = compiled.decomposed
+        new_moments = cirq.Circuit()
+        if compiled.num_ops < num_ops:
+            if compiled.num_ops < 0:
+                ops = self._circuit
+            else:
+                ops = cirq.Circuit(
+                    record.op for record in self._appended_ops[compiled.num_ops :]
+                )
+            # Decompose 3-qubit operations
+            new_moments = ct.decompose_into_sqrt_iswap(ops)
+            decomposed = _append_earliest(decomposed, new_moments)
+        if not isinstance(self.transformer, ct.ConnectivityHeuristicCircuitTransformer):
+            circuit = self.transformer(decomposed + measure_moment)
+            self._validate(circuit)
+            self._compiled = _CompiledCircuit(
+                num_ops, decomposed, circuit, {}, measure_moment, circuit
+            )
+            return circuit
+
+        mapping = self.transformer.extend_mapping(
+            new_moments + measure_moment, compiled.mapping
+        )
+        if mapping is None:
+            # Create NamedQubit to GridQubit mapping and transform
+            self.transformer.qubit_mapping(decomposed + measure_moment)
+            mapping = dict(self.transformer.mapping)
+            circuit = decomposed.transform_qubits(mapping.__getitem__)
+            self._validate(circuit)
+        elif new_moments:
+            new_moments = new_moments.transform_qubits(mapping.__getitem__)
+            self._validate(new_moments)
+            circuit = _append_earliest(compiled.circuit, new_moments)
+        else:
+            circuit = compiled.circuit
+        mapped_moment = measure_moment.transform_qubits(mapping.__getitem__)
+        self._validate(cirq.Circuit(mapped_moment))
+        # Qubits that are not measured do not need to be simulated.
+        measured = backward_light_cone(circuit, mapped_moment.qubits) + mapped_moment
+        self._compiled = _CompiledCircuit(
+            num_ops, decomposed, circuit, mapping, measure_moment, measured
+        )
+        return measured
+
+    def _snapshot(self) -> _MoveSnapshot:
+        """Records the state of the board, see `_restore`."""
+        return _MoveSnapshot(
+            state=self.state,
+            circuit=self._circuit,
+            appended_ops=self._appended_ops,
+            num_appended=len(self._appended_ops),
+            physical_qubits=self._physical_qubits.copy(),
+            logical_qubits=self._logical_qubits.copy(),
+            entangled_squares=self.entangled_squares.copy(),
+            post_selection=self.post_selection.copy(),
+            ancilla_count=self.ancilla_count,
+            allowed_pieces=self.allowed_pieces.copy(),
+            compiled=self._compiled,
+        )
+
+    def _restore(self, snapshot: _MoveSnapshot) -> None:
+        """Returns the board to the state recorded by `_snapshot`."""
+        self.state = snapshot.state
+        compiled = snapshot.compiled
+        if (
+            snapshot.circuit is self._circuit
+            and compiled.num_ops < self._compiled.num_ops <= snapshot.num_appended
+        ):
+            # The operations compiled since the snapshot are all kept.
+            compiled = self._compiled
+        self.circuit = snapshot.circuit
+        self._appended_ops = snapshot.appended_ops
+        while len(self._appended_ops) > snapshot.num_appended:
+            record = self._appended_ops.pop()
+            if record.new_moment:
+                del self._circuit[record.moment_index]
+            else:
+                moment = self._circuit[record.moment_index]
+                self._circuit[record.moment_index] = moment.without_operations_touching(
+                    record.op.qubits
+                )
+        self._compiled = compiled
+        self._physical_qubits = snapshot.physical_qubits
+        self._logical_qubits = snapshot.logical_qubits
+        self.entangled_squares = snapshot.entangled_squares
+        self.post_selection = snapshot.post_selection
+        self.ancilla_count = snapshot.ancilla_count
+        self.allowed_pieces = snapshot.allowed_pieces
+        self.board_accumulations_repetitions = _NO_CACHE_AVAILABLE
+
     def clear_debug_log(self) -> None:
         """Clears debug log."""
         self.debug_log = ""
@@ -190,19 +528,17 @@ class CirqBoard:
     def undo_last_move(self) -> bool:
         """Undoes the last move.
 
-        Instead of undoing the last move, this function resets
-        the board to the initial state and replays the move history
-
+        The board is restored from the snapshot taken before the last
+        move, so the earlier moves are not replayed and their measurement
+        outcomes are kept. Without any moves, the board is reset to the
+        initial state.
         """
-        # Store current move history...
-        current_move_history = self.move_history.copy()
-        # ...because we'll be resetting it here
-        self.with_state(self.init_basis_state, True)
-
-        # Repeat history up to last move
-        for m in range(len(current_move_history) - 1):
-            if not self.do_move(current_move_history[m]):
-                return False
+        if not self.move_history:
+            self.with_state(self.init_basis_state, True)
+            return True
+        self._restore(self._move_snapshots.pop())
+        self.move_history.pop()
+        self.move_history_probabilities_cache.pop()
         return True
 
     def record_time(self, action: str, t0: float, t1: Optional[float] = None) -> None:
@@ -231,28 +567,42 @@ class CirqBoard:
             sample_size = 100
         return sample_size
 
-    def _calculate_bitboards_from_measurements(self, data: pandas.DataFrame):
-        """Calculates bitboards given sample results and stores them in the DataFrame.
+    def _bitboards_from_measurements(
+        self, measurements: Dict[str, np.ndarray]
+    ) -> np.ndarray:
+        """Packs the measured squares of each repetition into a 64-bit bitboard.
 
-        The bitboard masked with 0x00000000FFFFFFFF is stored in a new column 'bb_low'
-        and the bitboard masked with 0xFFFFFFFF00000000 in 'bb_high'. It must be split
-        in this way because the vectorized operations only work with double floats which
-        have 53 bits of precision.
+        `measurements` maps the name of each measured qubit to its results,
+        one per repetition. Squares that are not entangled are taken from
+        the classical state of the board.
         """
-        # Construct expressions for vectorized evaluation of the board position.
-        # For example, if there are entangled pieces on a1 and e1 and a non-entangled
-        # piece on c1 then bitboard_exprs[0] is "a1 * 1.0 + e1 * 32.0 + 4.0"
-        bitboard_exprs = ["", ""]
-        classical_state = self.state
-        for qubit in self.entangled_squares:
-            if "anc" not in qubit.name:
-                bit = qubit_to_bit(qubit)
-                bitboard_exprs[bit // 32] += f"{qubit.name} * {1 << bit}.0 +"
-                classical_state &= ~(1 << bit)
-        bitboard_exprs[0] += str(classical_state & 0x00000000FFFFFFFF) + ".0"
-        bitboard_exprs[1] += str(classical_state & 0xFFFFFFFF00000000) + ".0"
-        # Store evaluated position in bb_low and bb_high columns
-        data.eval("bb_low = {}\nbb_high = {}".format(*bitboard_exprs), inplace=True)
+        bits = [
+            qubit_to_bit(qubit)
+            for qubit in self.entangled_squares
+            if "anc" not in qubit.name
+        ]
+        num_reps = len(next(iter(measurements.values())))
+        bitboards = np.full(num_reps, self._classical_bitboard(), dtype=np.uint64)
+        for bit in bits:
+            square = measurements[bit_to_square(bit)].astype(np.uint64)
+            bitboards |= square << np.uint64(bit)
+        return bitboards
+
+    @staticmethod
+    def _noise_mask(samples: np.ndarray, noise_threshold: float) -> np.ndarray:
+        """Marks the samples that are still considered noise.
+
+        A sample is noise if it has been seen, counting this one, fewer
+        than noise_threshold times among the samples before it.
+        """
+        _, inverse, counts = np.unique(samples, return_inverse=True, return_counts=True)
+        # Number the repeats of each sample in order of appearance.
+        order = np.argsort(inverse, kind="stable")
+        occurrence = np.empty(len(samples), dtype=np.int64)
+        occurrence[order] = np.arange(1, len(samples) + 1) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        return occurrence < noise_threshold
 
     def sample_with_ancilla(
         self,
@@ -274,15 +624,16 @@ class CirqBoard:
         t0 = time.perf_counter()
         if num_reps is None:
             num_reps = self.suggest_num_reps(num_samples)
-        measure_circuit = self.circuit.copy()
         ancilla = []
         error_count = 0
         noise_count = 0
         post_count = 0
         if self.entangled_squares:
             qubits = sorted(self.entangled_squares)
-            measure_moment = cirq.Moment(cirq.measure(q, key=q.name) for q in qubits)
-            measure_circuit.append(measure_moment)
+            physical_qubits = [self._physical_qubit(q) for q in qubits]
+            measure_moment = cirq.Moment(
+                cirq.measure(p, key=q.name) for p, q in zip(physical_qubits, qubits)
+            )
 
             noise_threshold = self.noise_mitigation * num_samples
 
@@ -293,73 +644,78 @@ class CirqBoard:
 
             # Translate circuit to grid qubits and sqrtISWAP gates
             if self.device is not None:
-                # Decompose 3-qubit operations
-                measure_circuit = ct.decompose_into_sqrt_iswap(measure_circuit)
-                # Create NamedQubit to GridQubit mapping and transform
-                measure_circuit = self.transformer(measure_circuit)
-
-                # For debug, ensure that the circuit correctly validates
-                try:
-                    self.device.validate_circuit(measure_circuit)
-                except ValueError as e:
-                    raise ct.DeviceMappingError(str(e))
+                measure_circuit = self._device_circuit(measure_moment)
+            else:
+                # Only simulate the operations that affect the measured qubits.
+                measure_circuit = self._light_cone(physical_qubits) + measure_moment
 
             # Run the circuit using the provided sampler (simulator or hardware)
             results = self.sampler.run(measure_circuit, repetitions=num_reps)
 
             # Parse the results
-            rtn = []
-            noise_buffer = {}
-            data = results.data
+            measurements = {
+                key: values[:, 0] for key, values in results.measurements.items()
+            }
 
             # Discard any results that disagree with our pre-defined
             # post-selection criteria
-            if self.post_selection:
-                data.query(
-                    "&".join(
-                        f"{qubit.name} == {val}"
-                        for qubit, val in self.post_selection.items()
-                    ),
-                    inplace=True,
-                )
-                post_count = num_reps - len(data)
-
-            self._calculate_bitboards_from_measurements(data)
-            ancilla_dict = data.filter(like="anc").to_dict("index")
-
-            for rep in data.index:
-                new_sample = int(data.at[rep, "bb_low"]) | int(data.at[rep, "bb_high"])
-
-                # Perform Error Mitigation
-                if self.error_mitigation != enums.ErrorMitigation.Nothing:
-                    # Discard boards that have the wrong number of pieces
-                    if num_ones(new_sample) not in self.allowed_pieces:
-                        if self.error_mitigation == enums.ErrorMitigation.Error:
-                            raise ValueError(
-                                "Error detected, "
-                                f"pieces allowed = {self.allowed_pieces}"
-                                f"but got {num_ones(new_sample)}"
-                            )
-                        if self.error_mitigation == enums.ErrorMitigation.Correct:
-                            error_count += 1
-                            continue
-
-                # Noise mitigation
-                if self.noise_mitigation > 0.0:
-                    # Ignore samples up to a threshold
-                    if new_sample not in noise_buffer:
-                        noise_buffer[new_sample] = 0
-                    noise_buffer[new_sample] += 1
-                    if noise_buffer[new_sample] < noise_threshold:
-                        noise_count += 1
-                        continue
-
-                # This sample has passed noise and error mitigation
-                # Record it as a proper sample
-                rtn.append(new_sample)
-                ancilla.append(ancilla_dict[rep])
-                if len(rtn) >= num_samples:
-                    break
+            selected = np.ones(num_reps, dtype=bool)
+            for qubit, val in self.post_selection.items():
+                selected &= measurements[qubit.name] == val
+            reps = np.flatnonzero(selected)
+            post_count = num_reps - len(reps)
+
+            samples = self._bitboards_from_measurements(measurements)[reps]
+            accepted = np.ones(len(samples), dtype=bool)
+
+            # Perform Error Mitigation
+            # Find boards that have the wrong number of pieces
+            wrong_count = np.zeros(len(samples), dtype=bool)
+            if self.error_mitigation != enums.ErrorMitigation.Nothing:
+                piece_counts = num_ones_array(samples)
+                wrong_count = ~np.isin(piece_counts, list(self.allowed_pieces))
+                if self.error_mitigation == enums.ErrorMitigation.Correct:
+                    accepted &= ~wrong_count
+
+            # Noise mitigation
+            # Ignore samples up to a threshold
+            noise = np.zeros(len(samples), dtype=bool)
+            if self.noise_mitigation > 0.0:
+                noise[accepted] = self._noise_mask(samples[accepted], noise_threshold)
+                accepted &= ~noise
+
+            # Only the first num_samples samples that passed noise and error
+            # mitigation are needed
+            accepted_reps = np.flatnonzero(accepted)
+            if len(accepted_reps) >= num_samples:
+                end = accepted_reps[num_samples - 1] + 1 if num_samples > 0 else 0
+                accepted_reps = accepted_reps[:num_samples]
+            else:
+                end = len(samples)
+
+            if self.error_mitigation == enums.ErrorMitigation.Error:
+                errors = np.flatnonzero(wrong_count[:end])
+                if len(errors):
+                    raise ValueError(
+                        "Error detected, "
+                        f"pieces allowed = {self.allowed_pieces}"
+                        f"but got {piece_counts[errors[0]]}"
+                    )
+            if self.error_mitigation == enums.ErrorMitigation.Correct:
+                error_count = int(np.count_nonzero(wrong_count[:end]))
+            noise_count = int(np.count_nonzero(noise[:end]))
+
+            # Record the samples that passed as proper samples
+            rtn = samples[accepted_reps].tolist()
+            ancilla_names = [q.name for q in qubits if "anc" in q.name]
+            ancilla_values = {
+                name: measurements[name][reps[accepted_reps]].tolist()
+                for name in ancilla_names
+            }
+            ancilla = [
+                {name: int(values[i]) for name, values in ancilla_values.items()}
+                for i in range(len(rtn))
+            ]
         else:
             rtn = [self.state] * num_samples
 
@@ -385,7 +741,7 @@ class CirqBoard:
         return rtn[:num_samples]
 
     def _make_probability_history(
-        self, repetitions: int, probabilities: Sequence[float]
+        self, repetitions: int, probabilities: Sequence[float], exact: bool = False
     ) -> ProbabilityHistory:
         probabilities = tuple(probabilities)
         full_squares = 0
@@ -400,39 +756,158 @@ class CirqBoard:
             probabilities=probabilities,
             full_squares=full_squares,
             empty_squares=empty_squares,
+            exact=exact,
+        )
+
+    def _exact_component_distributions(self) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Computes the distributions of the independent parts of the board.
+
+        The squares in superposition are split into components that never
+        interacted. The state vector of each component is computed
+        separately, only from the operations that affect its squares or
+        post-selected ancillas. Outcomes that disagree with the
+        post-selection criteria are left out and the remaining
+        probabilities are renormalized. Ancillas that are not post-selected
+        are summed out.
+
+        Returns:
+            For each component, the bitboards of its squares (the other
+            squares are empty) that have nonzero probability and their
+            probabilities.
+
+        Raises:
+            ValueError: if the post-selection criteria are impossible, or if
+                a component is too large to compute its state vector.
+        """
+        squares = {q for q in self.entangled_squares if "anc" not in q.name}
+        measured = {self._physical_qubit(q): q for q in squares}
+        measured.update((self._physical_qubit(q), q) for q in self.post_selection)
+        cone = self._light_cone(measured)
+        distributions = []
+        for component in _qubit_components(cone, measured):
+            if len(component) > _MAX_EXACT_QUBITS:
+                raise ValueError(
+                    f"Exact probabilities need the state of {len(component)} "
+                    f"entangled qubits, more than the limit of {_MAX_EXACT_QUBITS}. "
+                    "Use exact=False to sample instead."
+                )
+            qubits = [measured[p] for p in component if p in measured]
+            physical_qubits = [self._physical_qubit(q) for q in qubits]
+            qubit_set = set(component)
+            # Zero-qubit operations such as global phases do not belong to
+            # any component.
+            circuit = cirq.Circuit(
+                op
+                for op in cone.all_operations()
+                if op.qubits and op.qubits[0] in qubit_set
+            )
+            if circuit:
+                result = self.sampler.simulate(
+                    circuit,
+                    qubit_order=cirq.QubitOrder.explicit(
+                        physical_qubits, fallback=cirq.QubitOrder.DEFAULT
+                    ),
+                )
+                # Sum out the qubits that are not measured.
+                probs = np.abs(result.final_state_vector) ** 2
+                probs = probs.reshape(1 << len(qubits), -1).sum(axis=1)
+            else:
+                probs = np.zeros(1 << len(qubits))
+                probs[0] = 1.0
+
+            outcomes = np.arange(len(probs))
+            shifts = {q: len(qubits) - 1 - i for i, q in enumerate(qubits)}
+            selected = np.ones(len(probs), dtype=bool)
+            for qubit in qubits:
+                if qubit in self.post_selection:
+                    value = (outcomes >> shifts[qubit]) & 1
+                    selected &= value == self.post_selection[qubit]
+            total = probs[selected].sum()
+            if total <= _EXACT_TOLERANCE:
+                raise ValueError("The post-selection criteria are impossible.")
+            (support,) = np.nonzero(selected & (probs > _EXACT_TOLERANCE * total))
+            boards = np.zeros(len(support), dtype=np.uint64)
+            for qubit in qubits:
+                if qubit in squares:
+                    value = ((support >> shifts[qubit]) & 1).astype(np.uint64)
+                    boards |= value << np.uint64(qubit_to_bit(qubit))
+            boards, inverse = np.unique(boards, return_inverse=True)
+            board_probs = np.bincount(
+                inverse, weights=probs[support] / probs[support].sum()
+            )
+            distributions.append((boards, board_probs))
+        return distributions
+
+    def _classical_bitboard(self) -> int:
+        """Returns the bitboard of the full squares that are not entangled."""
+        classical_state = self.state
+        for qubit in self.entangled_squares:
+            if "anc" not in qubit.name:
+                classical_state &= ~(1 << qubit_to_bit(qubit))
+        return classical_state
+
+    def _exact_board_distribution(self) -> Dict[int, float]:
+        """Computes the probability of each board from the state vectors.
+
+        The components of the board are independent (see
+        `_exact_component_distributions`), so the probability of a board is
+        the product of the probabilities of its parts.
+        """
+        boards = np.array([self._classical_bitboard()], dtype=np.uint64)
+        probs = np.ones(1)
+        for component_boards, component_probs in self._exact_component_distributions():
+            boards = (boards[:, np.newaxis] | component_boards).reshape(-1)
+            probs = np.outer(probs, component_probs).reshape(-1)
+        return dict(zip(boards.tolist(), probs.tolist()))
+
+    def _generate_exact_accumulations(self) -> None:
+        """Computes the exact probability of each square.
+
+        The square probabilities are stored in the move history cache, marked
+        as exact. They are computed from each component separately, without
+        the probabilities of the whole boards.
+        """
+        classical_state = self._classical_bitboard()
+        probabilities = [float(nth_bit_of(i, classical_state)) for i in range(64)]
+        for boards, probs in self._exact_component_distributions():
+            for bit in bit_ones(int(np.bitwise_or.reduce(boards))):
+                occupied = (boards >> np.uint64(bit)) & np.uint64(1) == 1
+                probabilities[bit] = float(probs[occupied].sum())
+        probabilities = [1.0 if p > 1 - _EXACT_TOLERANCE else p for p in probabilities]
+        self.move_history_probabilities_cache[-1] = self._make_probability_history(
+            _CACHE_ALWAYS_AVAILABLE, probabilities, exact=True
         )
 
     def _generate_accumulations(self, repetitions: int = 1000) -> None:
         """Samples the state and generates the accumulated
         probabilities of each square, empty_squares, and full_squares.
+
+        In exact mode, the probabilities are computed from the state instead.
         """
+        if self.exact:
+            if not self.move_history_probabilities_cache[-1].exact:
+                self._generate_exact_accumulations()
+            return
         if self.move_history_probabilities_cache[-1].repetitions >= repetitions:
             return
 
-        if len(self.move_history) > 0:
+        if len(self.move_history) > 0 and self.cache.maxsize != 0:
             last_move = self.move_history[-1]
-            previous_move_in_cache = (
-                self.move_history_probabilities_cache[-2].repetitions >= repetitions
-            )
-            cache_key = cache_key_from_move(last_move, repetitions)
-            if (
-                previous_move_in_cache
-                and self._caching_supported(last_move)
-                and cache_key in self.cache
-            ):
-                previous_probability = self.move_history_probabilities_cache[
-                    -2
-                ].probabilities
-
-                probs = self._apply_cache(
-                    previous_probability, last_move, self.cache[cache_key]
-                )
-                self.move_history_probabilities_cache[-1] = (
-                    self._make_probability_history(repetitions, probs)
-                )
-                # Remove entry from cached since it has been consumed.
-                del self.cache[cache_key]
-                return
+            previous = self.move_history_probabilities_cache[-2]
+            if previous.repetitions >= repetitions:
+                cache_key = self._transform_cache_key(last_move, previous, repetitions)
+                if cache_key is not None:
+                    cache_value = self.cache.get(cache_key)
+                    if cache_value is None:
+                        cache_value = self._local_transform(last_move, cache_key)
+                        self.cache[cache_key] = cache_value
+                    probs = self._apply_cache(
+                        previous.probabilities, last_move, cache_key, cache_value
+                    )
+                    self.move_history_probabilities_cache[-1] = (
+                        self._make_probability_history(repetitions, probs)
+                    )
+                    return
 
         probabilities = [0.0] * 64
         samples = self.sample(repetitions)
@@ -446,55 +921,161 @@ class CirqBoard:
             repetitions, probabilities
         )
 
-    def _caching_supported(self, m: move.Move):
-        """Checks if caching is supported for this move."""
-        last_probs = self.move_history_probabilities_cache[-2]
-        # Caching is supported for a split jump from one full square to two empty squares.
-        if (
-            m.move_type == enums.MoveType.SPLIT_JUMP
-            and m.target2
-            and nth_bit_of(square_to_bit(m.source), last_probs.full_squares)
-            and nth_bit_of(square_to_bit(m.target), last_probs.empty_squares)
-            and nth_bit_of(square_to_bit(m.target2), last_probs.empty_squares)
+    @property
+    def sampler_identity(self) -> str:
+        """Describes the sampler and settings that the probabilities depend on.
+
+        Cached effects of moves are only shared by boards with the same
+        description. This follows changes to the sampler, device and
+        mitigation settings of the board.
+        """
+        sampler_type = type(self.sampler)
+        parts = [f"{sampler_type.__module__}.{sampler_type.__qualname__}"]
+        noise = getattr(self.sampler, "noise", cirq.NO_NOISE)
+        if noise != cirq.NO_NOISE:
+            parts.append(repr(noise))
+        if self.device is not None:
+            device = repr(self.device).encode()
+            parts.append(f"device={hashlib.sha256(device).hexdigest()[:16]}")
+        parts.append(f"error_mitigation={self.error_mitigation}")
+        parts.append(f"noise_mitigation={self.noise_mitigation}")
+        if self.exact:
+            parts.append("exact")
+        return ";".join(parts)
+
+    def _transform_paths(self, m: move.Move) -> List[List[int]]:
+        """Returns the bits of the squares along each path of a sliding move."""
+        if m.move_type in (enums.MoveType.SLIDE, enums.MoveType.PAWN_TWO_STEP):
+            return [self._path_bits(m.source, m.target)]
+        if m.move_type == enums.MoveType.SPLIT_SLIDE:
+            return [
+                self._path_bits(m.source, m.target),
+                self._path_bits(m.source, m.target2),  # type: ignore
+            ]
+        if m.move_type == enums.MoveType.MERGE_SLIDE:
+            return [
+                self._path_bits(m.source, m.target),
+                self._path_bits(m.source2, m.target),  # type: ignore
+            ]
+        return []
+
+    def _transform_cache_key(
+        self, m: move.Move, probs: ProbabilityHistory, repetitions: int
+    ) -> Optional[CacheKey]:
+        """Returns the key of the effect of move `m` on the probabilities.
+
+        The key is made of the move type and variant and the occupancy of the
+        squares of the move (and its paths) in `probs`, the probabilities
+        before the move. Returns None if the effect of the move cannot be
+        computed from these squares alone.
+
+        This is the case if all squares are known to be empty or full, since
+        the outcome of any measurement is then known. Otherwise, only the
+        source may be in superposition, for basic moves to empty squares that
+        do not measure anything. Such moves only carry over the probability
+        of the source.
+        """
+        if m.move_type not in _TRANSFORM_CACHE_MOVE_TYPES or m.measurement is not None:
+            return None
+
+        def occupancy(bit: int) -> Occupancy:
+            if nth_bit_of(bit, probs.full_squares):
+                return Occupancy.FULL
+            if nth_bit_of(bit, probs.empty_squares):
+                return Occupancy.EMPTY
+            return Occupancy.QUANTUM
+
+        squares = tuple(
+            occupancy(square_to_bit(getattr(m, role)))
+            for role in _TRANSFORM_ROLES
+            if getattr(m, role)
+        )
+        paths = tuple(
+            tuple(occupancy(bit) for bit in path) for path in self._transform_paths(m)
+        )
+        others = squares[1:] + sum(paths, ())
+        if Occupancy.QUANTUM in others:
+            return None
+        if squares[0] == Occupancy.QUANTUM and (
+            m.move_variant != enums.MoveVariant.BASIC
+            or m.move_type in _NONLOCAL_SOURCE_MOVE_TYPES
+            or Occupancy.FULL in others
         ):
-            return True
-        return False
+            return None
+        return cache_key_from_move(
+            m, repetitions, squares, paths, self.sampler_identity
+        )
 
-    def cache_results(self, cache_key: CacheKey):
-        if cache_key in self.cache:
-            return
-        if cache_key.move_type == enums.MoveType.SPLIT_JUMP:
-            helper_board = CirqBoard(
-                DEFAULT_CHESS_INIT_STATE,
-                self.sampler,
-                self.device,
-                self.error_mitigation,
-                self.noise_mitigation,
-                self.transformer if self.device else None,
-                reset_starting_states=False,
-            )
-            sample_jump_move = move.Move(
-                "b1",
-                "c3",
-                target2="a3",
-                move_type=enums.MoveType.SPLIT_JUMP,
-                move_variant=enums.MoveVariant.BASIC,
-            )
-            helper_board.do_move(sample_jump_move)
-            probs = helper_board.get_probability_distribution(cache_key.repetitions)
-            self.cache[cache_key] = {
-                "source": 0,
-                "target": probs[square_to_bit(sample_jump_move.target)],
-                "target2": probs[square_to_bit(sample_jump_move.target2)],  # type: ignore
-            }
-            self.debug_log += helper_board.debug_log
+    def _local_transform(self, m: move.Move, cache_key: CacheKey) -> Dict[str, float]:
+        """Computes the effect of move `m` on the probabilities of its squares.
+
+        Simulates the move on a board with only the full squares of
+        `cache_key`, where a source in superposition is full.
+
+        Returns a dictionary from the attributes of the move naming the
+        squares (such as "target") to their probability after the move.
+        """
+        state = 0
+        bits = [
+            square_to_bit(getattr(m, role))
+            for role in _TRANSFORM_ROLES
+            if getattr(m, role)
+        ]
+        for bit, occupied in zip(bits, cache_key.squares):
+            if occupied != Occupancy.EMPTY:
+                state = set_nth_bit(bit, state, True)
+        for path, path_occupancy in zip(self._transform_paths(m), cache_key.paths):
+            for bit, occupied in zip(path, path_occupancy):
+                if occupied == Occupancy.FULL:
+                    state = set_nth_bit(bit, state, True)
+        helper_board = CirqBoard(
+            state,
+            self.sampler,
+            self.device,
+            self.error_mitigation,
+            self.noise_mitigation,
+            self.transformer if self.device else None,
+            reset_starting_states=False,
+            exact=self.exact,
+            cache_size=0,
+        )
+        helper_board.do_move(copy.copy(m))
+        probs = helper_board.get_probability_distribution(cache_key.repetitions)
+        self.debug_log += helper_board.debug_log
+        return {
+            role: probs[square_to_bit(getattr(m, role))]
+            for role in _TRANSFORM_ROLES
+            if getattr(m, role)
+        }
+
+    def cache_results(self, m: move.Move, repetitions: int) -> Optional[CacheKey]:
+        """Computes the effect of move `m` from the current position in advance.
+
+        The result is stored in the cache, so that the probabilities after
+        performing the move can be computed without sampling the board.
+
+        Returns the key of the result, or None if the effect of the move
+        cannot be cached (see `_transform_cache_key`).
+        """
+        self._generate_accumulations(repetitions)
+        cache_key = self._transform_cache_key(
+            m, self.move_history_probabilities_cache[-1], repetitions
+        )
+        if cache_key is not None and self.cache.get(cache_key) is None:
+            self.cache[cache_key] = self._local_transform(m, cache_key)
+        return cache_key
 
     @staticmethod
-    def _apply_cache(probability, m, cache_value):
+    def _apply_cache(probability, m, cache_key, cache_value):
+        """Applies the effect of move `m` to the probabilities before it."""
         new_probability = list(probability)
+        # Moves of a source in superposition carry over its probability.
+        scale = 1.0
+        if cache_key.squares[0] == Occupancy.QUANTUM:
+            scale = probability[square_to_bit(m.source)]
         for k, v in cache_value.items():
             square = getattr(m, k)
-            new_probability[square_to_bit(square)] = v
+            new_probability[square_to_bit(square)] = v * scale
         return new_probability
 
     def get_probability_distribution(self, repetitions: int = 1000) -> Sequence[float]:
@@ -509,6 +1090,10 @@ class CirqBoard:
         """Samples the state and generates the accumulated probabilities of each board
         in the state, which will be saved as a map(board->prob.) in self.board_probabilities.
         """
+        if self.exact:
+            self.board_probabilities = self._exact_board_distribution()
+            self.board_accumulations_repetitions = _CACHE_ALWAYS_AVAILABLE
+            return
         self.board_probabilities: Dict[int, float] = {}
 
         samples = self.sample(repetitions)
@@ -582,7 +1167,7 @@ class CirqBoard:
             if qubit not in self.entangled_squares:
                 self.entangled_squares.add(qubit)
                 if nth_bit_of(qubit_to_bit(qubit), self.state):
-                    self.circuit.append(qm.place_piece(qubit))
+                    self._append(qm.place_piece(qubit))
 
     def new_ancilla(self, note: str = "") -> cirq.NamedQubit:
         """Adds a new ancilla to the circuit and returns its value.
@@ -609,27 +1194,28 @@ class CirqBoard:
         # Create a new ancilla qubit to replace the qubit with
         new_qubit = self.new_ancilla(note=qubit.name)
 
-        # Replace operations using the qubit with the ancilla instead
-        self.circuit = self.circuit.transform_qubits(
-            lambda q: new_qubit if q == qubit else q
-        )
+        # Let the ancilla take over the physical qubit, so that it replaces the
+        # qubit in all previous operations. The qubit continues on the unused
+        # physical qubit of the ancilla.
+        physical_qubit = self._physical_qubit(qubit)
+        self._physical_qubits[new_qubit] = physical_qubit
+        self._logical_qubits[physical_qubit] = new_qubit
+        self._physical_qubits[qubit] = new_qubit
+        self._logical_qubits[new_qubit] = qubit
+        self._logical_circuit = None
 
         # Remove the qubit from the list of active qubits
         self.entangled_squares.remove(qubit)
         self.entangled_squares.add(new_qubit)
         return new_qubit
 
-    def path_qubits(self, source: str, target: str) -> List[cirq.NamedQubit]:
-        """Returns all entangled qubits (or classical pieces)
-        between source and target.
+    @staticmethod
+    def _path_bits(source: str, target: str) -> List[int]:
+        """Returns the bits of all squares between source and target.
 
         Source and target should be in the same line, i.e. same row,
         same column, or same diagonal.
-
-        Source and target should be specified in algebraic notation,
-        such as 'f4'.
         """
-        rtn = []
         xs = move.x_of(source)
         ys = move.y_of(source)
         xt = move.x_of(target)
@@ -655,8 +1241,20 @@ class CirqBoard:
             )
         max_slide = max(x_slide, y_slide)
         # Only calculates path when max_slide > 1.
-        for t in range(1, max_slide):
-            path_bit = xy_to_bit(xs + dx * t, ys + dy * t)
+        return [xy_to_bit(xs + dx * t, ys + dy * t) for t in range(1, max_slide)]
+
+    def path_qubits(self, source: str, target: str) -> List[cirq.NamedQubit]:
+        """Returns all entangled qubits (or classical pieces)
+        between source and target.
+
+        Source and target should be in the same line, i.e. same row,
+        same column, or same diagonal.
+
+        Source and target should be specified in algebraic notation,
+        such as 'f4'.
+        """
+        rtn = []
+        for path_bit in self._path_bits(source, target):
             path_qubit = bit_to_qubit(path_bit)
             if path_qubit in self.entangled_squares or nth_bit_of(path_bit, self.state):
                 rtn.append(path_qubit)
@@ -673,9 +1271,7 @@ class CirqBoard:
                 qubit_to_bit(q), self.state
             ):
                 return path_ancilla
-        self.circuit.append(
-            qm.controlled_operation(cirq.X, [path_ancilla], [], path_qubits)
-        )
+        self._append(qm.controlled_operation(cirq.X, [path_ancilla], [], path_qubits))
         return path_ancilla
 
     def _clear_path_ancilla(self, path_qubits, ancilla):
@@ -688,7 +1284,7 @@ class CirqBoard:
                 qubit_to_bit(q), self.state
             ):
                 return
-        self.circuit.append(qm.controlled_operation(cirq.X, [ancilla], [], path_qubits))
+        self._append(qm.controlled_operation(cirq.X, [ancilla], [], path_qubits))
 
     def set_castle(self, sbit: int, rook_sbit: int, tbit: int, rook_tbit: int) -> None:
         """Adjusts classical bits for a castling operation."""
@@ -726,7 +1322,7 @@ class CirqBoard:
             self.state = set_nth_bit(sbit, self.state, False)
             self.state = set_nth_bit(tbit, self.state, True)
             self.add_entangled(rook_squbit, rook_tqubit)
-            self.circuit.append(qm.normal_move(rook_squbit, rook_tqubit))
+            self._append(qm.normal_move(rook_squbit, rook_tqubit))
             return 1
 
         # EXCLUDED is used when either of the king target and rook target
@@ -832,6 +1428,7 @@ class CirqBoard:
         self.board_accumulations_repetitions = _NO_CACHE_AVAILABLE
 
         # Add move to move_history
+        self._move_snapshots.append(self._snapshot())
         self.move_history.append(m)
         self.move_history_probabilities_cache.append(
             ProbabilityHistory(_NO_CACHE_AVAILABLE, (), 0, 0)
@@ -881,7 +1478,7 @@ class CirqBoard:
             # BASIC: target may be occupied by a pawn same color as the source
             if m.move_variant == enums.MoveVariant.BASIC:
                 self.add_entangled(squbit, tqubit, epqubit)
-                self.circuit.append(
+                self._append(
                     qm.en_passant_basic(
                         squbit,
                         tqubit,
@@ -900,7 +1497,7 @@ class CirqBoard:
                 if target_there:
                     return False
                 self.add_entangled(squbit, tqubit, epqubit)
-                self.circuit.append(
+                self._append(
                     qm.en_passant_basic(
                         squbit,
                         tqubit,
@@ -919,7 +1516,7 @@ class CirqBoard:
                 if not source_there:
                     return False
                 self.add_entangled(squbit, tqubit, epqubit)
-                self.circuit.append(
+                self._append(
                     qm.en_passant_capture(
                         squbit, tqubit, epqubit, self.new_ancilla(), self.new_ancilla()
                     )
@@ -936,7 +1533,7 @@ class CirqBoard:
                 self.state = set_nth_bit(sbit, self.state, False)
             else:
                 self.add_entangled(squbit, tqubit)
-                self.circuit.append(cirq.CNOT(tqubit, squbit))
+                self._append(cirq.CNOT(tqubit, squbit))
             return True
 
         if m.move_type == enums.MoveType.SPLIT_SLIDE:
@@ -960,7 +1557,7 @@ class CirqBoard:
                 self.add_entangled(squbit, tqubit, tqubit2, *path_qubits2)
                 # (0, 1): No qubit in one arm, one qubit in the other. 0 ancilla needed.
                 if len(path_qubits2) == 1:
-                    self.circuit.append(
+                    self._append(
                         qm.split_slide_zero_one(
                             squbit, tqubit, tqubit2, path_qubits2[0]
                         )
@@ -968,7 +1565,7 @@ class CirqBoard:
                 # (0, 2+): No qubit in one arm, multiple qubits in the other. 1 ancilla needed.
                 else:
                     path2 = self._create_path_ancilla(path_qubits2)
-                    self.circuit.append(
+                    self._append(
                         qm.split_slide_zero_multiple(squbit, tqubit, tqubit2, path2)
                     )
                     self._clear_path_ancilla(path_qubits2, path2)
@@ -977,13 +1574,13 @@ class CirqBoard:
                 self.add_entangled(squbit, tqubit, tqubit2, *path_qubits)
                 # (1, 0): No qubit in one arm, one qubit in the other. 0 ancilla needed.
                 if len(path_qubits) == 1:
-                    self.circuit.append(
+                    self._append(
                         qm.split_slide_one_zero(squbit, tqubit, tqubit2, path_qubits[0])
                     )
                 # (2+, 0): No qubit in one arm, multiple qubits in the other. 1 ancilla needed.
                 else:
                     path1 = self._create_path_ancilla(path_qubits)
-                    self.circuit.append(
+                    self._append(
                         qm.split_slide_multiple_zero(squbit, tqubit, tqubit2, path1)
                     )
                     self._clear_path_ancilla(path_qubits, path1)
@@ -994,7 +1591,7 @@ class CirqBoard:
                 if len(path_qubits2) == 1:
                     # If both arms share the same qubit in path. 0 ancilla needed.
                     if qubit_to_bit(path_qubits[0]) == qubit_to_bit(path_qubits2[0]):
-                        self.circuit.append(
+                        self._append(
                             qm.split_slide_one_one_same_qubit(
                                 squbit, tqubit, tqubit2, path_qubits[0]
                             )
@@ -1002,7 +1599,7 @@ class CirqBoard:
                     # Otherwise 1 ancilla needed.
                     else:
                         ancilla = self.new_ancilla()
-                        self.circuit.append(
+                        self._append(
                             qm.split_slide_one_one_diff_qubits(
                                 squbit,
                                 tqubit,
@@ -1016,13 +1613,13 @@ class CirqBoard:
                 else:
                     path2 = self._create_path_ancilla(path_qubits2)
                     ancilla = self.new_ancilla()
-                    self.circuit.append(cirq.X(path_qubits[0]))
-                    self.circuit.append(
+                    self._append(cirq.X(path_qubits[0]))
+                    self._append(
                         qm.split_slide(
                             squbit, tqubit, tqubit2, path_qubits[0], path2, ancilla
                         )
                     )
-                    self.circuit.append(cirq.X(path_qubits[0]))
+                    self._append(cirq.X(path_qubits[0]))
                     self._clear_path_ancilla(path_qubits2, path2)
                 return True
             # (2+, 1): one qubit in one arm, multiple qubits in the other. 2 ancillas needed.
@@ -1030,13 +1627,13 @@ class CirqBoard:
                 self.add_entangled(squbit, tqubit, tqubit2, *path_qubits, *path_qubits2)
                 path1 = self._create_path_ancilla(path_qubits)
                 ancilla = self.new_ancilla()
-                self.circuit.append(cirq.X(path_qubits2[0]))
-                self.circuit.append(
+                self._append(cirq.X(path_qubits2[0]))
+                self._append(
                     qm.split_slide(
                         squbit, tqubit, tqubit2, path1, path_qubits2[0], ancilla
                     )
                 )
-                self.circuit.append(cirq.X(path_qubits2[0]))
+                self._append(cirq.X(path_qubits2[0]))
                 self._clear_path_ancilla(path_qubits, path1)
                 return True
             # (2+, 2+): multiple qubits in both arms. 3 ancillas needed.
@@ -1045,7 +1642,7 @@ class CirqBoard:
                 path1 = self._create_path_ancilla(path_qubits)
                 path2 = self._create_path_ancilla(path_qubits2)
                 ancilla = self.new_ancilla()
-                self.circuit.append(
+                self._append(
                     qm.split_slide(squbit, tqubit, tqubit2, path1, path2, ancilla)
                 )
                 self._clear_path_ancilla(path_qubits, path1)
@@ -1073,7 +1670,7 @@ class CirqBoard:
                 self.add_entangled(squbit, squbit2, tqubit, *path_qubits2)
                 # (0, 1): No qubit in one arm, one qubit in the other. 0 ancilla needed.
                 if len(path_qubits2) == 1:
-                    self.circuit.append(
+                    self._append(
                         qm.merge_slide_zero_one(
                             squbit, tqubit, squbit2, path_qubits2[0]
                         )
@@ -1081,7 +1678,7 @@ class CirqBoard:
                 # (0, 2+): No qubit in one arm, multiple qubits in the other. 1 ancilla needed.
                 else:
                     path2 = self._create_path_ancilla(path_qubits2)
-                    self.circuit.append(
+                    self._append(
                         qm.merge_slide_zero_multiple(squbit, tqubit, squbit2, path2)
                     )
                     self._clear_path_ancilla(path_qubits2, path2)
@@ -1090,13 +1687,13 @@ class CirqBoard:
                 self.add_entangled(squbit, squbit2, tqubit, *path_qubits)
                 # (1, 0): No qubit in one arm, one qubit in the other. 0 ancilla needed.
                 if len(path_qubits) == 1:
-                    self.circuit.append(
+                    self._append(
                         qm.merge_slide_one_zero(squbit, tqubit, squbit2, path_qubits[0])
                     )
                 # (2+, 0): No qubit in one arm, multiple qubits in the other. 1 ancilla needed.
                 else:
                     path1 = self._create_path_ancilla(path_qubits)
-                    self.circuit.append(
+                    self._append(
                         qm.merge_slide_multiple_zero(squbit, tqubit, squbit2, path1)
                     )
                     self._clear_path_ancilla(path_qubits, path1)
@@ -1107,7 +1704,7 @@ class CirqBoard:
                 if len(path_qubits2) == 1:
                     # If both arms share the same qubit in path. 0 ancilla needed.
                     if qubit_to_bit(path_qubits[0]) == qubit_to_bit(path_qubits2[0]):
-                        self.circuit.append(
+                        self._append(
                             qm.merge_slide_one_one_same_qubit(
                                 squbit, tqubit, squbit2, path_qubits[0]
                             )
@@ -1115,7 +1712,7 @@ class CirqBoard:
                     # Otherwise 1 ancilla needed.
                     else:
                         ancilla = self.new_ancilla()
-                        self.circuit.append(
+                        self._append(
                             qm.merge_slide_one_one_diff_qubits(
                                 squbit,
                                 tqubit,
@@ -1129,13 +1726,13 @@ class CirqBoard:
                 else:
                     path2 = self._create_path_ancilla(path_qubits2)
                     ancilla = self.new_ancilla()
-                    self.circuit.append(cirq.X(path_qubits[0]))
-                    self.circuit.append(
+                    self._append(cirq.X(path_qubits[0]))
+                    self._append(
                         qm.merge_slide(
                             squbit, tqubit, squbit2, path_qubits[0], path2, ancilla
                         )
                     )
-                    self.circuit.append(cirq.X(path_qubits[0]))
+                    self._append(cirq.X(path_qubits[0]))
                     self._clear_path_ancilla(path_qubits2, path2)
                 return True
             # (2+, 1): one qubit in one arm, multiple qubits in the other. 2 ancillas needed.
@@ -1143,13 +1740,13 @@ class CirqBoard:
                 self.add_entangled(squbit, squbit2, tqubit, *path_qubits, *path_qubits2)
                 path1 = self._create_path_ancilla(path_qubits)
                 ancilla = self.new_ancilla()
-                self.circuit.append(cirq.X(path_qubits2[0]))
-                self.circuit.append(
+                self._append(cirq.X(path_qubits2[0]))
+                self._append(
                     qm.merge_slide(
                         squbit, tqubit, squbit2, path1, path_qubits2[0], ancilla
                     )
                 )
-                self.circuit.append(cirq.X(path_qubits2[0]))
+                self._append(cirq.X(path_qubits2[0]))
                 self._clear_path_ancilla(path_qubits, path1)
                 return True
             # (2+, 2+): multiple qubits in both arms. 3 ancillas needed.
@@ -1158,7 +1755,7 @@ class CirqBoard:
                 path1 = self._create_path_ancilla(path_qubits)
                 path2 = self._create_path_ancilla(path_qubits2)
                 ancilla = self.new_ancilla()
-                self.circuit.append(
+                self._append(
                     qm.merge_slide(squbit, tqubit, squbit2, path1, path2, ancilla)
                 )
                 self._clear_path_ancilla(path_qubits, path1)
@@ -1199,7 +1796,7 @@ class CirqBoard:
                 else:
                     self.add_entangled(squbit, tqubit, *path_qubits)
                     capture_ancilla = self.new_ancilla()
-                    self.circuit.append(
+                    self._append(
                         qm.controlled_operation(
                             cirq.X, [capture_ancilla], [squbit], path_qubits
                         )
@@ -1226,7 +1823,7 @@ class CirqBoard:
                     self.add_entangled(tqubit)
 
                     # Perform the actual move
-                    self.circuit.append(qm.normal_move(squbit, tqubit))
+                    self._append(qm.normal_move(squbit, tqubit))
 
                     # Set source to empty
                     self.unhook(squbit)
@@ -1244,11 +1841,11 @@ class CirqBoard:
 
             if len(path_qubits) == 1:
                 # For path of one, no ancilla needed
-                self.circuit.append(qm.slide_move(squbit, tqubit, path_qubits))
+                self._append(qm.slide_move(squbit, tqubit, path_qubits))
                 return True
             # Longer paths require a path ancilla
             ancilla = self.new_ancilla()
-            self.circuit.append(qm.slide_move(squbit, tqubit, path_qubits, ancilla))
+            self._append(qm.slide_move(squbit, tqubit, path_qubits, ancilla))
             return True
 
         if (
@@ -1288,7 +1885,7 @@ class CirqBoard:
             self.add_entangled(squbit, tqubit)
 
             # Execute jump
-            self.circuit.append(qm.normal_move(squbit, tqubit))
+            self._append(qm.normal_move(squbit, tqubit))
 
             if unhook or m.move_variant != enums.MoveVariant.BASIC:
                 # The source is empty.
@@ -1313,7 +1910,7 @@ class CirqBoard:
                 and not nth_bit_of(tbit2, self.state)
             )
             self.add_entangled(squbit, tqubit, tqubit2)
-            self.circuit.append(qm.split_move(squbit, tqubit, tqubit2))
+            self._append(qm.split_move(squbit, tqubit, tqubit2))
             if is_basic_case:
                 self.state = set_nth_bit(sbit, self.state, False)
                 self.unhook(squbit)
@@ -1325,7 +1922,7 @@ class CirqBoard:
             sbit2 = square_to_bit(m.source2)
             squbit2 = bit_to_qubit(sbit2)
             self.add_entangled(squbit, squbit2, tqubit)
-            self.circuit.append(qm.merge_move(squbit, squbit2, tqubit))
+            self._append(qm.merge_move(squbit, squbit2, tqubit))
             return True
 
         if m.move_type == enums.MoveType.KS_CASTLE:
@@ -1371,7 +1968,7 @@ class CirqBoard:
             # empty or has a same-color rook in superposition
             if m.move_variant == enums.MoveVariant.BASIC:
                 self.add_entangled(squbit, tqubit, rook_squbit, rook_tqubit, b_qubit)
-                self.circuit.append(
+                self._append(
                     qm.queenside_castle(
                         squbit, rook_squbit, tqubit, rook_tqubit, b_qubit
                     )
@@ -1410,7 +2007,7 @@ class CirqBoard:
                 self.unhook(tqubit)
                 self.unhook(rook_tqubit)
                 self.add_entangled(squbit, tqubit, rook_squbit, rook_tqubit, b_qubit)
-                self.circuit.append(
+                self._append(
                     qm.queenside_castle(
                         squbit, rook_squbit, tqubit, rook_tqubit, b_qubit
                     )
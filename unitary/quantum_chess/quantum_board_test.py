@@ -30,7 +30,7 @@ from unitary.quantum_chess.test_utils import (
     assert_fifty_fifty,
 )
 from unitary.quantum_chess.bit_utils import bit_to_qubit, square_to_bit, nth_bit_of
-from unitary.quantum_chess.caching_utils import CacheKey
+from unitary.quantum_chess.caching_utils import CacheKey, Occupancy, SqliteCache
 
 # The number of samples needed to avoid caching previous repetitions.
 # Choosing this to be above the sample size of is_classical(), which is 1000, will avoid caching.
@@ -1677,6 +1677,109 @@ def test_undo_entangled_measurement():
     assert_prob_about(board_probs, u.squares_to_bitboard(["c3", "c2", "a2", "d1"]), 0.5)
 
 
+def test_undo_restores_snapshots():
+    b = simulator(u.squares_to_bitboard(["a2", "b1", "c2", "d1"]))
+    moves = [
+        "b1^a3c3:SPLIT_JUMP:BASIC",
+        "c2c4:PAWN_TWO_STEP:BASIC",
+        "d1c2:JUMP:EXCLUDED",
+        "a2a4:PAWN_TWO_STEP:BASIC",
+    ]
+    history = []
+    for m in moves:
+        history.append(
+            (
+                b.state,
+                b.circuit.copy(),
+                set(b.entangled_squares),
+                dict(b.post_selection),
+                b.ancilla_count,
+                set(b.allowed_pieces),
+            )
+        )
+        b.perform_moves(m)
+
+    # Undoing must not need the sampler.
+    b.sampler = None
+    for expected in reversed(history):
+        assert b.undo_last_move()
+        assert (
+            b.state,
+            b.circuit,
+            b.entangled_squares,
+            b.post_selection,
+            b.ancilla_count,
+            b.allowed_pieces,
+        ) == expected
+    assert b.move_history == []
+    assert len(b.move_history_probabilities_cache) == 1
+
+
+def test_undo_independent_moves():
+    b = simulator(u.squares_to_bitboard(["b1", "g1", "b8", "g8"]))
+    b.perform_moves("b1^a3c3:SPLIT_JUMP:BASIC")
+    circuit = b.circuit.copy()
+    b.perform_moves(
+        "g1^f3h3:SPLIT_JUMP:BASIC",
+        "b8^a6c6:SPLIT_JUMP:BASIC",
+        "g8^f6h6:SPLIT_JUMP:BASIC",
+    )
+    # Independent moves share the moments of the circuit.
+    assert len(b.circuit) == len(circuit)
+    for _ in range(3):
+        assert b.undo_last_move()
+    assert b.circuit == circuit
+
+
+def test_light_cone():
+    board = simulator(u.squares_to_bitboard(["b1", "g1"]))
+    board.perform_moves("b1^a3c3:SPLIT_JUMP:BASIC")
+    qubits = [board._physical_qubit(q) for q in sorted(board.entangled_squares)]
+    cone = board._light_cone(qubits)
+    assert board._light_cone(reversed(qubits)) is cone
+    board.perform_moves("g1^f3h3:SPLIT_JUMP:BASIC")
+    assert board._light_cone(qubits) is not cone
+    assert board._light_cone(qubits) == cone
+    assert_samples_in(
+        board,
+        {
+            u.squares_to_bitboard(["a3", "f3"]),
+            u.squares_to_bitboard(["a3", "h3"]),
+            u.squares_to_bitboard(["c3", "f3"]),
+            u.squares_to_bitboard(["c3", "h3"]),
+        },
+    )
+
+
+def test_incremental_device_compilation(monkeypatch):
+    b = syc23_noiseless(u.squares_to_bitboard(["b1", "g1"]))
+    b.perform_moves("b1^a3c3:SPLIT_JUMP:BASIC")
+    assert_samples_in(b, {u.squares_to_bitboard([s, "g1"]) for s in ("a3", "c3")})
+    compiled = b._compiled
+    assert compiled.num_ops == len(b._appended_ops)
+
+    # Sampling again does not compile anything, nor recompute the light cone.
+    with monkeypatch.context() as m:
+        m.setattr(qb, "backward_light_cone", None)
+        b.sample(10)
+    assert b._compiled is compiled
+    assert compiled.measured[-1] == compiled.measure_moment.transform_qubits(
+        compiled.mapping.__getitem__
+    )
+
+    # Only the new moves are compiled, with the existing mapping.
+    b.perform_moves("a3b5:JUMP:BASIC")
+    assert_samples_in(b, {u.squares_to_bitboard([s, "g1"]) for s in ("b5", "c3")})
+    assert b._compiled.num_ops == len(b._appended_ops)
+    new_ops = list(b._compiled.circuit.all_operations())
+    assert all(op in new_ops for op in compiled.circuit.all_operations())
+    assert {q: b._compiled.mapping[q] for q in compiled.mapping} == compiled.mapping
+
+    # Undoing a move keeps the compilation of the earlier moves.
+    assert b.undo_last_move()
+    assert b._compiled is compiled
+
+
 def test_record_time():
     b = qb.CirqBoard(u.squares_to_bitboard(["b8", "b5", "c7"]))
     assert b.perform_moves(
@@ -1714,6 +1817,150 @@ def test_record_time():
     assert b.timing_stats["test_action"][-1] == expected_time_2
 
 
+def test_sample_with_ancilla_post_selection():
+    b = simulator(u.squares_to_bitboard(["a1"]))
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    b.post_select_on(bit_to_qubit(square_to_bit("a2")), measurement_outcome=0)
+    samples, ancilla = b.sample_with_ancilla(10, num_reps=100)
+    assert 0 < len(samples) <= 10
+    assert samples == [u.squares_to_bitboard(["a3"])] * len(samples)
+    assert ancilla == [{"anc0_a1": 0, "anc1_a2": 0}] * len(samples)
+    assert "from post-selection" in b.debug_log
+
+
+def test_sample_with_ancilla_error_mitigation():
+    b = qb.CirqBoard(
+        u.squares_to_bitboard(["a1", "b1"]),
+        sampler=cirq.DensityMatrixSimulator(
+            noise=cirq.ConstantQubitNoiseModel(cirq.bit_flip(0.2)),
+            seed=get_seed(),
+        ),
+        error_mitigation=enums.ErrorMitigation.Correct,
+        noise_mitigation=0.05,
+    )
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC", "b1^b2b3:SPLIT_JUMP:BASIC")
+    samples, _ = b.sample_with_ancilla(100, num_reps=1000)
+    assert len(samples) == 100
+    assert all(u.num_ones(sample) == 2 for sample in samples)
+
+
+def test_exact_probabilities():
+    b = qb.CirqBoard(u.squares_to_bitboard(["a1", "b1", "c1"]), exact=True)
+    assert b.perform_moves(
+        "a1^a2a3:SPLIT_JUMP:BASIC",
+        "a2b2:JUMP:BASIC",
+        "c1^c3c4:SPLIT_JUMP:BASIC",
+    )
+    assert not b.is_classical()
+    probs = b.get_probability_distribution()
+    assert probs == pytest.approx(
+        [
+            {"b1": 1.0, "b2": 0.5, "a3": 0.5, "c3": 0.5, "c4": 0.5}.get(square, 0.0)
+            for square in (u.bit_to_square(bit) for bit in range(64))
+        ],
+        abs=1e-6,
+    )
+    assert b.move_history_probabilities_cache[-1].exact
+    assert b.get_full_squares_bitboard() == u.squares_to_bitboard(["b1"])
+    boards = b.get_board_probability_distribution()
+    assert boards == {
+        u.squares_to_bitboard(squares): pytest.approx(0.25, abs=1e-6)
+        for squares in (
+            ["b1", "a3", "c3"],
+            ["b1", "a3", "c4"],
+            ["b1", "b2", "c3"],
+            ["b1", "b2", "c4"],
+        )
+    }
+
+
+def test_exact_probabilities_post_selection():
+    b = qb.CirqBoard(u.squares_to_bitboard(["a1"]), exact=True)
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    b.post_select_on(bit_to_qubit(square_to_bit("a2")), measurement_outcome=0)
+    assert b.is_classical()
+    assert b.get_full_squares_bitboard() == u.squares_to_bitboard(["a3"])
+    assert b.get_board_probability_distribution() == {
+        u.squares_to_bitboard(["a3"]): 1.0
+    }
+
+
+def test_exact_probabilities_factored():
+    files = "abcdefgh"
+    b = qb.CirqBoard(
+        u.squares_to_bitboard([f + "1" for f in files] + [f + "8" for f in files]),
+        exact=True,
+    )
+    for f in files:
+        assert b.perform_moves(
+            f"{f}1^{f}2{f}3:SPLIT_JUMP:BASIC", f"{f}8^{f}7{f}6:SPLIT_JUMP:BASIC"
+        )
+    # The 48 qubits are simulated in 16 independent parts.
+    assert len(b._exact_component_distributions()) == 16
+    probs = b.get_probability_distribution()
+    for f in files:
+        for rank in "2367":
+            assert probs[square_to_bit(f + rank)] == pytest.approx(0.5)
+    boards = b.get_board_probability_distribution()
+    assert len(boards) == 2**16
+    assert sum(boards.values()) == pytest.approx(1.0)
+
+
+def test_exact_probabilities_measurements():
+    b = qb.CirqBoard(u.squares_to_bitboard(["a1", "b1", "c1", "d1"]), exact=True)
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC", "b1^b2b3:SPLIT_JUMP:BASIC")
+    result = b.perform_moves("a2b2:JUMP:CAPTURE")
+    assert any("anc" in q.name for q in b.entangled_squares)
+    probs = b.get_probability_distribution()
+    # The captured piece was on b2 half of the time.
+    assert sum(probs) == pytest.approx(4 - result / 2)
+    assert sum(b.get_board_probability_distribution().values()) == pytest.approx(1.0)
+
+
+def test_exact_probabilities_global_phase(monkeypatch):
+    # Keep the whole circuit, so that the global phase is not pruned.
+    monkeypatch.setattr(qb, "backward_light_cone", lambda circuit, qubits: circuit)
+    b = qb.CirqBoard(u.squares_to_bitboard(["a1", "b1"]), exact=True)
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    b._append(cirq.global_phase_operation(1j))
+    assert b.perform_moves("b1^b2b3:SPLIT_JUMP:BASIC")
+    assert any(not op.qubits for op in b.circuit.all_operations())
+    probs = b.get_probability_distribution()
+    for square in ("a2", "a3", "b2", "b3"):
+        assert probs[square_to_bit(square)] == pytest.approx(0.5)
+    assert len(b.get_board_probability_distribution()) == 4
+
+
+def test_exact_probabilities_too_large(monkeypatch):
+    monkeypatch.setattr(qb, "_MAX_EXACT_QUBITS", 2)
+    b = qb.CirqBoard(u.squares_to_bitboard(["a1", "b1"]), exact=True)
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    with pytest.raises(ValueError, match="exact=False"):
+        b.get_probability_distribution()
+
+
+def test_exact_needs_simulator():
+    with pytest.raises(ValueError, match="Exact"):
+        qb.CirqBoard(0, sampler=cirq.DensityMatrixSimulator(), exact=True)
+    with pytest.raises(ValueError, match="Exact"):
+        qb.CirqBoard(
+            0, device=utils.get_device_obj_by_name("Syc23-noiseless"), exact=True
+        )
+
+
+def test_noise_mask():
+    samples = np.array([5, 3, 5, 5, 3, 7], dtype=np.uint64)
+    assert qb.CirqBoard._noise_mask(samples, 2).tolist() == [
+        True,
+        True,
+        False,
+        False,
+        False,
+        True,
+    ]
+    assert not qb.CirqBoard._noise_mask(samples, 0).any()
+
+
 @pytest.mark.parametrize("board", ALL_CIRQ_BOARDS)
 def test_caching_accumulations_different_repetition_not_cached(board):
     b = board(u.squares_to_bitboard(["a1", "b1"]))
@@ -1757,10 +2004,6 @@ def test_caching_accumulations_same_repetition_cached(board):
 @pytest.mark.parametrize("board", ALL_CIRQ_BOARDS)
 def test_get_probability_distribution_split_jump_pre_cached(board):
     b = board(u.squares_to_bitboard(["a1", "b1"]))
-    # Cache a split jump in advance.
-    cache_key = CacheKey(enums.MoveType.SPLIT_JUMP, CACHE_INVALIDATION_REPS)
-    b.cache_results(cache_key)
-
     m1 = move.Move(
         "a1", "a2", move_type=enums.MoveType.JUMP, move_variant=enums.MoveVariant.BASIC
     )
@@ -1771,13 +2014,22 @@ def test_get_probability_distribution_split_jump_pre_cached(board):
         move_type=enums.MoveType.SPLIT_JUMP,
         move_variant=enums.MoveVariant.BASIC,
     )
+    # Cache a split jump in advance.
+    cache_key = b.cache_results(m2, CACHE_INVALIDATION_REPS)
+    assert cache_key == CacheKey(
+        enums.MoveType.SPLIT_JUMP,
+        CACHE_INVALIDATION_REPS,
+        enums.MoveVariant.BASIC,
+        (Occupancy.FULL, Occupancy.EMPTY, Occupancy.EMPTY),
+        sampler=b.sampler_identity,
+    )
     b.do_move(m1)
 
     probs = list(b.get_probability_distribution(CACHE_INVALIDATION_REPS))
     b.do_move(m2)
     b.clear_debug_log()
     # Expected probability with the cache applied
-    probs[square_to_bit("b1")] = 0
+    probs[square_to_bit("b1")] = b.cache[cache_key]["source"]
     probs[square_to_bit("c1")] = b.cache[cache_key]["target"]
     probs[square_to_bit("d1")] = b.cache[cache_key]["target2"]
 
@@ -1800,9 +2052,6 @@ def test_get_probability_distribution_split_jump_pre_cached(board):
 @pytest.mark.parametrize("board", ALL_CIRQ_BOARDS)
 def test_get_probability_distribution_split_jump_first_move_pre_cached(board):
     b = board(u.squares_to_bitboard(["a1", "b1"]))
-    # Cache a split jump in advance.
-    cache_key = CacheKey(enums.MoveType.SPLIT_JUMP, CACHE_INVALIDATION_REPS)
-    b.cache_results(cache_key)
     m1 = move.Move(
         "b1",
         "c1",
@@ -1810,12 +2059,14 @@ def test_get_probability_distribution_split_jump_first_move_pre_cached(board):
         move_type=enums.MoveType.SPLIT_JUMP,
         move_variant=enums.MoveVariant.BASIC,
     )
+    # Cache a split jump in advance.
+    cache_key = b.cache_results(m1, CACHE_INVALIDATION_REPS)
     b.do_move(m1)
     b.clear_debug_log()
     # Expected probability with the cache applied
     expected_probs = [0] * 64
     expected_probs[square_to_bit("a1")] = 1
-    expected_probs[square_to_bit("b1")] = 0
+    expected_probs[square_to_bit("b1")] = b.cache[cache_key]["source"]
     expected_probs[square_to_bit("c1")] = b.cache[cache_key]["target"]
     expected_probs[square_to_bit("d1")] = b.cache[cache_key]["target2"]
 
@@ -1834,6 +2085,123 @@ def test_get_probability_distribution_split_jump_first_move_pre_cached(board):
     assert nth_bit_of(square_to_bit("b1"), empty_squares)
 
 
+def test_transform_cache_keys():
+    b = simulator(u.squares_to_bitboard(["a1", "c1", "h1"]))
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    b.get_probability_distribution(100)
+    probs = b.move_history_probabilities_cache[-1]
+    # Moving a piece in superposition to an empty square.
+    m = move.Move.from_string("a2c4:SLIDE:BASIC")
+    assert b._transform_cache_key(m, probs, 100) == CacheKey(
+        enums.MoveType.SLIDE,
+        100,
+        enums.MoveVariant.BASIC,
+        (Occupancy.QUANTUM, Occupancy.EMPTY),
+        ((Occupancy.EMPTY,),),
+        b.sampler_identity,
+    )
+    # Sliding through a classical piece.
+    m = move.Move.from_string("h1a1:SLIDE:BASIC")
+    assert b._transform_cache_key(m, probs, 100) == CacheKey(
+        enums.MoveType.SLIDE,
+        100,
+        enums.MoveVariant.BASIC,
+        (Occupancy.FULL, Occupancy.EMPTY),
+        ((Occupancy.EMPTY,) * 4 + (Occupancy.FULL, Occupancy.EMPTY),),
+        b.sampler_identity,
+    )
+    # Sliding through a piece in superposition.
+    m = move.Move.from_string("c1a3:SLIDE:BASIC")
+    assert b._transform_cache_key(m, probs, 100) is None
+    # Capturing with a piece in superposition.
+    m = move.Move.from_string("a2c1:JUMP:CAPTURE")
+    assert b._transform_cache_key(m, probs, 100) is None
+
+
+def test_transform_cache_quantum_source(monkeypatch):
+    b = simulator(u.squares_to_bitboard(["a1", "h1"]))
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    before = b.get_probability_distribution(1000)
+    assert b.perform_moves("a2c4:SLIDE:BASIC")
+    after = b.get_probability_distribution(1000)
+    assert len(b.cache) == 2
+    cache_key = b._transform_cache_key(
+        b.move_history[-1], b.move_history_probabilities_cache[-2], 1000
+    )
+    entry = b.cache[cache_key]
+    assert after[square_to_bit("c4")] == before[square_to_bit("a2")] * entry["target"]
+    assert after[square_to_bit("a2")] == before[square_to_bit("a2")] * entry["source"]
+    assert after[square_to_bit("a3")] == before[square_to_bit("a3")]
+    assert_prob_about(after, square_to_bit("c4"), 0.5)
+    assert_prob_about(after, square_to_bit("h1"), 1.0)
+
+    # Replaying the moves reuses the cached effects instead of sampling.
+    b.with_state(u.squares_to_bitboard(["a1", "h1"]))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("sampled a cached move")
+
+    monkeypatch.setattr(b.sampler, "run", fail)
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    assert b.get_probability_distribution(1000) == before
+    assert b.perform_moves("a2c4:SLIDE:BASIC")
+    assert b.get_probability_distribution(1000) == after
+
+
+def test_shared_sqlite_cache(tmp_path):
+    path = str(tmp_path / "cache.db")
+    b = qb.CirqBoard(u.squares_to_bitboard(["a1"]), cache=SqliteCache(path))
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    probs = b.get_probability_distribution(1000)
+    assert b.cache.misses == 1
+    assert len(b.cache) == 1
+
+    # Another board (as in another process) reuses the stored effect.
+    b2 = qb.CirqBoard(u.squares_to_bitboard(["a1"]), cache=SqliteCache(path))
+    assert b2.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    assert b2.get_probability_distribution(1000) == probs
+    assert b2.cache.hit_rate == 1.0
+
+    # Boards with other sampler settings do not.
+    b3 = qb.CirqBoard(
+        u.squares_to_bitboard(["a1"]),
+        error_mitigation=enums.ErrorMitigation.Error,
+        cache=SqliteCache(path),
+    )
+    assert b3.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    b3.get_probability_distribution(1000)
+    assert b3.cache.hits == 0
+    assert len(b3.cache) == 2
+    assert {key.sampler for key in b3.cache} == {
+        b.sampler_identity,
+        b3.sampler_identity,
+    }
+
+
+def test_sampler_identity_follows_settings():
+    b = qb.CirqBoard(u.squares_to_bitboard(["a1"]))
+    identity = b.sampler_identity
+    b.error_mitigation = enums.ErrorMitigation.Error
+    assert b.sampler_identity != identity
+    b.error_mitigation = enums.ErrorMitigation.Nothing
+    assert b.sampler_identity == identity
+    b.sampler = cirq.DensityMatrixSimulator(noise=cirq.depolarize(0.01))
+    assert b.sampler_identity != identity
+
+    # Effects cached under the old settings are not reused.
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    b.get_probability_distribution(100)
+    assert {key.sampler for key in b.cache} == {b.sampler_identity}
+
+
+def test_transform_cache_disabled():
+    b = qb.CirqBoard(u.squares_to_bitboard(["a1"]), cache_size=0)
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    probs = b.get_probability_distribution(1000)
+    assert_prob_about(probs, square_to_bit("a2"), 0.5)
+    assert len(b.cache) == 0
+
+
 @pytest.mark.parametrize("board", ALL_CIRQ_BOARDS)
 def test_jump_with_successful_measurement_outcome(board):
     b = board(u.squares_to_bitboard(["b1", "c2"]))
@@ -2003,3 +2371,20 @@ def test_measurement_without_fully_classical_position(board):
         "f5^b3:JUMP:CAPTURE",
     )
     assert not b.is_classical()
+
+
+def test_unhook_does_not_rewrite_circuit():
+    b = simulator(u.squares_to_bitboard(["a1"]))
+    assert b.perform_moves("a1^a2a3:SPLIT_JUMP:BASIC")
+    a2 = bit_to_qubit(square_to_bit("a2"))
+    circuit = b.circuit.copy()
+    physical_circuit = b._circuit.copy()
+
+    ancilla = b.unhook(a2)
+    assert b._circuit == physical_circuit
+    assert b.circuit == circuit.transform_qubits(lambda q: ancilla if q == a2 else q)
+
+    # New operations on a2 act on the unused qubit of the ancilla.
+    b._append(cirq.X(a2))
+    assert cirq.X(a2) in b.circuit.all_operations()
+    assert cirq.X(ancilla) in b._circuit.all_operations()
@@ -17,11 +17,11 @@ Look-Ahead Heuristic for the Qubit Mapping Problem of NISQ Computers'
 
 This transforms circuits by adding additional SWAP gates to ensure that all operations are on adjacent qubits.
 """
-from collections import deque
+import math
 from typing import (
     Callable,
-    Deque,
     Dict,
+    FrozenSet,
     Generator,
     Iterable,
     List,
@@ -33,6 +33,7 @@ from typing import (
 import cirq
 
 import unitary.quantum_chess.mcpe_utils as mcpe
+from unitary.quantum_chess.device_graph import DeviceGraph
 
 
 def _satisfies_adjacency(gate: cirq.Operation) -> bool:
@@ -50,43 +51,6 @@ def _satisfies_adjacency(gate: cirq.Operation) -> bool:
     return q1.is_adjacent(q2)
 
 
-def _pairwise_shortest_distances(
-    adjacencies: Dict[cirq.GridQubit, List[cirq.GridQubit]]
-) -> Dict[Tuple[cirq.GridQubit, cirq.GridQubit], int]:
-    """Precomputes the shortest path length between each pair of qubits.
-
-    This function runs in O(V**2) where V=len(qubits).
-
-    Args:
-        adjacencies: adjacency list representation of the qubit graph
-    Returns:
-        dictionary mapping a pair of qubits to the length of the shortest path
-        between them (disconnected qubits will be absent).
-    """
-    # Do BFS starting from each qubit and collect the shortest path lengths as
-    # we go.
-    # For device graphs where all edges are the same (where each edge can be
-    # treated as unit length) repeated BFS is O(V**2 + V E). On sparse device
-    # graphs (like GridQubit graphs where qubits are locally connected to their
-    # neighbors) that is faster than the Floyd-Warshall algorithm which is
-    # O(V**3).
-    # However this won't work if in the future we figure out a way to
-    # incorporate edge weights (for example in order to give negative preference
-    # to gates with poor calibration metrics).
-    shortest = {}
-    for starting_qubit in adjacencies:
-        to_be_visited: Deque[Tuple[cirq.Qid, int]] = deque()
-        shortest[(starting_qubit, starting_qubit)] = 0
-        to_be_visited.append((starting_qubit, 0))
-        while to_be_visited:
-            qubit, cur_dist = to_be_visited.popleft()
-            for neighbor in adjacencies[qubit]:
-                if (starting_qubit, neighbor) not in shortest:
-                    shortest[(starting_qubit, neighbor)] = cur_dist + 1
-                    to_be_visited.append((neighbor, cur_dist + 1))
-    return shortest
-
-
 def _near_mod_n(e, t, n, atol=1e-8):
     return abs((e - t + 1) % n - 1) <= atol
 
@@ -145,6 +109,12 @@ class SwapUpdater:
 
     The SwapUpdater's internal state is modified as the algorithm runs, so each instance is one-time use.
 
+    The greedy choice of SWAPs can go around in circles when the MCPE of the
+    candidate SWAPs ties.  When a mapping repeats, or when too many SWAPs were
+    added since the last circuit gate was output, one of the active gates is
+    instead routed along a shortest path of the device.  Every circuit gate is
+    therefore output after a bounded number of iterations.
+
     Args:
       circuit: the circuit to be updated with additional SWAPs
       device_qubits: the allowed set of qubits on the device. If None, behaves
@@ -153,6 +123,9 @@ class SwapUpdater:
         must contain an entry for every qubit in the circuit
       swap_factory: the factory used to produce operations representing a swap
         of two qubits
+      max_iterations: the number of iterations after which `add_swaps` gives
+        up with a RuntimeError.  If None, a bound is derived from the sizes of
+        the circuit and the device.
     """
 
     def __init__(
@@ -163,20 +136,45 @@ class SwapUpdater:
         swap_factory: Callable[
             [cirq.Qid, cirq.Qid], Iterable[cirq.Operation]
         ] = generate_decomposed_swap,
+        max_iterations: Optional[int] = None,
     ):
         self.device_qubits = device_qubits or []
         self.dlists = mcpe.DependencyLists(circuit)
         self.mapping = mcpe.QubitMapping(initial_mapping)
         self.swap_factory = swap_factory
-        self.adjacent = {q: q.neighbors(device_qubits) for q in self.device_qubits}
-        self.pairwise_distances = _pairwise_shortest_distances(self.adjacent)
+        self.device_graph = DeviceGraph.for_qubits(self.device_qubits)
         # Tracks swaps that have been made since the last circuit gate was
         # output.
         self.prev_swaps: Set[Tuple[cirq.GridQubit, cirq.GridQubit]] = set()
+        # Mappings reached since the last circuit gate was output, used to
+        # detect cycles.
+        self.prev_mappings: Set[FrozenSet[Tuple[cirq.GridQubit, cirq.Qid]]] = set()
+        self.swaps_since_progress = 0
+        self.cycle_detected = False
+        # Swaps without progress after which a gate is routed along a
+        # shortest path.
+        self.max_swaps_without_progress = max(len(self.device_graph), 1)
+        if max_iterations is None:
+            # Each circuit gate is output after at most
+            # max_swaps_without_progress + 2 iterations.
+            num_gates = sum(1 for _ in circuit.all_operations())
+            max_iterations = (self.max_swaps_without_progress + 2) * (num_gates + 1)
+        self.max_iterations = max_iterations
+        # Statistics of the algorithm.
+        self.iterations = 0
+        self.swaps_added = 0
+        self.shortest_path_fallbacks = 0
 
     def _distance_between(self, q1: cirq.GridQubit, q2: cirq.GridQubit) -> int:
-        """Returns the precomputed length of the shortest path between two qubits."""
-        return self.pairwise_distances[(q1, q2)]
+        """Returns the precomputed length of the shortest path between two qubits.
+
+        Raises:
+          KeyError: if the qubits are not connected on the device.
+        """
+        distance = self.device_graph.distance(q1, q2)
+        if distance == math.inf:
+            raise KeyError((q1, q2))
+        return distance
 
     def generate_candidate_swaps(
         self, gates: Iterable[cirq.Operation]
@@ -189,7 +187,7 @@ class SwapUpdater:
         """
         for gate in gates:
             for gate_q in gate.qubits:
-                for swap_q in gate_q.neighbors(self.device_qubits):
+                for swap_q in self.device_graph.neighbors(gate_q):
                     swap_qubits = (gate_q, swap_q)
                     effect = mcpe.effect_of_swap(
                         swap_qubits, gate.qubits, self._distance_between
@@ -203,6 +201,65 @@ class SwapUpdater:
             swap_q1, swap_q2, self.mapping, self._distance_between
         )
 
+    def _swap(
+        self, q1: cirq.GridQubit, q2: cirq.GridQubit
+    ) -> Generator[cirq.Operation, None, None]:
+        """Swaps two physical qubits and generates the corresponding operations."""
+        self.prev_swaps.add((q1, q2))
+        self.prev_swaps.add((q2, q1))
+        self.mapping.swap_physical(q1, q2)
+        self.swaps_added += 1
+        self.swaps_since_progress += 1
+        yield from self.swap_factory(q1, q2)
+
+    def _record_mapping(self) -> None:
+        """Records the current mapping, noting if it was reached before."""
+        state = frozenset(
+            (p, q) for p, q in self.mapping.physical_to_logical.items() if q is not None
+        )
+        if state in self.prev_mappings:
+            self.cycle_detected = True
+        self.prev_mappings.add(state)
+
+    def _stalled(self) -> bool:
+        """Returns whether the greedy swaps stopped making progress."""
+        return (
+            self.cycle_detected
+            or self.swaps_since_progress >= self.max_swaps_without_progress
+        )
+
+    def _route_along_shortest_path(
+        self, gates: Iterable[cirq.Operation]
+    ) -> Generator[cirq.Operation, None, None]:
+        """Swaps the qubits of the closest gate until they are adjacent.
+
+        The first qubit of the gate is moved along a shortest path of the
+        device towards the second one.
+
+        Args:
+          gates: the active gates on GridQubits that do not satisfy adjacency
+        """
+        routable = [
+            gate
+            for gate in gates
+            if all(q in self.device_graph for q in gate.qubits)
+            and self.device_graph.distance(*gate.qubits) != math.inf
+        ]
+        if not routable:
+            # This should never happen for reasonable initial mappings.
+            # For example, it can happen when the initial mapping placed a
+            # gate's qubits on disconnected components in the device
+            # connectivity graph.
+            raise ValueError("no swaps founds that will improve the circuit")
+        gate = min(
+            routable,
+            key=lambda g: (self._distance_between(*g.qubits), sorted(g.qubits)),
+        )
+        self.shortest_path_fallbacks += 1
+        path = self.device_graph.shortest_path(*gate.qubits)
+        for q1, q2 in zip(path[:-2], path[1:-1]):
+            yield from self._swap(q1, q2)
+
     def update_iteration(self) -> Generator[cirq.Operation, None, None]:
         """Runs one iteration of the swap update algorithm and updates internal
         state about the original circuit.
@@ -211,6 +268,7 @@ class SwapUpdater:
           the operations on GridQubits in the final updated circuit generated by
           this iteration
         """
+        self.iterations += 1
         # Handle the already-satisfied active gates.
         # Those can be immediately added into the final circuit.
         active_physical_gates = []
@@ -221,6 +279,9 @@ class SwapUpdater:
                 # and added to the final circuit.
                 self.dlists.pop_active(gate)
                 self.prev_swaps.clear()
+                self.prev_mappings.clear()
+                self.swaps_since_progress = 0
+                self.cycle_detected = False
                 yield physical_gate
             else:
                 # physical_gate needs to be fixed up with some swaps.
@@ -233,17 +294,14 @@ class SwapUpdater:
             return
 
         candidates = set(self.generate_candidate_swaps(active_physical_gates))
-        if not candidates:
-            # This should never happen for reasonable initial mappings.
-            # For example, it can happen when the initial mapping placed a
-            # gate's qubits on disconnected components in the device
-            # connectivity graph.
-            raise ValueError("no swaps founds that will improve the circuit")
+        if not candidates or self._stalled():
+            # The greedy swaps are not making progress, so move the qubits of
+            # one gate next to each other instead.
+            yield from self._route_along_shortest_path(active_physical_gates)
+            return
         chosen_swap = max(candidates, key=lambda swap: self._mcpe(*swap))
-        self.prev_swaps.add(chosen_swap)
-        self.prev_swaps.add((chosen_swap[1], chosen_swap[0]))
-        self.mapping.swap_physical(*chosen_swap)
-        yield from self.swap_factory(*chosen_swap)
+        yield from self._swap(*chosen_swap)
+        self._record_mapping()
 
     def add_swaps(self) -> Generator[cirq.Operation, None, None]:
         """Iterates the swap update algorithm to completion.
@@ -252,6 +310,20 @@ class SwapUpdater:
 
         Returns:
           the generated operations on physical GridQubits in the final circuit
+
+        Raises:
+          RuntimeError: if the algorithm did not finish within
+            `max_iterations` iterations.
         """
         while not self.dlists.all_empty():
+            if self.iterations >= self.max_iterations:
+                remaining = sum(len(d) for d in self.dlists.dependencies.values())
+                raise RuntimeError(
+                    f"SwapUpdater did not finish after {self.iterations} "
+                    f"iterations: {self.swaps_added} swaps added, "
+                    f"{self.shortest_path_fallbacks} shortest path fallbacks, "
+                    f"{self.swaps_since_progress} swaps since the last gate, "
+                    f"{len(self.dlists.active_gates)} active gates and "
+                    f"{remaining} gate dependencies left"
+                )
             yield from self.update_iteration()
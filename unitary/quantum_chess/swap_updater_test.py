@@ -294,3 +294,49 @@ def test_termination_in_local_minimum():
         if _is_swap(prev_it) and _is_swap(cur_it):
             assert set(prev_it[0].qubits) != set(cur_it[0].qubits)
         prev_it = cur_it
+
+
+def test_shortest_path_fallback():
+    grid_1x5 = cirq.GridQubit.rect(1, 5)
+    initial_mapping = {q[0]: grid_1x5[0], q[1]: grid_1x5[4]}
+    circuit = cirq.Circuit(cirq.CNOT(q[0], q[1]), cirq.CNOT(q[1], q[0]))
+    updater = SwapUpdater(
+        circuit, grid_1x5, initial_mapping, lambda q1, q2: [cirq.SWAP(q1, q2)]
+    )
+    # Route every gate along a shortest path instead of using the MCPE.
+    updater.max_swaps_without_progress = 0
+    assert cirq.Circuit(updater.add_swaps()) == cirq.Circuit(
+        cirq.SWAP(grid_1x5[0], grid_1x5[1]),
+        cirq.SWAP(grid_1x5[1], grid_1x5[2]),
+        cirq.SWAP(grid_1x5[2], grid_1x5[3]),
+        cirq.CNOT(grid_1x5[3], grid_1x5[4]),
+        cirq.CNOT(grid_1x5[4], grid_1x5[3]),
+    )
+    assert updater.shortest_path_fallbacks == 1
+    assert updater.swaps_added == 3
+
+
+def test_cycle_detection():
+    grid_2x3 = cirq.GridQubit.rect(2, 3)
+    updater = SwapUpdater(
+        cirq.Circuit(cirq.CNOT(q[0], q[1])),
+        grid_2x3,
+        {q[0]: grid_2x3[0], q[1]: grid_2x3[2]},
+    )
+    updater._record_mapping()
+    assert not updater.cycle_detected
+    updater.mapping.swap_physical(grid_2x3[0], grid_2x3[3])
+    updater._record_mapping()
+    assert not updater.cycle_detected
+    updater.mapping.swap_physical(grid_2x3[0], grid_2x3[3])
+    updater._record_mapping()
+    assert updater.cycle_detected
+
+
+def test_max_iterations():
+    grid_1x5 = cirq.GridQubit.rect(1, 5)
+    initial_mapping = {q[0]: grid_1x5[0], q[1]: grid_1x5[4]}
+    circuit = cirq.Circuit(cirq.CNOT(q[0], q[1]))
+    updater = SwapUpdater(circuit, grid_1x5, initial_mapping, max_iterations=2)
+    with pytest.raises(RuntimeError, match="did not finish after 2 iterations"):
+        list(updater.add_swaps())